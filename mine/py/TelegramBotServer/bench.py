@@ -0,0 +1,370 @@
+"""End-to-end benchmark of the bot against local stand-ins for Telegram and Gemini.
+
+Usage:
+  python bench.py [--updates N] [--pages N] [--gemini-latency SEC] [--async]
+                  [--save-baseline FILE] [--compare FILE]
+
+Nothing leaves the machine: a fake Bot API server (getUpdates, sendMessage,
+sendDocument) runs on 127.0.0.1 and the bot is pointed at it through
+TELEGRAM_API_URL; google.genai is replaced by a stub whose replies take
+--gemini-latency seconds. A synthetic corpus shaped like the real pages
+(/html/body/div[n]/div[2]/span, /html/body/div[7]/p) is generated in a
+temporary directory unless --corpus is given.
+
+Each route ("plain", "?" report, dot trigger, danger sign -> Gemini) is sent
+as a burst of updates, one chat per update. Reply latency is the time from
+an update becoming available to getUpdates until the last message of its
+reply reaches the fake server. Results can be saved as a baseline and later
+runs compared against it; a run slower than the baseline by more than
+--tolerance exits with code 1.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+ROUTES = {
+    "plain": "hello {i}",
+    "report": "hello {i}?",
+    "dots": "hello {i}...",
+    "danger": "hello {i}!",
+}
+WORDS = (
+    "alpha beta gamma delta epsilon zeta theta kappa lambda sigma omega "
+    "river stone cloud light window garden market letter journey morning"
+).split()
+
+
+# ----- Synthetic corpus -----
+def _sentence(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def generate_corpus(root: str, pages: int, seed: int = 1) -> str:
+    """Write `pages` HTML files shaped like the estHTML pages under root."""
+    rng = random.Random(seed)
+    os.makedirs(root, exist_ok=True)
+    for n in range(1, pages + 1):
+        blocks = []
+        for d in range(1, 7):
+            blocks.append(
+                f"<div class=\"b{d}\"><div>{_sentence(rng, 3)}</div>"
+                f"<div><span>{_sentence(rng, rng.randint(5, 40))}</span></div></div>"
+            )
+        blocks.append(f"<div><p>{_sentence(rng, rng.randint(10, 60))}</p></div>")
+        html = (
+            "<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>page</title></head>"
+            f"<body>{''.join(blocks)}</body></html>"
+        )
+        with open(os.path.join(root, f"{n}.html"), "w", encoding="utf-8") as fh:
+            fh.write(html)
+    return root
+
+
+# ----- Fake Telegram Bot API -----
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # socketserver's default backlog of 5 drops connections in bursts (1s+ SYN retries)
+    request_queue_size = 1024
+
+
+class FakeTelegram:
+    """In-process Bot API stand-in that records every message it is sent."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self._cond = threading.Condition()
+        self._pending: List[dict] = []
+        self._next_id = 1
+        self.received: Dict[int, List[float]] = {}  # chat_id -> arrival times
+        self.texts: Dict[int, List[str]] = {}  # chat_id -> message texts, in arrival order
+        self.documents = 0
+        self.server = _Server(("127.0.0.1", 0), self._handler_class())
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, name="fake-telegram", daemon=True).start()
+
+    def push(self, chat_id: int, text: str) -> float:
+        """Make an update available to getUpdates; returns the time it was queued."""
+        with self._cond:
+            upd = {
+                "update_id": self._next_id,
+                "message": {"chat": {"id": chat_id, "first_name": "Bench"}, "text": text},
+            }
+            self._next_id += 1
+            self._pending.append(upd)
+            self._cond.notify_all()
+            return time.monotonic()
+
+    def get_updates(self, offset: int, timeout: float) -> List[dict]:
+        with self._cond:
+            self._pending = [u for u in self._pending if u["update_id"] >= offset]
+            self._cond.wait_for(lambda: self._pending, timeout=timeout)
+            return self._pending[:100]
+
+    def record(self, chat_id: int, text: str = ""):
+        if self.latency:
+            time.sleep(self.latency)
+        now = time.monotonic()
+        with self._cond:
+            self.received.setdefault(chat_id, []).append(now)
+            self.texts.setdefault(chat_id, []).append(text)
+
+    def message_count(self) -> int:
+        with self._cond:
+            return sum(len(v) for v in self.received.values())
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately; without this, delayed ACKs dominate
+            disable_nagle_algorithm = True
+
+            def _reply(self, result):
+                body = json.dumps({"ok": True, "result": result}).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _dispatch(self, params: dict, body: bytes):
+                method = urlparse(self.path).path.rsplit("/", 1)[-1]
+                if method == "getUpdates":
+                    offset = int(params.get("offset") or 0)
+                    timeout = float(params.get("timeout") or 0)
+                    return self._reply(fake.get_updates(offset, timeout))
+                if method == "sendMessage":
+                    if body:
+                        params = json.loads(body.decode("utf-8"))
+                    fake.record(int(params["chat_id"]), params.get("text", ""))
+                    return self._reply({"message_id": 1})
+                if method == "sendDocument":
+                    fake.documents += 1
+                    return self._reply({"message_id": 1})
+                self._reply(True)
+
+            def do_GET(self):
+                params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+                self._dispatch(params, b"")
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+                if self.headers.get("Content-Type", "").startswith("multipart/"):
+                    body = b""
+                self._dispatch(params, body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+# ----- Stub Gemini SDK -----
+def install_fake_genai(latency: float):
+    """Register a google.genai stand-in whose calls take `latency` seconds."""
+    import asyncio
+
+    class Response:
+        def __init__(self, contents: str):
+            self.text = f"AI reply to a {len(contents)} character prompt"
+
+    class Models:
+        def generate_content(self, model: str, contents: str):
+            time.sleep(latency)
+            return Response(contents)
+
+        def get(self, model: str):
+            return {"name": model}
+
+    class AsyncModels:
+        async def generate_content(self, model: str, contents: str):
+            await asyncio.sleep(latency)
+            return Response(contents)
+
+    class Client:
+        def __init__(self, api_key: Optional[str] = None):
+            self.models = Models()
+            self.aio = types.SimpleNamespace(models=AsyncModels())
+
+    genai = types.ModuleType("google.genai")
+    genai.Client = Client
+    google = types.ModuleType("google")
+    google.genai = genai
+    sys.modules["google"] = google
+    sys.modules["google.genai"] = genai
+
+
+# ----- Measurement -----
+def _percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def run_route(fake: FakeTelegram, name: str, updates: int, first_chat: int, settle: float, timeout: float) -> dict:
+    """Send a burst of updates for one route and measure the replies."""
+    template = ROUTES[name]
+    pushed = {}
+    for i in range(updates):
+        chat_id = first_chat + i
+        pushed[chat_id] = fake.push(chat_id, template.format(i=chat_id))
+    started = min(pushed.values())
+
+    # Done once every chat has an answer and no message has arrived for `settle` seconds
+    deadline = time.monotonic() + timeout
+    last_count, last_change = -1, time.monotonic()
+    while time.monotonic() < deadline:
+        count = fake.message_count()
+        if count != last_count:
+            last_count, last_change = count, time.monotonic()
+        answered = sum(1 for c in pushed if fake.received.get(c))
+        if answered == len(pushed) and time.monotonic() - last_change >= settle:
+            break
+        time.sleep(0.01)
+
+    latencies = [fake.received[c][-1] - t for c, t in pushed.items() if fake.received.get(c)]
+    finished = max(fake.received[c][-1] for c in pushed if fake.received.get(c)) if latencies else started
+    return {
+        "updates": updates,
+        "answered": len(latencies),
+        "messages": sum(len(fake.received.get(c, ())) for c in pushed),
+        "updates_per_sec": len(latencies) / max(finished - started, 1e-9),
+        "p50_ms": _percentile(latencies, 0.50) * 1000 if latencies else None,
+        "p99_ms": _percentile(latencies, 0.99) * 1000 if latencies else None,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float, min_delta_ms: float = 10.0) -> List[str]:
+    """Regressions of results against baseline beyond the given tolerance (0.2 = 20%).
+
+    Latencies must also be worse by at least min_delta_ms, so jitter on
+    millisecond-scale routes is not reported.
+    """
+    problems = []
+    for route, cur in results["routes"].items():
+        old = baseline.get("routes", {}).get(route)
+        if not old:
+            continue
+        if cur["updates_per_sec"] < old["updates_per_sec"] * (1 - tolerance):
+            problems.append(
+                f"{route}: {cur['updates_per_sec']:.1f} updates/s vs baseline {old['updates_per_sec']:.1f}"
+            )
+        for key in ("p50_ms", "p99_ms"):
+            if (
+                cur[key] is not None
+                and old.get(key)
+                and cur[key] > old[key] * (1 + tolerance)
+                and cur[key] - old[key] >= min_delta_ms
+            ):
+                problems.append(f"{route}: {key} {cur[key]:.1f} vs baseline {old[key]:.1f}")
+        if cur["answered"] < cur["updates"]:
+            problems.append(f"{route}: only {cur['answered']}/{cur['updates']} updates answered")
+    return problems
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the bot against local fake Telegram/Gemini servers.")
+    parser.add_argument("--updates", type=int, default=200, help="updates per route (default 200)")
+    parser.add_argument("--pages", type=int, default=500, help="synthetic corpus size (default 500)")
+    parser.add_argument("--corpus", help="use this HTML directory instead of a synthetic corpus")
+    parser.add_argument("--gemini-latency", type=float, default=0.05, help="stub Gemini reply time in seconds")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="fake sendMessage handling time")
+    parser.add_argument("--routes", default=",".join(ROUTES), help="comma-separated subset of: " + ",".join(ROUTES))
+    parser.add_argument("--async", dest="use_async", action="store_true", help="benchmark the asyncio runtime")
+    parser.add_argument("--telegram-limits", action="store_true", help="keep Telegram's send rate limits on")
+    parser.add_argument("--settle", type=float, default=0.3, help="quiet time that ends a route")
+    parser.add_argument("--timeout", type=float, default=120.0, help="give up on a route after this long")
+    parser.add_argument("--save-baseline", metavar="FILE", help="write the results to FILE")
+    parser.add_argument("--compare", metavar="FILE", help="compare with a saved baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression (default 0.2 = 20%%)")
+    parser.add_argument(
+        "--min-delta-ms", type=float, default=10.0, help="ignore latency regressions smaller than this (default 10)"
+    )
+    args = parser.parse_args(argv)
+
+    routes = [r.strip() for r in args.routes.split(",") if r.strip()]
+    unknown = [r for r in routes if r not in ROUTES]
+    if unknown:
+        parser.error(f"unknown route(s): {', '.join(unknown)}")
+
+    tmp = tempfile.TemporaryDirectory(prefix="botbench-")
+    corpus = args.corpus or generate_corpus(os.path.join(tmp.name, "html"), args.pages)
+    fake = FakeTelegram(latency=args.telegram_latency)
+    install_fake_genai(args.gemini_latency)
+    os.environ.update(
+        TELEGRAM_BOT_TOKEN="bench",
+        GEMINI_API_KEY="bench",
+        TELEGRAM_API_URL=fake.url,
+        EST_HTML_DIR=corpus,
+        EST_INDEX_CACHE="off",
+        xGeneral=os.getenv("xGeneral") or "/html/body/div[7]/p",
+    )
+    if not args.telegram_limits:
+        os.environ.update(TELEGRAM_CHAT_RATE="0", TELEGRAM_GLOBAL_RATE="0")
+
+    import bot  # after the environment is prepared: TELEGRAM_API_URL is read at import
+
+    if args.use_async:
+        import asyncio
+
+        target = lambda: asyncio.run(bot.main_async())  # noqa: E731
+    else:
+        target = bot.main
+    threading.Thread(target=target, name="bot", daemon=True).start()
+
+    # Warm-up: wait for the index and open the connections before measuring
+    warm = run_route(fake, "plain", 20, 1, args.settle, args.timeout)
+    if not warm["answered"]:
+        print("ERROR: the bot did not answer during warm-up", file=sys.stderr)
+        return 2
+
+    results = {
+        "runtime": "asyncio" if args.use_async else "threads",
+        "updates": args.updates,
+        "pages": args.pages if not args.corpus else None,
+        "gemini_latency": args.gemini_latency,
+        "routes": {},
+    }
+    first_chat = 1000
+    for route in routes:
+        results["routes"][route] = run_route(fake, route, args.updates, first_chat, args.settle, args.timeout)
+        first_chat += args.updates
+
+    print(f"\nRuntime: {results['runtime']}, {args.updates} updates per route, Gemini stub {args.gemini_latency}s")
+    print(f"{'route':<8} {'updates/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'messages':>9}")
+    for route, r in results["routes"].items():
+        p50 = f"{r['p50_ms']:.1f}" if r["p50_ms"] is not None else "-"
+        p99 = f"{r['p99_ms']:.1f}" if r["p99_ms"] is not None else "-"
+        print(f"{route:<8} {r['updates_per_sec']:>10.1f} {p50:>9} {p99:>9} {r['messages']:>9}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as fh:
+            json.dump(results, fh, indent=2)
+        print(f"Baseline written to {args.save_baseline}")
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as fh:
+            baseline = json.load(fh)
+        problems = compare(results, baseline, args.tolerance, args.min_delta_ms)
+        for p in problems:
+            print(f"REGRESSION: {p}")
+        if problems:
+            return 1
+        print(f"No regression beyond {args.tolerance:.0%} of {args.compare}")
+    return 0
+
+
+if __name__ == "__main__":
+    # The bot runs on daemon threads; leave without waiting for them
+    code = main()
+    sys.stdout.flush()
+    os._exit(code)
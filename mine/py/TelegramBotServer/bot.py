@@ -2,15 +2,38 @@ import os
 import sys
 import time
 import json
+import functools
+import errno
+import codecs
 import random
-import mimetypes
-import http.client
+import bisect
+import queue
+import signal
+import threading
+import struct
+from array import array
+from collections import OrderedDict, deque
 from urllib.parse import urlencode
 from html.parser import HTMLParser
 from typing import Optional, List, Tuple
 
 
-API_HOST = "api.telegram.org"
+def _api_base(url: str) -> Tuple[str, bool]:
+    """Split TELEGRAM_API_URL into (host[:port], use_tls).
+
+    Unset means the public api.telegram.org over HTTPS; a local Bot API server
+    is typically http://localhost:8081.
+    """
+    url = url.strip().rstrip("/")
+    if not url:
+        return "api.telegram.org", True
+    scheme, sep, rest = url.partition("://")
+    if not sep:
+        return url, True
+    return rest, scheme.lower() != "http"
+
+
+API_HOST, API_TLS = _api_base(os.getenv("TELEGRAM_API_URL", ""))
 POLL_TIMEOUT_SEC = 50  # long polling duration
 SLEEP_BETWEEN_ERRORS_SEC = 5
 
@@ -22,120 +45,660 @@ def getenv_strict(name: str) -> str:
     return val
 
 
-def find_html_files(root_path: str):
-    exts = {".html", ".htm"}
-    files = []
-    for base, _, names in os.walk(root_path):
-        for n in names:
-            if os.path.splitext(n)[1].lower() in exts:
-                files.append(os.path.join(base, n))
-    return files
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, "") or default)
+    except ValueError:
+        return default
 
 
-def http_get_json(host: str, path: str, params: dict):
-    conn = http.client.HTTPSConnection(host, timeout=POLL_TIMEOUT_SEC + 10)
+def _env_flag(name: str) -> bool:
+    return os.getenv(name, "").strip().lower() in ("1", "true", "yes", "on")
+
+
+def _env_float(name: str, default: float) -> float:
     try:
-        qp = urlencode(params)
-        full_path = f"{path}?{qp}" if qp else path
-        conn.request("GET", full_path)
-        resp = conn.getresponse()
-        data = resp.read()
-        if resp.status != 200:
-            raise RuntimeError(f"HTTP {resp.status}: {data[:200]!r}")
-        obj = json.loads(data.decode("utf-8"))
-        return obj
-    finally:
-        conn.close()
+        return float(os.getenv(name, "") or default)
+    except ValueError:
+        return default
+
+
+class PathTable:
+    """Compact, append-only list of file paths (the corpus catalog).
+
+    Every directory is stored once; file names are packed into one buffer
+    with an array of end offsets. A path costs its file name plus a few
+    machine words instead of a full str object, and table[i] rebuilds it in
+    O(1), so sampling a random row stays constant-time. find() looks a path
+    up through an open-addressing table of row numbers.
+    """
+
+    def __init__(self, paths=()):
+        self.dirs: List[str] = []
+        self._dir_id = {}
+        self._names = bytearray()
+        self._ends = array("I")  # end offset of each name; 4 GiB of names is plenty
+        self._dir_of = array("I")
+        self._slots = array("i", [-1]) * 8  # row per hash slot, -1 = free
+        for path in paths:
+            self.append(path)
+
+    def __len__(self) -> int:
+        return len(self._ends)
+
+    def __getitem__(self, row: int) -> str:
+        if row < 0:
+            row += len(self._ends)
+        end = self._ends[row]
+        start = self._ends[row - 1] if row else 0
+        return self.dirs[self._dir_of[row]] + os.fsdecode(bytes(self._names[start:end]))
+
+    def __iter__(self):
+        for row in range(len(self._ends)):
+            yield self[row]
+
+    def random_index(self) -> int:
+        return random.randrange(len(self._ends))
+
+    def rows_under(self, folder: str) -> List[int]:
+        """Rows of every path inside `folder`, at any depth."""
+        prefix = folder if folder.endswith(("/", os.sep)) else folder + os.sep
+        ids = {i for i, d in enumerate(self.dirs) if d.startswith(prefix)}
+        if not ids:
+            return []
+        return [row for row, dir_id in enumerate(self._dir_of) if dir_id in ids]
+
+    def _split(self, path: str) -> Tuple[str, bytes]:
+        # Cut after the last separator, keeping it, so that dir + name == path exactly
+        cut = max(path.rfind("/"), path.rfind(os.sep)) + 1
+        return path[:cut], os.fsencode(path[cut:])
+
+    def append(self, path: str) -> int:
+        """Add a path and return its row (duplicates are not checked; see find)."""
+        folder, name = self._split(path)
+        dir_id = self._dir_id.get(folder)
+        if dir_id is None:
+            dir_id = self._dir_id[folder] = len(self.dirs)
+            self.dirs.append(folder)
+        row = len(self._ends)
+        self._names += name
+        self._dir_of.append(dir_id)
+        # Appending the end offset publishes the row: readers size themselves by _ends
+        self._ends.append(len(self._names))
+        if 2 * len(self._ends) > len(self._slots):
+            self._rehash(2 * len(self._slots))
+        else:
+            slot = self._slot(dir_id, name)
+            if self._slots[slot] < 0:
+                self._slots[slot] = row
+        return row
+
+    def find(self, path: str) -> Optional[int]:
+        """Row of the first occurrence of path, or None."""
+        folder, name = self._split(path)
+        dir_id = self._dir_id.get(folder)
+        if dir_id is None:
+            return None
+        row = self._slots[self._slot(dir_id, name)]
+        return row if row >= 0 else None
+
+    def _slot(self, dir_id: int, name: bytes, slots=None) -> int:
+        # Linear probing on (directory, file name); compares bytes, no str is built
+        if slots is None:
+            slots = self._slots
+        mask = len(slots) - 1
+        i = hash((dir_id, name)) & mask
+        ends, names, dir_of = self._ends, self._names, self._dir_of
+        while True:
+            row = slots[i]
+            if row < 0 or (dir_of[row] == dir_id and names[ends[row - 1] if row else 0:ends[row]] == name):
+                return i
+            i = (i + 1) & mask
+
+    def _rehash(self, size: int):
+        # Filled aside and swapped in whole, so a concurrent find() never sees a half-built table
+        slots = array("i", [-1]) * size
+        start = 0
+        for row, end in enumerate(self._ends):
+            slot = self._slot(self._dir_of[row], bytes(self._names[start:end]), slots)
+            if slots[slot] < 0:
+                slots[slot] = row
+            start = end
+        self._slots = slots
+
+
+# ----- Metrics -----
+# name -> (type, help) of everything exported on the metrics endpoint
+METRIC_HELP = {
+    "bot_updates_total": ("counter", "Telegram updates handled"),
+    "bot_updates_duplicate_total": ("counter", "Redelivered updates skipped because they were already handled"),
+    "bot_update_seconds": ("histogram", "Time to handle one update end to end, by route"),
+    "bot_get_updates_seconds": ("histogram", "getUpdates round trip, including the long-poll wait"),
+    "bot_page_read_seconds": ("histogram", "Reading one HTML file while indexing"),
+    "bot_page_parse_seconds": ("histogram", "Parsing one HTML page and extracting its XPaths while indexing"),
+    "bot_page_lookup_seconds": ("histogram", "Picking a random page and its XPath values for an update"),
+    "bot_index_pages_total": ("counter", "Pages loaded into the index, by source (cache, parsed, csv, watch)"),
+    "bot_corpus_changes_total": ("counter", "Pages added, changed or removed by the corpus watcher"),
+    "bot_gemini_seconds": ("histogram", "gemini_generate latency including fallback-model retries, by outcome"),
+    "bot_gemini_model_fallback_total": ("counter", "Gemini calls retried on the fallback model"),
+    "bot_gemini_circuit_state": ("gauge", "Gemini circuit breaker: 0 closed, 1 open, 2 half-open (probing)"),
+    "bot_gemini_late_total": ("counter", "AI replies that missed the reply deadline, by what happened to them"),
+    "bot_gemini_cache_hits_total": ("counter", "Gemini replies served from the response cache"),
+    "bot_gemini_cache_misses_total": ("counter", "Gemini prompts not found in the response cache"),
+    "bot_telegram_send_seconds": ("histogram", "Telegram send round trip (a pipelined batch or a single message)"),
+    "bot_telegram_messages_total": ("counter", "Outgoing messages, by result"),
+    "bot_telegram_retry_after_total": ("counter", "Outgoing messages rejected with 429 and resent"),
+    "bot_queue_depth": ("gauge", "Updates queued or running in the dispatcher"),
+    "bot_interaction_log_written_total": ("counter", "Interaction log records written"),
+    "bot_interaction_log_dropped_total": ("counter", "Interaction log records dropped because the writer fell behind"),
+}
+
+
+class Histogram:
+    """Counts of observed durations in fixed (Prometheus style) buckets."""
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile (inf past the last bucket)."""
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.BUCKETS + (float("inf"),), self.counts):
+            seen += n
+            if n and seen >= rank:
+                return bound
+        return float("inf")
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    parts = []
+    for k, v in labels:
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{k}="{v}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _format_number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return str(int(value)) if value == int(value) else repr(float(value))
+
+
+class _Timer:
+    __slots__ = ("metrics", "name", "labels", "started")
+
+    def __init__(self, metrics: "Metrics", name: str, labels: dict):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.monotonic() - self.started, **self.labels)
+        return False
+
+
+class Metrics:
+    """Process-wide counters and latency histograms.
+
+    Series are keyed by name plus keyword labels; values that live elsewhere
+    (queue depth, cache hits) are read through callbacks when rendering.
+    render() produces the Prometheus text format, summary() the shutdown report.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> Histogram
+        self._callbacks = {}  # name -> fn() returning the current value
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = Histogram()
+            hist.observe(seconds)
+
+    def time(self, name: str, **labels) -> _Timer:
+        """Context manager that observes the duration of its block."""
+        return _Timer(self, name, labels)
+
+    def set_callback(self, name: str, fn):
+        self._callbacks[name] = fn
+
+    def counter(self, name: str) -> float:
+        """Sum of a counter over all its labels."""
+        with self._lock:
+            return sum(v for (n, _), v in self._counters.items() if n == name)
+
+    def render(self) -> str:
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                ((key, list(h.counts), h.sum, h.count) for key, h in self._histograms.items()),
+                key=lambda item: item[0],
+            )
+        callbacks = {}
+        for name, fn in list(self._callbacks.items()):
+            try:
+                callbacks[name] = fn()
+            except Exception:
+                pass
+
+        lines = []
+        for name, (kind, help_text) in METRIC_HELP.items():
+            series = []
+            if name in callbacks:
+                series.append(f"{name} {_format_number(callbacks[name])}")
+            for (n, labels), value in counters:
+                if n == name:
+                    series.append(f"{name}{_format_labels(labels)} {_format_number(value)}")
+            for (n, labels), counts, total, count in histograms:
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, c in zip(Histogram.BUCKETS + (float("inf"),), counts):
+                    cumulative += c
+                    le = labels + (("le", _format_number(bound)),)
+                    series.append(f"{name}_bucket{_format_labels(le)} {cumulative}")
+                series.append(f"{name}_sum{_format_labels(labels)} {_format_number(total)}")
+                series.append(f"{name}_count{_format_labels(labels)} {count}")
+            if series:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.extend(series)
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        uptime = max(time.monotonic() - self.started, 1e-9)
+        updates = self.counter("bot_updates_total")
+        lines = [f"Metrics: {updates:.0f} updates in {uptime:.0f}s ({updates / uptime:.2f}/s)"]
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            for (name, labels), h in histograms:
+                if h.count:
+                    lines.append(
+                        f"  {name}{_format_labels(labels)}: n={h.count}, mean {h.sum / h.count:.3f}s, "
+                        f"p50 <= {_format_number(h.quantile(0.5))}s, p99 <= {_format_number(h.quantile(0.99))}s"
+                    )
+        return "\n".join(lines)
+
+
+METRICS = Metrics()
+
+
+def start_metrics_server(host: str, port: int, metrics: Metrics = METRICS):
+    """Serve metrics.render() at http://host:port/metrics on a daemon thread."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class _MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+# ----- Keep-alive HTTPS connection pools -----
+def _stale_conn_errors() -> tuple:
+    """Errors that, on a reused connection, mean the server closed it while
+    idle: reconnect and try again once. (http.client is imported on first use.)"""
+    import http.client
+
+    return (ConnectionError, http.client.BadStatusLine, http.client.ImproperConnectionState)
+
+
+class HTTPSConnectionPool:
+    """Keep-alive HTTPS connections to a single host, reused across requests.
+
+    Up to `maxsize` idle connections are kept; when all are busy a new one is
+    opened, and surplus connections are closed when they are returned.
+    """
+
+    def __init__(self, host: str, timeout: float, maxsize: int = 4, use_tls: bool = True):
+        self.host = host
+        self.timeout = timeout
+        self.use_tls = use_tls
+        self._idle = queue.LifoQueue(maxsize=max(1, maxsize))
+
+    def _connect(self):
+        import http.client
+
+        if not self.use_tls:
+            return http.client.HTTPConnection(self.host, timeout=self.timeout)
+        return http.client.HTTPSConnection(self.host, timeout=self.timeout)
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait(), True
+        except queue.Empty:
+            return self._connect(), False
+
+    def _checkin(self, conn):
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def request(self, method: str, path: str, body=None, headers: Optional[dict] = None) -> Tuple[int, bytes]:
+        """Send a request and return (status, response_body)."""
+        conn, reused = self._checkout()
+        while True:
+            try:
+                conn.request(method, path, body=body, headers=headers or {})
+                resp = conn.getresponse()
+                data = resp.read()
+            except _stale_conn_errors():
+                conn.close()
+                if not reused:
+                    raise
+                # Stale keep-alive socket: retry once on a fresh connection
+                conn, reused = self._connect(), False
+                continue
+            except Exception:
+                conn.close()
+                raise
+            if resp.will_close:
+                conn.close()
+            else:
+                self._checkin(conn)
+            return resp.status, data
+
+    def pipeline(self, requests: List[tuple]) -> List[Tuple[int, bytes]]:
+        """Send several (method, path, body, headers) requests back to back on
+        one connection (HTTP/1.1 pipelining) and return their (status, body)
+        in order.
+
+        Requests may be non-idempotent (sendMessage), so they are only sent
+        again when a reused keep-alive socket fails before a single byte of
+        response came back. Once any response was read, a failure is not
+        retried: the requests left unanswered get status 0. If nothing was
+        answered at all, the error is raised.
+        """
+        results: List[Tuple[int, bytes]] = []
+        conn, reused = self._checkout()
+        while len(results) < len(requests):
+            pending = requests[len(results):]
+            answered = False  # some response bytes were read on this connection
+            keep_alive = True
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                conn.sock.sendall(b"".join(_encode_request(self.host, *r) for r in pending))
+                fp = conn.sock.makefile("rb")
+                try:
+                    for _ in pending:
+                        answered = answered or bool(fp.peek(1))
+                        status, headers, data = _read_http_response(fp)
+                        results.append((status, data))
+                        if headers.get("connection", "").lower() == "close":
+                            # The server stops after this one; the rest go on a new connection
+                            keep_alive = False
+                            break
+                finally:
+                    fp.close()
+            except Exception as e:
+                conn.close()
+                if reused and not answered and isinstance(e, _stale_conn_errors()):
+                    # Stale keep-alive socket: nothing was processed, send again on a fresh one
+                    conn, reused = self._connect(), False
+                    continue
+                if not results:
+                    raise
+                return results + [(0, b"")] * (len(requests) - len(results))
+            if not keep_alive:
+                conn.close()
+                conn, reused = self._connect(), False
+        self._checkin(conn)
+        return results
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def _encode_request(host: str, method: str, path: str, body: bytes = b"", headers: Optional[dict] = None) -> bytes:
+    lines = [f"{method} {path} HTTP/1.1", f"Host: {host}", "Connection: keep-alive"]
+    for k, v in (headers or {}).items():
+        lines.append(f"{k}: {v}")
+    if body or method == "POST":
+        lines.append(f"Content-Length: {len(body)}")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + (body or b"")
+
+
+def _read_http_response(fp) -> Tuple[int, dict, bytes]:
+    """Read one HTTP/1.1 response from a buffered file; returns (status, headers, body)."""
+    import http.client
+
+    status_line = fp.readline(65537)
+    if not status_line:
+        raise http.client.RemoteDisconnected("Remote end closed connection without response")
+    try:
+        status = int(status_line.split()[1])
+    except (IndexError, ValueError):
+        raise http.client.BadStatusLine(repr(status_line))
+    headers = {}
+    while True:
+        line = fp.readline(65537)
+        if line in (b"\r\n", b"\n", b""):
+            break
+        k, _, v = line.decode("latin-1").partition(":")
+        headers[k.strip().lower()] = v.strip()
+
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        parts = []
+        while True:
+            size = int(fp.readline(65537).split(b";")[0], 16)
+            if size == 0:
+                fp.readline(65537)
+                break
+            parts.append(fp.read(size))
+            fp.readline(65537)
+        data = b"".join(parts)
+    elif "content-length" in headers:
+        length = int(headers["content-length"])
+        data = fp.read(length)
+        if len(data) < length:
+            raise http.client.IncompleteRead(data, length - len(data))
+    else:
+        data = fp.read()
+        headers["connection"] = "close"
+    return status, headers, data
+
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def _get_pool(host: str, kind: str = "send") -> HTTPSConnectionPool:
+    """Shared pool for host. Long polling ("poll") gets its own connection so
+    it never competes with outgoing sends ("send")."""
+    key = (host, kind)
+    with _POOLS_LOCK:
+        pool = _POOLS.get(key)
+        if pool is None:
+            use_tls = API_TLS if host == API_HOST else True
+            if kind == "poll":
+                pool = HTTPSConnectionPool(host, timeout=POLL_TIMEOUT_SEC + 10, maxsize=1, use_tls=use_tls)
+            else:
+                pool = HTTPSConnectionPool(
+                    host, timeout=60, maxsize=_env_int("TELEGRAM_POOL_SIZE", 4), use_tls=use_tls
+                )
+            _POOLS[key] = pool
+        return pool
+
+
+def http_get_json(host: str, path: str, params: dict, pool: str = "send"):
+    qp = urlencode(params)
+    full_path = f"{path}?{qp}" if qp else path
+    status, data = _get_pool(host, pool).request("GET", full_path)
+    if status != 200:
+        raise RuntimeError(f"HTTP {status}: {data[:200]!r}")
+    obj = json.loads(data.decode("utf-8"))
+    return obj
 
 
 def http_post_json(host: str, path: str, body_obj: dict):
     data = json.dumps(body_obj).encode("utf-8")
-    conn = http.client.HTTPSConnection(host, timeout=60)
-    try:
-        conn.request(
-            "POST",
-            path,
-            body=data,
-            headers={
-                "Content-Type": "application/json; charset=utf-8",
-                "Content-Length": str(len(data)),
-            },
-        )
-        resp = conn.getresponse()
-        resp_data = resp.read()
-        if resp.status != 200:
-            raise RuntimeError(f"HTTP {resp.status}: {resp_data[:500]!r}")
-        return json.loads(resp_data.decode("utf-8"))
-    finally:
-        conn.close()
+    status, resp_data = _get_pool(host).request(
+        "POST",
+        path,
+        body=data,
+        headers={
+            "Content-Type": "application/json; charset=utf-8",
+            "Content-Length": str(len(data)),
+        },
+    )
+    if status != 200:
+        raise RuntimeError(f"HTTP {status}: {resp_data[:500]!r}")
+    return json.loads(resp_data.decode("utf-8"))
 
 
-def build_multipart(fields: dict, files: dict):
-    """Builds a multipart/form-data body.
+_MULTIPART_CHUNK = 256 * 1024
+
+
+class MultipartBody:
+    """A multipart/form-data request body that is streamed, not built in memory.
 
     fields: {name: value}
-    files: {name: (filename, bytes, content_type)}
-    Returns: (content_type_header_value, body_bytes)
-    """
-    boundary = f"----WebKitFormBoundary{random.randrange(10**15, 10**16-1)}"
-    lines = []
+    files: {name: (filename, source, content_type)}, where source is a file
+    path (read in _MULTIPART_CHUNK pieces while sending) or bytes.
 
-    def add(s: str):
-        lines.append(s.encode("utf-8"))
+    len() is the exact Content-Length, known before anything is sent.
+    Iterating yields the encoded body; files are reopened on every
+    iteration, so the body can be sent again when a stale keep-alive
+    connection is retried. Memory use is one chunk buffer per body,
+    whatever the file sizes.
+    """
 
-    for name, value in (fields or {}).items():
-        add(f"--{boundary}")
-        add(f"Content-Disposition: form-data; name=\"{name}\"")
-        add("")
-        add(str(value))
+    def __init__(self, fields: dict, files: dict):
+        self.boundary = f"----WebKitFormBoundary{random.randrange(10**15, 10**16-1)}"
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        # bytes, or (path, size) for file contents
+        self._parts: list = []
+        head = []
+        for name, value in (fields or {}).items():
+            head.append(
+                f"--{self.boundary}\r\n"
+                f"Content-Disposition: form-data; name=\"{name}\"\r\n\r\n"
+                f"{value}\r\n"
+            )
+        for name, (filename, source, ctype) in (files or {}).items():
+            head.append(
+                f"--{self.boundary}\r\n"
+                f"Content-Disposition: form-data; name=\"{name}\"; filename=\"{filename}\"\r\n"
+                f"Content-Type: {ctype}\r\n\r\n"
+            )
+            self._add("".join(head).encode("utf-8"))
+            head = []
+            if isinstance(source, (bytes, bytearray, memoryview)):
+                self._add(bytes(source))
+            else:
+                # Stat now so that Content-Length is known before sending
+                self._parts.append((source, os.path.getsize(source)))
+            head.append("\r\n")
+        head.append(f"--{self.boundary}--\r\n")
+        self._add("".join(head).encode("utf-8"))
+        self._length = sum(len(p) if isinstance(p, bytes) else p[1] for p in self._parts)
 
-    for name, (filename, content, ctype) in (files or {}).items():
-        add(f"--{boundary}")
-        add(
-            f"Content-Disposition: form-data; name=\"{name}\"; filename=\"{filename}\""
-        )
-        add(f"Content-Type: {ctype}")
-        add("")
-        # binary content
-        lines.append(content)
+    def _add(self, data: bytes):
+        # Merge adjacent small parts so they go out in one send()
+        if self._parts and isinstance(self._parts[-1], bytes):
+            self._parts[-1] += data
+        else:
+            self._parts.append(data)
 
-    add(f"--{boundary}--")
-    add("")
+    def __len__(self) -> int:
+        return self._length
 
-    body = b"\r\n".join(lines)
-    ctype_header = f"multipart/form-data; boundary={boundary}"
-    return ctype_header, body
+    def __iter__(self):
+        buf = None
+        for part in self._parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+            path, size = part
+            if buf is None:
+                buf = bytearray(_MULTIPART_CHUNK)
+            view = memoryview(buf)
+            remaining = size
+            with open(path, "rb") as fh:
+                while remaining > 0:
+                    n = fh.readinto(view[: min(remaining, len(buf))])
+                    if not n:
+                        raise RuntimeError(f"{path} shrank while it was being sent")
+                    remaining -= n
+                    # The buffer is reused: the caller sends each chunk before asking for the next
+                    yield view[:n]
 
 
 def http_post_multipart_json(host: str, path: str, fields: dict, files: dict):
-    ctype, body = build_multipart(fields, files)
-    conn = http.client.HTTPSConnection(host, timeout=60)
-    try:
-        conn.request(
-            "POST",
-            path,
-            body=body,
-            headers={
-                "Content-Type": ctype,
-                "Content-Length": str(len(body)),
-            },
-        )
-        resp = conn.getresponse()
-        data = resp.read()
-        if resp.status != 200:
-            raise RuntimeError(f"HTTP {resp.status}: {data[:200]!r}")
-        return json.loads(data.decode("utf-8"))
-    finally:
-        conn.close()
+    body = MultipartBody(fields, files)
+    status, data = _get_pool(host).request(
+        "POST",
+        path,
+        body=body,
+        headers={
+            "Content-Type": body.content_type,
+            "Content-Length": str(len(body)),
+        },
+    )
+    if status != 200:
+        raise RuntimeError(f"HTTP {status}: {data[:200]!r}")
+    return json.loads(data.decode("utf-8"))
 
 
 def send_document(token: str, chat_id: int, file_path: str, caption: Optional[str] = None):
+    """Upload a file as a document. The file is streamed from disk in chunks,
+    so memory use does not depend on its size."""
+    import mimetypes
+
     filename = os.path.basename(file_path)
     ctype, _ = mimetypes.guess_type(filename)
     if not ctype:
         ctype = "application/octet-stream"
-    with open(file_path, "rb") as f:
-        content = f.read()
 
     path = f"/bot{token}/sendDocument"
     fields = {"chat_id": str(chat_id)}
@@ -146,7 +709,7 @@ def send_document(token: str, chat_id: int, file_path: str, caption: Optional[st
         API_HOST,
         path,
         fields=fields,
-        files={"document": (filename, content, ctype)},
+        files={"document": (filename, file_path, ctype)},
     )
     if not res.get("ok"):
         raise RuntimeError(f"sendDocument failed: {res}")
@@ -159,12 +722,170 @@ def send_message(token: str, chat_id: int, text: str):
     if len(text) > 4096:
         text = text[:4093] + "..."
     path = f"/bot{token}/sendMessage"
-    res = http_get_json(API_HOST, path, {"chat_id": chat_id, "text": text})
+    try:
+        with METRICS.time("bot_telegram_send_seconds", kind="single"):
+            res = http_get_json(API_HOST, path, {"chat_id": chat_id, "text": text})
+    except Exception:
+        METRICS.inc("bot_telegram_messages_total", result="failed")
+        raise
+    METRICS.inc("bot_telegram_messages_total", result="ok" if res.get("ok") else "failed")
     if not res.get("ok"):
         raise RuntimeError(f"sendMessage failed: {res}")
     return res
 
 
+def edit_message_text(token: str, chat_id: int, message_id: int, text: str):
+    if len(text) > 4096:
+        text = text[:4093] + "..."
+    path = f"/bot{token}/editMessageText"
+    with METRICS.time("bot_telegram_send_seconds", kind="edit"):
+        res = http_get_json(API_HOST, path, {"chat_id": chat_id, "message_id": message_id, "text": text})
+    if not res.get("ok"):
+        raise RuntimeError(f"editMessageText failed: {res}")
+    return res
+
+
+# ----- Outgoing message batching and rate limits -----
+class TokenBucket:
+    """Token bucket: `rate` tokens per second, up to `burst` saved up.
+
+    reserve() never blocks; it takes the tokens (possibly going into debt)
+    and returns how many seconds the caller should wait before sending.
+    A rate <= 0 disables the limit.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.capacity = max(1.0, burst)
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def reserve(self, n: int = 1) -> float:
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= n
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def idle(self) -> bool:
+        """True if the bucket is full again, i.e. it can be forgotten."""
+        with self._lock:
+            self._refill(time.monotonic())
+            return self.tokens >= self.capacity
+
+
+class RateLimiter:
+    """Telegram's per-chat and global send limits as token buckets."""
+
+    def __init__(self, chat_rate: float = 1.0, chat_burst: float = 6, global_rate: float = 30.0):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "RateLimiter":
+        return cls(
+            chat_rate=_env_float("TELEGRAM_CHAT_RATE", 1.0),
+            chat_burst=_env_float("TELEGRAM_CHAT_BURST", 6),
+            global_rate=_env_float("TELEGRAM_GLOBAL_RATE", 30.0),
+        )
+
+    def reserve(self, chat_id, n: int = 1) -> float:
+        """Take n sends for chat_id; returns the delay before they may start."""
+        with self._lock:
+            bucket = self._chats.get(chat_id)
+            if bucket is None:
+                if len(self._chats) > 10000:
+                    self._chats = {k: b for k, b in self._chats.items() if not b.idle()}
+                bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return max(bucket.reserve(n), self.global_bucket.reserve(n))
+
+
+def coalesce_messages(texts: List[str], limit: int = 4096) -> List[str]:
+    """Join consecutive messages with a blank line while they fit in one Telegram message."""
+    out: List[str] = []
+    for t in texts:
+        if out and len(out[-1]) + 2 + len(t) <= limit:
+            out[-1] = f"{out[-1]}\n\n{t}"
+        else:
+            out.append(t)
+    return out
+
+
+def _prepare_batch(texts: List[str], coalesce: bool) -> List[str]:
+    # Empty texts would be rejected by Telegram; long ones are trimmed like send_message does
+    texts = [t if len(t) <= 4096 else t[:4093] + "..." for t in texts if t]
+    return coalesce_messages(texts) if coalesce else texts
+
+
+def _retry_after(status: int, data: bytes) -> Optional[float]:
+    """Seconds to wait if a Bot API response is a 429 (Too Many Requests)."""
+    if status != 429:
+        return None
+    try:
+        return float(json.loads(data.decode("utf-8")).get("parameters", {}).get("retry_after", 1))
+    except Exception:
+        return 1.0
+
+
+class MessageSender:
+    """Delivers a chat's multi-part reply as one batch.
+
+    The batch waits once for the rate limiter, then all sendMessage requests
+    are pipelined on a single pooled connection. Messages rejected with 429
+    are resent once after Telegram's retry_after. With coalesce=True,
+    consecutive parts are joined into as few messages as fit.
+    """
+
+    def __init__(self, token: str, limiter: RateLimiter, coalesce: bool = False, host: str = API_HOST):
+        self.token = token
+        self.limiter = limiter
+        self.coalesce = coalesce
+        self.host = host
+
+    def _request(self, chat_id, text: str) -> tuple:
+        body = json.dumps({"chat_id": chat_id, "text": text}).encode("utf-8")
+        return ("POST", f"/bot{self.token}/sendMessage", body, {"Content-Type": "application/json; charset=utf-8"})
+
+    def send_batch(self, chat_id, texts: List[str]) -> List[bool]:
+        """Send texts in order; returns per-message success for the messages actually sent."""
+        texts = _prepare_batch(texts, self.coalesce)
+        if not texts:
+            return []
+        wait = self.limiter.reserve(chat_id, len(texts))
+        if wait > 0:
+            time.sleep(wait)
+        pool = _get_pool(self.host)
+        with METRICS.time("bot_telegram_send_seconds", kind="batch"):
+            responses = pool.pipeline([self._request(chat_id, t) for t in texts])
+        ok = [status == 200 for status, _ in responses]
+        retry = [i for i, (status, data) in enumerate(responses) if _retry_after(status, data) is not None]
+        if retry:
+            METRICS.inc("bot_telegram_retry_after_total", len(retry))
+            time.sleep(max(_retry_after(*responses[i]) for i in retry))
+            with METRICS.time("bot_telegram_send_seconds", kind="batch"):
+                resent = pool.pipeline([self._request(chat_id, texts[i]) for i in retry])
+            for i, (status, _) in zip(retry, resent):
+                ok[i] = status == 200
+        _count_sent(ok)
+        return ok
+
+
+def _count_sent(ok: List[bool]):
+    sent = sum(ok)
+    METRICS.inc("bot_telegram_messages_total", sent, result="ok")
+    if sent < len(ok):
+        METRICS.inc("bot_telegram_messages_total", len(ok) - sent, result="failed")
+
+
 # ----- Input inspection helpers -----
 def _contains_danger(text: Optional[str]) -> bool:
     """Return True if the text contains an exclamation mark or a common
@@ -213,6 +934,34 @@ def _ends_with_double_q(text: Optional[str]) -> bool:
     return t.endswith("?") or t.endswith("？") or t.endswith("؟")
 
 
+# ----- Built-in DEFAULT_n XPaths -----
+# Used by the dot-trigger messages and the XPaths report.
+DEFAULTS_LIST_XPATHS = [
+    ("DEFAULT_1", "/html/body/div[1]/div[2]/span"),
+    ("DEFAULT_2", "/html/body/div[2]/div[2]/span"),
+    ("DEFAULT_3", "/html/body/div[4]/div[2]/span"),
+    ("DEFAULT_4", "/html/body/div[7]/p"),
+]
+# Used by the "?" follow-up message (note: starts at div[2], not div[1]).
+DEFAULTS_VALUES_XPATHS = [
+    ("DEFAULT_1", "/html/body/div[2]/div[2]/span"),
+    ("DEFAULT_2", "/html/body/div[3]/div[2]/span"),
+    ("DEFAULT_3", "/html/body/div[4]/div[2]/span"),
+    ("DEFAULT_4", "/html/body/div[7]/p"),
+]
+# XPath env vars, in first-match order (the last three are legacy names).
+XPATH_ENV_VARS = (
+    "EST_XPATH_MAIN",
+    "xGeneral",
+    "xMarriga",
+    "xOriginal",
+    "xTrade",
+    "EST_XPATH_FIRST",
+    "EST_XPATH_SECOND",
+    "EST_XPATH_THIRD",
+)
+
+
 def _build_xpaths_report(html_bytes: Optional[bytes]) -> str:
     """Build a report of XPaths and their extracted values.
 
@@ -224,6 +973,7 @@ def _build_xpaths_report(html_bytes: Optional[bytes]) -> str:
         return ""
 
     lines: List[str] = []
+    page = extract_page(html_bytes)
 
     def add_line(label: str, xpath_env_key: Optional[str] = None, xpath_literal: Optional[str] = None):
         xpath = None
@@ -232,12 +982,7 @@ def _build_xpaths_report(html_bytes: Optional[bytes]) -> str:
         elif xpath_env_key:
             xpath = os.getenv(xpath_env_key) or None
 
-        value = ""
-        try:
-            if xpath_env_key:
-                value = _extract_text_for_env_xpath(html_bytes, xpath_env_key) or ""
-        except Exception:
-            value = ""
+        value = page.env_value(xpath_env_key) if xpath_env_key else ""
 
         if xpath:
             lines.append(f"{label}: {xpath} -> {value}")
@@ -260,32 +1005,7 @@ def _build_xpaths_report(html_bytes: Optional[bytes]) -> str:
     add_line("EST_XPATH_THIRD", "EST_XPATH_THIRD")
 
     # Built-in defaults documented in extract_span_text_for_fixed_xpath
-    defaults = [
-        ("DEFAULT_1", "/html/body/div[1]/div[2]/span"),
-        ("DEFAULT_2", "/html/body/div[2]/div[2]/span"),
-        ("DEFAULT_3", "/html/body/div[4]/div[2]/span"),
-        ("DEFAULT_4", "/html/body/div[7]/p"),
-    ]
-    # For defaults, we can reuse the parser directly
-    try:
-        text = html_bytes.decode("utf-8", errors="ignore")
-    except Exception:
-        text = html_bytes.decode(errors="ignore")
-    parser = _SimpleHTMLTree()
-    parser.feed(text)
-    root = parser.root
-
-    def traverse(simple_xpath: str) -> str:
-        spec = _parse_simple_xpath(simple_xpath)
-        node = root
-        for tag, idx in spec:
-            node = _find_nth_child(node, tag, idx)
-            if not node:
-                return ""
-        return _collect_text(node)
-
-    for label, xp in defaults:
-        val = traverse(xp) or ""
+    for (label, val), (_, xp) in zip(page.defaults_list(), DEFAULTS_LIST_XPATHS):
         lines.append(f"{label}: {xp} -> {val}")
 
     report = "\n".join(lines).strip()
@@ -306,35 +1026,14 @@ def _build_defaults_values(html_bytes: Optional[bytes]) -> str:
     """
     if not html_bytes:
         return ""
-    # Prepare parser
-    try:
-        text = html_bytes.decode("utf-8", errors="ignore")
-    except Exception:
-        text = html_bytes.decode(errors="ignore")
-    parser = _SimpleHTMLTree()
-    parser.feed(text)
-    root = parser.root
-
-    defaults = [
-        ("DEFAULT_1", "/html/body/div[2]/div[2]/span"),
-        ("DEFAULT_2", "/html/body/div[3]/div[2]/span"),
-        ("DEFAULT_3", "/html/body/div[4]/div[2]/span"),
-        ("DEFAULT_4", "/html/body/div[7]/p"),
-    ]
-
-    def traverse(simple_xpath: str) -> str:
-        spec = _parse_simple_xpath(simple_xpath)
-        node = root
-        for tag, idx in spec:
-            node = _find_nth_child(node, tag, idx)
-            if not node:
-                return ""
-        return _collect_text(node)
+    return extract_page(html_bytes).defaults_values()
 
+
+def _format_defaults_values(values: List[str]) -> str:
+    """Join DEFAULT_n values into the single "?" follow-up message."""
     lines: List[str] = []
-    for label, xp in defaults:
-        val = traverse(xp) or ""
-        lines.append(f"{val}")
+    for val in values:
+        lines.append(f"{val or ''}")
 
     out = "\n".join(lines).strip()
     if len(out) > 4000:
@@ -349,35 +1048,7 @@ def _extract_defaults_list(html_bytes: Optional[bytes]) -> List[Tuple[str, str]]
     """
     if not html_bytes:
         return []
-    try:
-        text = html_bytes.decode("utf-8", errors="ignore")
-    except Exception:
-        text = html_bytes.decode(errors="ignore")
-    parser = _SimpleHTMLTree()
-    parser.feed(text)
-    root = parser.root
-
-    defaults = [
-        ("DEFAULT_1", "/html/body/div[1]/div[2]/span"),
-        ("DEFAULT_2", "/html/body/div[2]/div[2]/span"),
-        ("DEFAULT_3", "/html/body/div[4]/div[2]/span"),
-        ("DEFAULT_4", "/html/body/div[7]/p"),
-    ]
-
-    def traverse(simple_xpath: str) -> str:
-        spec = _parse_simple_xpath(simple_xpath)
-        node = root
-        for tag, idx in spec:
-            node = _find_nth_child(node, tag, idx)
-            if not node:
-                return ""
-        return _collect_text(node)
-
-    out: List[Tuple[str, str]] = []
-    for label, xp in defaults:
-        val = traverse(xp) or ""
-        out.append((label, val))
-    return out
+    return extract_page(html_bytes).defaults_list()
 
 
 def _count_trailing_dots(text: Optional[str]) -> int:
@@ -406,18 +1077,32 @@ def _count_trailing_dots(text: Optional[str]) -> int:
 
 
 # ----- Minimal HTML parser for fixed XPath extraction -----
+# Reference semantics for extract_paths (_PathExtractor); test_bot.py checks both agree.
+# Shared placeholder for nodes without children/text; replaced by a list on first add.
+# Most elements on a page are leaves or carry no text, so this saves two lists per node.
+_EMPTY: Tuple = ()
+
+
 class _Node:
+    __slots__ = ("tag", "children", "text_parts")
+
     def __init__(self, tag: Optional[str]):
         self.tag = tag
-        self.children: List[_Node] = []
-        self.text_parts: List[str] = []
+        self.children: List[_Node] = _EMPTY  # type: ignore[assignment]
+        self.text_parts: List[str] = _EMPTY  # type: ignore[assignment]
 
     def add_child(self, child: "_Node"):
-        self.children.append(child)
+        if self.children is _EMPTY:
+            self.children = [child]
+        else:
+            self.children.append(child)
 
     def add_text(self, text: str):
         if text:
-            self.text_parts.append(text)
+            if self.text_parts is _EMPTY:
+                self.text_parts = [text]
+            else:
+                self.text_parts.append(text)
 
 
 class _SimpleHTMLTree(HTMLParser):
@@ -427,7 +1112,8 @@ class _SimpleHTMLTree(HTMLParser):
         self._stack = [self.root]
 
     def handle_starttag(self, tag, attrs):
-        node = _Node(tag.lower())
+        # Interned so every node of the same tag shares one string
+        node = _Node(sys.intern(tag.lower()))
         self._stack[-1].add_child(node)
         self._stack.append(node)
 
@@ -464,6 +1150,133 @@ def _collect_text(node: _Node) -> str:
     return "".join(parts).strip()
 
 
+# ----- Streaming path-targeted extraction -----
+class _StopParsing(Exception):
+    pass
+
+
+class _PathTrie:
+    """Wanted XPath specs merged into a trie of (tag, index) steps."""
+
+    __slots__ = ("children", "targets", "specs")
+
+    def __init__(self):
+        self.children = {}  # (tag, index) -> _PathTrie
+        self.targets: List[int] = []  # specs that end at this step
+        self.specs: List[int] = []  # specs that pass through or end at this step
+
+
+class _Frame:
+    __slots__ = ("tag", "trie", "counts", "collect", "parts", "child_texts")
+
+    def __init__(self, tag: Optional[str], trie: Optional[_PathTrie], collect: bool):
+        self.tag = tag
+        self.trie = trie
+        # Per-tag child counters, only needed where the trie continues below
+        self.counts = {} if trie is not None and trie.children else None
+        self.collect = collect
+        self.parts: List[str] = [] if collect else _EMPTY  # type: ignore[assignment]
+        self.child_texts: List[str] = [] if collect else _EMPTY  # type: ignore[assignment]
+
+
+class _PathExtractor(HTMLParser):
+    """SAX-style extractor for a fixed set of simple XPath specs.
+
+    Produces exactly what _SimpleHTMLTree + _find_nth_child + _collect_text
+    would, but keeps only the stack of open elements: sibling counters are
+    tracked only along wanted paths, and text is kept only inside matched
+    subtrees. Once every spec has its final value (its element, or an
+    ancestor on its path, has been closed) parsing stops via _StopParsing.
+    """
+
+    def __init__(self, specs):
+        super().__init__(convert_charrefs=True)
+        self.results = [""] * len(specs)
+        root = _PathTrie()
+        for i, spec in enumerate(specs):
+            node = root
+            node.specs.append(i)
+            for tag, idx in spec:
+                node = node.children.setdefault((tag.lower(), idx), _PathTrie())
+                node.specs.append(i)
+            node.targets.append(i)
+        self._unresolved = set(range(len(specs)))
+        self._stack = [_Frame(None, root, False)]
+        if not self._unresolved:
+            raise _StopParsing()
+
+    def handle_starttag(self, tag, attrs):
+        t = tag.lower()
+        parent = self._stack[-1]
+        trie = None
+        if parent.counts is not None:
+            n = parent.counts.get(t, 0) + 1
+            parent.counts[t] = n
+            trie = parent.trie.children.get((t, n))
+        self._stack.append(_Frame(t, trie, parent.collect or (trie is not None and bool(trie.targets))))
+
+    def handle_endtag(self, tag):
+        # Pop until matching tag or root, like _SimpleHTMLTree
+        t = tag.lower()
+        stack = self._stack
+        for i in range(len(stack) - 1, 0, -1):
+            if stack[i].tag == t:
+                while len(stack) > i:
+                    self._close(stack.pop())
+                break
+
+    def handle_data(self, data):
+        top = self._stack[-1]
+        if top.collect and data:
+            top.parts.append(data)
+
+    def _close(self, frame: _Frame):
+        if frame.collect:
+            # Same order as _collect_text: own text first, then each child's text
+            text = "".join(frame.parts + frame.child_texts).strip()
+            parent = self._stack[-1]
+            if parent.collect:
+                parent.child_texts.append(text)
+            if frame.trie is not None:
+                for i in frame.trie.targets:
+                    self.results[i] = text
+        if frame.trie is not None:
+            # Its subtree is final: specs through here are either found or cannot match
+            self._unresolved.difference_update(frame.trie.specs)
+            if not self._unresolved:
+                raise _StopParsing()
+
+    def finish(self):
+        """Close elements still open at the end of the input (without flushing
+        buffered text, as _SimpleHTMLTree is never close()d either)."""
+        while len(self._stack) > 1:
+            self._close(self._stack.pop())
+
+
+_EXTRACT_CHUNK = 64 * 1024
+
+
+def extract_paths(html_bytes: bytes, specs) -> List[str]:
+    """Return the text of every (tag, index) spec, in order ("" where missing).
+
+    The HTML is decoded and parsed incrementally and parsing stops as soon
+    as all specs are resolved, so usually only a prefix of the page is read.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+    try:
+        parser = _PathExtractor(specs)
+    except _StopParsing:
+        return []
+    try:
+        for start in range(0, len(html_bytes), _EXTRACT_CHUNK):
+            parser.feed(decoder.decode(html_bytes[start:start + _EXTRACT_CHUNK]))
+        parser.feed(decoder.decode(b"", final=True))
+        parser.finish()
+    except _StopParsing:
+        pass
+    return parser.results
+
+
 def extract_span_text_for_fixed_xpath(html_bytes: bytes) -> str:
     """Extract text from a set of XPaths in the HTML bytes.
 
@@ -479,33 +1292,7 @@ def extract_span_text_for_fixed_xpath(html_bytes: bytes) -> str:
 
     If none match or segments are missing, returns empty string.
     """
-    try:
-        text = html_bytes.decode("utf-8", errors="ignore")
-    except Exception:
-        text = html_bytes.decode(errors="ignore")
-
-    parser = _SimpleHTMLTree()
-    parser.feed(text)
-    root = parser.root
-
-    def _traverse_path(path_spec):
-        node = root
-        for tag, idx in path_spec:
-            node = _find_nth_child(node, tag, idx)
-            if not node:
-                return None
-        return node
-
-    # Get configured XPaths or fallback defaults (as (tag, index) sequences)
-    xpaths = _configured_xpath_specs()
-
-    for spec in xpaths:
-        node = _traverse_path(spec)
-        if node:
-            txt = _collect_text(node)
-            if txt:
-                return txt
-    return ""
+    return extract_page(html_bytes).xpath_value
 
 
 # Helper: extract text for a specific XPath provided via an env var name (e.g., "xGeneral")
@@ -514,25 +1301,12 @@ def _extract_text_for_env_xpath(html_bytes: bytes, env_var_name: str) -> str:
 
     If the env var is undefined or invalid, returns empty string.
     """
-    xpath = os.getenv(env_var_name, "")
-    spec = _parse_simple_xpath(xpath) if xpath else None
+    if env_var_name in XPATH_ENV_VARS:
+        return extract_page(html_bytes).env_value(env_var_name)
+    spec = _parse_simple_xpath(os.getenv(env_var_name, ""))
     if not spec:
         return ""
-    try:
-        text = html_bytes.decode("utf-8", errors="ignore")
-    except Exception:
-        text = html_bytes.decode(errors="ignore")
-
-    parser = _SimpleHTMLTree()
-    parser.feed(text)
-    root = parser.root
-
-    node = root
-    for tag, idx in spec:
-        node = _find_nth_child(node, tag, idx)
-        if not node:
-            return ""
-    return _collect_text(node)
+    return extract_paths(html_bytes, [spec])[0]
 
 
 # ----- Simple XPath configuration (via env) -----
@@ -579,104 +1353,512 @@ def _parse_simple_xpath(xpath: str) -> Optional[List[Tuple[str, int]]]:
     return spec
 
 
-def _configured_xpath_specs() -> List[List[Tuple[str, int]]]:
-    """Build the ordered list of XPath specs from environment variables.
-
-    Environment variables (first to last):
-      - EST_XPATH_MAIN
-      - xGeneral
-      - xMarriga
-      - xOriginal
-      - xTrade
-      - (legacy fallbacks)
-        • EST_XPATH_FIRST
-        • EST_XPATH_SECOND
-        • EST_XPATH_THIRD
-
-    Invalid entries are ignored. If none present, fall back to built-in defaults.
-    Duplicate specs are removed while preserving order.
-    """
-    env_vars = [
-        "EST_XPATH_MAIN",
-        # new names
-        "xGeneral",
-        "xMarriga",
-        "xOriginal",
-        "xTrade",
-        # legacy names for backward compatibility
-        "EST_XPATH_FIRST",
-        "EST_XPATH_SECOND",
-        "EST_XPATH_THIRD",
-    ]
-    specs: List[List[Tuple[str, int]]] = []
-    seen = set()
-    for name in env_vars:
-        val = os.getenv(name)
-        if not val:
-            continue
-        spec = _parse_simple_xpath(val)
-        if not spec:
-            continue
-        key = tuple(spec)
-        if key in seen:
-            continue
-        seen.add(key)
-        specs.append(spec)
+# ----- Compiled XPath configuration -----
+DEFAULT_FIRST_MATCH_SPECS = (
+    (("html", 1), ("body", 1), ("div", 1), ("div", 2), ("span", 1)),
+    (("html", 1), ("body", 1), ("div", 2), ("div", 2), ("span", 1)),
+    (("html", 1), ("body", 1), ("div", 4), ("div", 2), ("span", 1)),
+    (("html", 1), ("body", 1), ("div", 7), ("p", 1)),
+)
 
-    if specs:
-        return specs
-    # default fixed XPaths
-    return [
-        [("html", 1), ("body", 1), ("div", 1), ("div", 2), ("span", 1)],
-        [("html", 1), ("body", 1), ("div", 2), ("div", 2), ("span", 1)],
-        [("html", 1), ("body", 1), ("div", 4), ("div", 2), ("span", 1)],
-        [("html", 1), ("body", 1), ("div", 7), ("p", 1)],
-    ]
 
+def _read_env_file(path: str) -> dict:
+    """Parse KEY=VALUE lines (api.env style); blank lines and # comments are skipped."""
+    values = {}
+    with open(path, "r", encoding="utf-8") as fh:
+        for line in fh:
+            line = line.strip()
+            if not line or line.startswith("#") or "=" not in line:
+                continue
+            key, val = line.split("=", 1)
+            val = val.strip()
+            if len(val) >= 2 and val[0] == val[-1] and val[0] in "\"'":
+                val = val[1:-1]
+            values[key.strip()] = val
+    return values
 
-def get_updates(token: str, offset):
-    path = f"/bot{token}/getUpdates"
+
+class XPathConfig:
+    """The XPath configuration, parsed once into read-only tuples.
+
+    - named: env var name -> spec, for every XPath env var that is set and valid
+    - first_match: de-duplicated specs tried in order by the xpath_value lookup
+      (the built-in defaults if no env var is set)
+    - columns: every distinct spec any reply path needs; this is the column
+      layout of a CorpusIndex, and the *_cols attributes map each lookup
+      (first_match_cols, env_cols, defaults_list_cols, defaults_values_cols)
+      onto it.
+
+    Instances are never modified; a reload builds a new one and swaps it in.
+    """
+
+    __slots__ = (
+        "named", "first_match", "columns",
+        "first_match_cols", "env_cols", "defaults_list_cols", "defaults_values_cols",
+    )
+
+    def __init__(self, values: dict):
+        named = {}
+        for name in XPATH_ENV_VARS:
+            spec = _parse_simple_xpath(values.get(name) or "")
+            if spec:
+                named[name] = tuple(spec)
+        first_match = tuple(dict.fromkeys(named[n] for n in XPATH_ENV_VARS if n in named))
+
+        columns: List[Tuple[Tuple[str, int], ...]] = []
+        col_of = {}
+
+        def column(spec) -> int:
+            key = tuple(spec)
+            if key not in col_of:
+                col_of[key] = len(columns)
+                columns.append(key)
+            return col_of[key]
+
+        self.named = named
+        self.first_match = first_match or DEFAULT_FIRST_MATCH_SPECS
+        self.first_match_cols = tuple(column(spec) for spec in self.first_match)
+        self.env_cols = {name: column(spec) for name, spec in named.items()}
+        self.defaults_list_cols = tuple(column(_parse_simple_xpath(xp)) for _, xp in DEFAULTS_LIST_XPATHS)
+        self.defaults_values_cols = tuple(column(_parse_simple_xpath(xp)) for _, xp in DEFAULTS_VALUES_XPATHS)
+        self.columns = tuple(columns)
+
+    @classmethod
+    def from_env(cls, path: Optional[str] = None) -> "XPathConfig":
+        return cls(xpath_settings(path))
+
+
+# Re-read on SIGHUP when BOT_CONFIG_FILE is not set
+DEFAULT_CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "api.env")
+
+
+def config_file_path() -> str:
+    """The file SIGHUP reloads from: BOT_CONFIG_FILE, else api.env next to bot.py."""
+    return os.getenv("BOT_CONFIG_FILE", "") or DEFAULT_CONFIG_FILE
+
+
+def xpath_settings(path: Optional[str] = None) -> dict:
+    """Raw XPath env var values, overridden by the config file at path
+    (default: BOT_CONFIG_FILE, if it is set)."""
+    values = {name: os.getenv(name, "") for name in XPATH_ENV_VARS}
+    if path is None:
+        path = os.getenv("BOT_CONFIG_FILE", "")
+    if path:
+        try:
+            file_values = _read_env_file(path)
+        except OSError as e:
+            print(f"Config file unreadable ({path}): {e}", file=sys.stderr)
+        else:
+            values.update((k, v) for k, v in file_values.items() if k in XPATH_ENV_VARS)
+    return values
+
+
+_XPATH_CONFIG: Optional[XPathConfig] = None
+
+
+def xpath_config() -> XPathConfig:
+    """The current XPathConfig, compiled on first use."""
+    global _XPATH_CONFIG
+    config = _XPATH_CONFIG
+    if config is None:
+        config = _XPATH_CONFIG = XPathConfig.from_env()
+    return config
+
+
+def reload_xpath_config(path: Optional[str] = None) -> XPathConfig:
+    """Re-read the XPath configuration (see xpath_settings) and make it current
+    (a single reference swap)."""
+    global _XPATH_CONFIG
+    config = _XPATH_CONFIG = XPathConfig.from_env(path)
+    return config
+
+
+# ----- Preparsed corpus index -----
+def _extract_columns(html_bytes: bytes, columns) -> Tuple[str, ...]:
+    """Parse the HTML once and return the text for every spec in columns."""
+    return tuple(extract_paths(html_bytes, columns))
+
+
+class PageValues:
+    """Every XPath value of one page, from a single parse.
+
+    Returned by extract_page() and by CorpusIndex lookups. It keeps the
+    XPathConfig it was built with, so a reload in the middle of a reply does
+    not mix values from two configurations.
+    """
+
+    __slots__ = ("config", "values", "path")
+
+    def __init__(self, config: XPathConfig, values: Tuple[str, ...], path: str = ""):
+        self.config = config
+        self.values = values
+        self.path = path
+
+    @property
+    def xpath_value(self) -> str:
+        """First non-empty value of the configured XPaths (see extract_span_text_for_fixed_xpath)."""
+        values = self.values
+        for col in self.config.first_match_cols:
+            if values[col]:
+                return values[col]
+        return ""
+
+    def env_value(self, env_var_name: str) -> str:
+        """Value of a named env XPath (see _extract_text_for_env_xpath)."""
+        col = self.config.env_cols.get(env_var_name)
+        if col is None:
+            return ""
+        return self.values[col]
+
+    def env_values(self) -> dict:
+        """Values of all configured env XPaths, by env var name."""
+        return {name: self.values[col] for name, col in self.config.env_cols.items()}
+
+    def defaults_values(self) -> str:
+        """Same output as _build_defaults_values()."""
+        values = self.values
+        return _format_defaults_values([values[c] for c in self.config.defaults_values_cols])
+
+    def defaults_list(self) -> List[Tuple[str, str]]:
+        """Same output as _extract_defaults_list()."""
+        values = self.values
+        return [
+            (label, values[c])
+            for (label, _), c in zip(DEFAULTS_LIST_XPATHS, self.config.defaults_list_cols)
+        ]
+
+
+def extract_page(html_bytes: bytes, config: Optional[XPathConfig] = None) -> PageValues:
+    """Parse the HTML once and return the values of every configured XPath.
+
+    The legacy single-value helpers (extract_span_text_for_fixed_xpath,
+    _build_defaults_values, ...) are thin wrappers around this.
+    """
+    config = config or xpath_config()
+    return PageValues(config, _extract_columns(html_bytes, config.columns))
+
+
+class CorpusIndex:
+    """In-memory table of pre-extracted XPath values for every HTML page.
+
+    Every XPath any reply path can ask for is a column (the layout comes from
+    an XPathConfig); each page is one tuple of column values, stored in `rows`
+    parallel to `paths` (a compact PathTable). Pages are read and parsed once
+    when added, so serving a message is a plain table lookup.
+
+    Pages can be updated or removed in place (see CorpusWatcher): replacing a
+    row is a single assignment, so a reader always gets either the old or the
+    new values of a page. Removed rows are left as None until compacted().
+    """
+
+    def __init__(self, config: Optional[XPathConfig] = None):
+        self.config = config or xpath_config()
+        self.columns = self.config.columns
+
+        self.paths = PathTable()
+        self.rows: List[Optional[Tuple[str, ...]]] = []
+        # mtime_ns and size of each page when it was read (0 if unknown, e.g. CSV rows)
+        self.mtimes = array("q")
+        self.sizes = array("q")
+        self.removed = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.paths) - self.removed
+
+    def extract_file(self, path: str) -> Tuple[str, ...]:
+        try:
+            t0 = time.monotonic()
+            with open(path, "rb") as fh:
+                data = fh.read()
+            t1 = time.monotonic()
+            values = _extract_columns(data, self.columns)
+            METRICS.observe("bot_page_read_seconds", t1 - t0)
+            METRICS.observe("bot_page_parse_seconds", time.monotonic() - t1)
+        except Exception:
+            # Unreadable pages still take part in the random pick, with empty values
+            values = ("",) * len(self.columns)
+        return values
+
+    def add_file(self, path: str, stamp: Tuple[int, int] = (0, 0)) -> Tuple[str, ...]:
+        values = self.extract_file(path)
+        self.add_values(path, values, stamp)
+        return values
+
+    def add_values(self, path: str, values: Tuple[str, ...], stamp: Tuple[int, int] = (0, 0)):
+        with self._lock:
+            row = self.paths.find(path)
+            if row is None:
+                # paths is appended last: random_page() and pages() pick rows by len(paths),
+                # so a reader never sees a row whose values are not there yet
+                self.rows.append(values)
+                self.mtimes.append(stamp[0])
+                self.sizes.append(stamp[1])
+                self.paths.append(path)
+                return
+            if self.rows[row] is None:
+                self.removed -= 1
+            self.rows[row] = values
+            self.mtimes[row], self.sizes[row] = stamp
+
+    def remove(self, path: str) -> bool:
+        """Drop a page from the random pick; False if it was not in the index."""
+        with self._lock:
+            row = self.paths.find(path)
+            if row is None or self.rows[row] is None:
+                return False
+            self.rows[row] = None
+            self.removed += 1
+            return True
+
+    def stamp(self, row: int) -> Tuple[int, int]:
+        return self.mtimes[row], self.sizes[row]
+
+    def _values(self, row: int) -> PageValues:
+        return PageValues(self.config, self.rows[row], self.paths[row])
+
+    def pages(self):
+        """PageValues of every page in the index, in row order."""
+        for row in range(len(self.paths)):
+            values = self.rows[row]
+            if values is not None:
+                yield PageValues(self.config, values, self.paths[row])
+
+    def page(self, path: str) -> Optional[PageValues]:
+        row = self.paths.find(path)
+        if row is None or self.rows[row] is None:
+            return None
+        return self._values(row)
+
+    def random_page(self) -> PageValues:
+        if not len(self):
+            raise ValueError("the corpus index is empty")
+        while True:
+            # Removed rows are skipped; compaction keeps them to at most half the table
+            row = self.paths.random_index()
+            values = self.rows[row]
+            if values is not None:
+                return PageValues(self.config, values, self.paths[row])
+
+    def compacted(self) -> "CorpusIndex":
+        """A copy without removed rows."""
+        index = CorpusIndex(self.config)
+        for row in range(len(self.paths)):
+            values = self.rows[row]
+            if values is not None:
+                index.add_values(self.paths[row], values, self.stamp(row))
+        return index
+
+
+# ----- Persistent index cache -----
+INDEX_CACHE_NAME = ".estindex.sqlite3"
+
+
+def scan_html_files(root_path: str) -> List[Tuple[str, int, int]]:
+    """Every .html/.htm file under root_path, as (path, mtime_ns, size)."""
+    exts = {".html", ".htm"}
+    files = []
+    stack = [root_path]
+    while stack:
+        base = stack.pop()
+        try:
+            entries = list(os.scandir(base))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    stack.append(entry.path)
+                elif os.path.splitext(entry.name)[1].lower() in exts:
+                    st = entry.stat()
+                    files.append((entry.path, st.st_mtime_ns, st.st_size))
+            except OSError:
+                continue
+    return files
+
+
+def index_cache_path(html_dir: str) -> Optional[str]:
+    """Location of the on-disk index cache (EST_INDEX_CACHE), or None if disabled."""
+    val = os.getenv("EST_INDEX_CACHE", "")
+    if val.strip().lower() in ("0", "off", "false", "no"):
+        return None
+    return val or os.path.join(html_dir, INDEX_CACHE_NAME)
+
+
+def load_corpus_index(
+    scanned: List[Tuple[str, int, int]],
+    cache_path: Optional[str],
+    config: Optional[XPathConfig] = None,
+):
+    """Build a CorpusIndex, reusing cached values for files whose mtime/size are unchanged.
+
+    The cache is a SQLite file holding (path, mtime_ns, size, values) per page.
+    It is tied to the set of index columns; if the configured XPaths change, every
+    page is rebuilt. Returns (index, reused_count, rebuilt_count).
+    """
+    index = CorpusIndex(config)
+    if not cache_path:
+        for path, mtime_ns, size in scanned:
+            index.add_file(path, (mtime_ns, size))
+        METRICS.inc("bot_index_pages_total", len(scanned), source="parsed")
+        return index, 0, len(scanned)
+
+    import sqlite3
+
+    signature = json.dumps(index.columns)
+    db = sqlite3.connect(cache_path)
+    try:
+        db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, vals TEXT)"
+        )
+        row = db.execute("SELECT value FROM meta WHERE key = 'columns'").fetchone()
+        cached = {}
+        if row and row[0] == signature:
+            for path, mtime_ns, size, vals in db.execute("SELECT path, mtime_ns, size, vals FROM pages"):
+                cached[path] = (mtime_ns, size, vals)
+
+        reused = 0
+        changed = []
+        for path, mtime_ns, size in scanned:
+            hit = cached.pop(path, None)
+            if hit is not None and hit[0] == mtime_ns and hit[1] == size:
+                index.add_values(path, tuple(json.loads(hit[2])), (mtime_ns, size))
+                reused += 1
+            else:
+                values = index.add_file(path, (mtime_ns, size))
+                changed.append((path, mtime_ns, size, json.dumps(values, ensure_ascii=False)))
+
+        with db:
+            if not row or row[0] != signature:
+                db.execute("DELETE FROM pages")
+                db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('columns', ?)", (signature,))
+            db.executemany("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)", changed)
+            # Whatever is left in `cached` no longer exists on disk
+            db.executemany("DELETE FROM pages WHERE path = ?", [(p,) for p in cached])
+        METRICS.inc("bot_index_pages_total", reused, source="cache")
+        METRICS.inc("bot_index_pages_total", len(changed), source="parsed")
+        return index, reused, len(changed)
+    finally:
+        db.close()
+
+
+def update_index_cache(
+    cache_path: str,
+    columns,
+    changed: List[Tuple[str, int, int, Tuple[str, ...]]],
+    removed: List[str],
+):
+    """Write single-page changes through to the cache built by load_corpus_index.
+
+    changed holds (path, mtime_ns, size, values). Nothing is written if the
+    cache belongs to other columns; the next full load rebuilds it anyway.
+    """
+    import sqlite3
+
+    db = sqlite3.connect(cache_path)
+    try:
+        row = db.execute("SELECT value FROM meta WHERE key = 'columns'").fetchone()
+        if not row or row[0] != json.dumps(columns):
+            return
+        with db:
+            db.executemany(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)",
+                [(p, m, n, json.dumps(v, ensure_ascii=False)) for p, m, n, v in changed],
+            )
+            db.executemany("DELETE FROM pages WHERE path = ?", [(p,) for p in removed])
+    finally:
+        db.close()
+
+
+# ----- CSV data source -----
+# Column layout of the estekhareh plugin's source.csv (see extract_corpus.py)
+CSV_DEFAULT_COLUMNS = tuple(zip(("xp1m", "xp2", "xp3", "xp4"), (xp for _, xp in DEFAULTS_LIST_XPATHS)))
+
+
+def csv_column_map() -> List[Tuple[str, str]]:
+    """EST_CSV_COLUMNS as (csv column, XPath) pairs; defaults to CSV_DEFAULT_COLUMNS.
+
+    Format: xp1m=/html/body/div[1]/div[2]/span,xp2=/html/body/div[2]/div[2]/span,...
+    """
+    raw = os.getenv("EST_CSV_COLUMNS", "")
+    if not raw.strip():
+        return list(CSV_DEFAULT_COLUMNS)
+    pairs = []
+    for item in raw.split(","):
+        name, sep, xpath = item.partition("=")
+        if sep and name.strip() and _parse_simple_xpath(xpath):
+            pairs.append((name.strip(), xpath.strip()))
+        else:
+            print(f"Ignoring invalid EST_CSV_COLUMNS entry: {item!r}", file=sys.stderr)
+    return pairs
+
+
+def load_csv_index(
+    csv_path: str,
+    column_map: List[Tuple[str, str]],
+    config: Optional[XPathConfig] = None,
+) -> CorpusIndex:
+    """Build a CorpusIndex from a table of pre-extracted values instead of HTML.
+
+    The first CSV column names the page; every other mapped column fills the
+    index column of its XPath. Index columns without a CSV column stay empty.
+    """
+    import csv
+
+    index = CorpusIndex(config)
+    col_of = {spec: i for i, spec in enumerate(index.columns)}
+    width = len(index.columns)
+    with open(csv_path, "r", encoding="utf-8-sig", newline="") as fh:
+        reader = csv.reader(fh)
+        header = next(reader, [])
+        pos = {name: i for i, name in enumerate(header)}
+        # (CSV position, index column) for every mapped column the index uses
+        plan = []
+        for name, xpath in column_map:
+            if name not in pos:
+                print(f"CSV column not found in {csv_path}: {name}", file=sys.stderr)
+                continue
+            col = col_of.get(tuple(_parse_simple_xpath(xpath)))
+            if col is not None:
+                plan.append((pos[name], col))
+        for row in reader:
+            if not row or not row[0]:
+                continue
+            values = [""] * width
+            for p, c in plan:
+                if p < len(row):
+                    values[c] = row[p]
+            index.add_values(row[0], tuple(values))
+    METRICS.inc("bot_index_pages_total", len(index), source="csv")
+    return index
+
+
+def get_updates(token: str, offset):
+    path = f"/bot{token}/getUpdates"
     params = {"timeout": POLL_TIMEOUT_SEC}
     if offset is not None:
         params["offset"] = offset
-    res = http_get_json(API_HOST, path, params)
+    with METRICS.time("bot_get_updates_seconds"):
+        res = http_get_json(API_HOST, path, params, pool="poll")
     if not res.get("ok"):
         raise RuntimeError(f"getUpdates failed: {res}")
     return res["result"]
 
 
-def gemini_generate(
-    api_key: str,
-    model: str,
+def _format_prompt(
     user_text: str,
     xpath_value: str,
     prompt_template: Optional[str] = None,
     extra_vars: Optional[dict] = None,
 ) -> str:
-    """Generate text using Google's official genai SDK.
-
-    This follows the template recommended by Google:
-        from google import genai
-        client = genai.Client()
-        response = client.models.generate_content(
-            model="gemini-2.5-flash", contents="..."
-        )
-        print(response.text)
+    """Compose the contents string sent to Gemini using a configurable template.
 
-    We pass the API key explicitly to avoid relying on the ambient environment,
-    but the SDK also supports pulling it from GEMINI_API_KEY automatically.
+    Supported placeholders:
+      {user_text}, {xpath_value}, {chat_username}, {chat_first_name}, {chat_last_name}, {chat_title}
+    Unknown/missing placeholders resolve to empty string.
     """
-    try:
-        from google import genai  # type: ignore
-    except Exception as e:
-        raise RuntimeError(
-            "google-genai package is not installed. Install it with: pip install google-genai"
-        ) from e
-
-    # Compose the contents string using a configurable template
-    # Supported placeholders:
-    #   {user_text}, {xpath_value}, {chat_username}, {chat_first_name}, {chat_last_name}, {chat_title}
-    # Unknown/missing placeholders resolve to empty string.
     default_template = (
         "User message: {user_text}\n"
         "Extracted HTML value: {xpath_value}"
@@ -695,42 +1877,172 @@ def gemini_generate(
 
     tpl = prompt_template or os.getenv("PROMPT_TEMPLATE") or os.getenv("EST_PROMPT_TEMPLATE") or default_template
     try:
-        contents = tpl.format_map(_SafeDict(vars_all))
+        return tpl.format_map(_SafeDict(vars_all))
     except Exception:
         # Fallback to default if the provided template has format errors
-        contents = default_template.format_map(_SafeDict(vars_all))
+        return default_template.format_map(_SafeDict(vars_all))
+
 
-    # Instantiate client. If api_key is empty, the SDK will try GEMINI_API_KEY from env.
-    client = genai.Client(api_key=api_key) if api_key else genai.Client()
+# Retried once with Google's current safe default model from the template.
+GEMINI_FALLBACK_MODEL = "gemini-2.5-flash"
 
-    # Call the model using the official method API
+
+def _is_model_not_found(e: Exception) -> bool:
+    """True if the error says the configured model is invalid or unsupported."""
+    emsg = str(e)
+    not_found_hints = (
+        "NOT_FOUND",
+        "is not found",
+        "supported for generateContent",
+    )
+    return any(h in emsg for h in not_found_hints)
+
+
+def _import_genai():
     try:
-        response = client.models.generate_content(model=model, contents=contents)
+        from google import genai  # type: ignore
     except Exception as e:
-        # Provide a graceful fallback if the configured model is invalid or unsupported
-        emsg = str(e)
-        not_found_hints = (
-            "NOT_FOUND",
-            "is not found",
-            "supported for generateContent",
-        )
-        if any(h in emsg for h in not_found_hints):
-            # Retry once with Google's current safe default model from the template.
-            fallback_model = "gemini-2.5-flash"
-            if model != fallback_model:
-                try:
-                    response = client.models.generate_content(
-                        model=fallback_model, contents=contents
+        raise RuntimeError(
+            "google-genai package is not installed. Install it with: pip install google-genai"
+        ) from e
+    return genai
+
+
+class ModelResolver:
+    """Remembers which model to call for a configured GEMINI_MODEL.
+
+    When a model turns out not to exist (NOT_FOUND), calls for it go straight
+    to GEMINI_FALLBACK_MODEL for `ttl` seconds instead of failing first every
+    time; after that the configured model is tried again.
+    """
+
+    def __init__(self, ttl: float = 3600.0):
+        self.ttl = ttl
+        self._bad = {}  # model -> time.monotonic() until which it is skipped
+        self._lock = threading.Lock()
+
+    def resolve(self, model: str) -> str:
+        with self._lock:
+            until = self._bad.get(model)
+            if until is None:
+                return model
+            if time.monotonic() < until:
+                return GEMINI_FALLBACK_MODEL
+            del self._bad[model]
+            return model
+
+    def mark_bad(self, model: str):
+        if model == GEMINI_FALLBACK_MODEL:
+            return
+        with self._lock:
+            if model not in self._bad:
+                print(
+                    f"Gemini model {model!r} not found; using {GEMINI_FALLBACK_MODEL} for the next {self.ttl:g}s",
+                    file=sys.stderr,
+                )
+            self._bad[model] = time.monotonic() + self.ttl
+
+
+MODEL_RESOLVER = ModelResolver(_env_float("GEMINI_MODEL_TTL", 3600.0))
+
+
+class CircuitBreaker:
+    """Stops calling Gemini while it keeps failing.
+
+    After `threshold` consecutive failures the circuit opens: allow() returns
+    False, and handlers reply with the fallback text right away. After
+    `cooldown` seconds it goes half-open and lets a single probe call through;
+    a success closes the circuit, a failure opens it for another cooldown.
+    threshold <= 0 disables the breaker.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 0, 1, 2
+
+    def __init__(self, threshold: int = 5, cooldown: float = 30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "CircuitBreaker":
+        return cls(_env_int("GEMINI_BREAKER_FAILURES", 5), _env_float("GEMINI_BREAKER_COOLDOWN_SEC", 30.0))
+
+    def allow(self) -> bool:
+        if self.threshold <= 0:
+            return True
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            # Open, or half-open with a probe whose result never came back
+            if time.monotonic() - self._opened_at < self.cooldown:
+                return False
+            self.state = self.HALF_OPEN
+            self._opened_at = time.monotonic()  # one probe per cooldown
+            return True
+
+    def success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                print("Gemini is answering again; circuit closed", file=sys.stderr)
+            self.state = self.CLOSED
+            self._failures = 0
+
+    def failure(self):
+        if self.threshold <= 0:
+            return
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.threshold:
+                if self.state != self.OPEN:
+                    print(
+                        f"Gemini failing ({self._failures} errors in a row); "
+                        f"replying without AI for {self.cooldown:g}s",
+                        file=sys.stderr,
                     )
-                except Exception:
-                    # Re-raise original error if fallback also fails
-                    raise
-            else:
-                # Already the fallback model, re-raise
-                raise
-        else:
-            # Unknown error, re-raise
-            raise
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+_GENAI_CLIENTS = {}
+_GENAI_LOCK = threading.Lock()
+
+
+def get_gemini_client(api_key: str):
+    """Shared genai.Client for api_key, created on first use and reused by every request.
+
+    The client keeps its own HTTP connection pool, so one instance serves all
+    threads (and the asyncio runtime via client.aio).
+    """
+    with _GENAI_LOCK:
+        client = _GENAI_CLIENTS.get(api_key)
+        if client is None:
+            genai = _import_genai()
+            # If api_key is empty, the SDK will try GEMINI_API_KEY from env.
+            client = genai.Client(api_key=api_key) if api_key else genai.Client()
+            _GENAI_CLIENTS[api_key] = client
+        return client
+
+
+def gemini_health_check(api_key: str, model: str) -> Tuple[bool, str]:
+    """Look up `model` with the shared client; returns (ok, detail).
+
+    This is a metadata call, so it opens the connection (warm-up) and checks
+    the key and model without spending generation quota.
+    """
+    t0 = time.monotonic()
+    try:
+        get_gemini_client(api_key).models.get(model=model)
+    except Exception as e:
+        if _is_model_not_found(e):
+            MODEL_RESOLVER.mark_bad(model)
+        return False, str(e)
+    return True, f"{model} reachable in {(time.monotonic() - t0) * 1000:.0f} ms"
+
+
+def _response_text(response) -> str:
     text = getattr(response, "text", None)
     if text:
         return str(text).strip()
@@ -741,180 +2053,2330 @@ def gemini_generate(
         return ""
 
 
-def main():
-    token = getenv_strict("TELEGRAM_BOT_TOKEN")
-    gemini_api_key = getenv_strict("GEMINI_API_KEY")
-    # Use Google's template default model unless overridden
-    gemini_model = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
-    # Default directory as per issue description
-    default_dir = r"D:\SDK\estHTML"
-    html_dir = os.getenv("EST_HTML_DIR", default_dir)
+class ResponseCache:
+    """LRU cache of Gemini replies keyed by a hash of model + prompt contents.
 
-    if not os.path.isdir(html_dir):
-        print(f"ERROR: HTML directory not found: {html_dir}", file=sys.stderr)
-        sys.exit(2)
+    Entries older than `ttl` seconds are ignored (ttl <= 0: never expire).
+    With `path` set, entries are also written to a SQLite file and the most
+    recent ones are loaded back on startup. put() only queues the row; a
+    background thread commits queued rows every `flush_sec` seconds and trims
+    the table to the `maxsize` newest unexpired rows, so the file stays
+    bounded and no reply waits for the disk.
+    """
 
-    html_files = find_html_files(html_dir)
-    if not html_files:
-        print(f"ERROR: No .html/.htm files found under: {html_dir}", file=sys.stderr)
-        sys.exit(3)
+    def __init__(self, maxsize: int = 1024, ttl: float = 86400, path: Optional[str] = None, flush_sec: float = 1.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (stored_at, text)
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._unwritten: List[Tuple[str, float, str]] = []
+        self._stop = threading.Event()
+        self._thread = None
+        if path:
+            import sqlite3
 
-    print("Telegram bot started. Waiting for messages...")
-    print(f"Serving random HTML pages from: {html_dir}")
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, ts REAL, text TEXT)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_ts ON responses (ts)")
+            self._trim()
+            rows = self._db.execute(
+                "SELECT key, ts, text FROM responses ORDER BY ts DESC LIMIT ?", (maxsize,)
+            ).fetchall()
+            for key, ts, text in reversed(rows):
+                self._data[key] = (ts, text)
+            self._flush_sec = max(0.01, flush_sec)
+            self._thread = threading.Thread(target=self._run, name="gemini-cache", daemon=True)
+            self._thread.start()
 
-    offset = None
-    try:
-        while True:
+    @classmethod
+    def from_env(cls) -> Optional["ResponseCache"]:
+        """Cache configured by GEMINI_CACHE_SIZE/_TTL/_FILE, or None if the size is 0."""
+        size = _env_int("GEMINI_CACHE_SIZE", 1024)
+        if size <= 0:
+            return None
+        return cls(size, _env_float("GEMINI_CACHE_TTL", 86400), os.getenv("GEMINI_CACHE_FILE") or None)
+
+    @staticmethod
+    def key(model: str, contents: str) -> str:
+        import hashlib
+
+        return hashlib.sha256(f"{model}\0{contents}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and (self.ttl <= 0 or time.time() - entry[0] < self.ttl):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: str, text: str):
+        now = time.time()
+        with self._lock:
+            self._data[key] = (now, text)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            if self._db is not None:
+                self._unwritten.append((key, now, text))
+
+    def _run(self):
+        while not self._stop.wait(self._flush_sec):
+            self.flush()
+
+    def _trim(self):
+        """Delete expired rows and all but the `maxsize` newest ones."""
+        with self._db:
+            if self.ttl > 0:
+                self._db.execute("DELETE FROM responses WHERE ts < ?", (time.time() - self.ttl,))
+            self._db.execute(
+                "DELETE FROM responses WHERE ts < (SELECT ts FROM responses ORDER BY ts DESC LIMIT 1 OFFSET ?)",
+                (self.maxsize - 1,),
+            )
+
+    def flush(self):
+        """Commit the rows queued by put() and trim the table (one transaction each)."""
+        import sqlite3
+
+        with self._lock:
+            rows, self._unwritten = self._unwritten, []
+        if not rows:
+            return
+        with self._db_lock:
+            if self._db is None:
+                return
             try:
-                updates = get_updates(token, offset)
-                for upd in updates:
-                    offset = max(offset or 0, upd.get("update_id", 0) + 1)
-                    msg = upd.get("message") or upd.get("edited_message") or {}
-                    chat = msg.get("chat") or {}
-                    chat_id = chat.get("id")
-                    if not chat_id:
-                        continue
+                with self._db:
+                    self._db.executemany("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", rows)
+                self._trim()
+            except sqlite3.Error as e:
+                print(f"Gemini cache write failed: {e}", file=sys.stderr)
 
-                    # On any input, pick a random HTML file and extract the fixed XPath value
-                    choice = random.choice(html_files)
-                    xpath_value = ""
-                    try:
-                        with open(choice, "rb") as fh:
-                            html_bytes = fh.read()
-                        xpath_value = extract_span_text_for_fixed_xpath(html_bytes) or ""
-                    except Exception:
-                        xpath_value = ""
-
-                    # Compose prompt for Gemini using user's message text and the XPath value
-                    user_text = msg.get("text") or ""
-                    # Flag: when input ends with a question mark (any supported script),
-                    # send ONLY the values of DEFAULT_1..4 as a follow-up message.
-                    want_xpaths_report = _ends_with_double_q(user_text)
-                    # Count trailing dots to trigger per-default separate messages
-                    dots_count = _count_trailing_dots(user_text)
-                    # Prepare extra variables for the template context
-                    extra_vars = {
-                        "chat_username": chat.get("username") or "",
-                        "chat_first_name": chat.get("first_name") or "",
-                        "chat_last_name": chat.get("last_name") or "",
-                        "chat_title": chat.get("title") or "",
-                    }
-                    # Route logic: only call Gemini if the input contains a danger sign; else return xGeneral/xpath.
-                    if not _contains_danger(user_text):
-                        try:
-                            xgeneral_value = _extract_text_for_env_xpath(html_bytes, "xGeneral") if 'html_bytes' in locals() else ""
-                        except Exception:
-                            xgeneral_value = ""
-                        reply_text = xgeneral_value or (xpath_value or "")
-                        try:
-                            send_message(token, chat_id, reply_text)
-                        except Exception:
-                            pass
-                        # If user asked for DEFAULTS values, send them as a follow-up message
-                        if want_xpaths_report:
-                            try:
-                                defaults_vals = _build_defaults_values(html_bytes if 'html_bytes' in locals() else None)
-                                if defaults_vals:
-                                    send_message(token, chat_id, defaults_vals)
-                            except Exception:
-                                pass
-                        # If user ended with dots, send per-default values as separate messages
-                        if dots_count > 0:
-                            try:
-                                pairs = _extract_defaults_list(html_bytes if 'html_bytes' in locals() else None)
-                                if pairs:
-                                    if dots_count <= 4:
-                                        to_send = pairs[:dots_count]
-                                    else:
-                                        to_send = pairs[:4]
-                                    for label, val in to_send:
-                                        text_out = f"{label}: {val}".strip()
-                                        if text_out:
-                                            send_message(token, chat_id, text_out)
-                            except Exception:
-                                pass
-                        continue
-                    try:
-                        ai_text = gemini_generate(
-                            gemini_api_key,
-                            gemini_model,
-                            user_text,
-                            xpath_value,
-                            prompt_template=None,  # can be overridden by env vars inside function
-                            extra_vars=extra_vars,
-                        )
-                        # Always send Gemini response as-is; newline-based actions removed per requirement.
-                        send_message(token, chat_id, ai_text)
-                        if want_xpaths_report:  # send DEFAULTS values after AI reply
-                            try:
-                                defaults_vals = _build_defaults_values(html_bytes if 'html_bytes' in locals() else None)
-                                if defaults_vals:
-                                    send_message(token, chat_id, defaults_vals)
-                            except Exception:
-                                pass
-                        # Dot-trigger per-default messages after AI reply
-                        if dots_count > 0:
-                            try:
-                                pairs = _extract_defaults_list(html_bytes if 'html_bytes' in locals() else None)
-                                if pairs:
-                                    if dots_count <= 4:
-                                        to_send = pairs[:dots_count]
-                                    else:
-                                        to_send = pairs[:4]
-                                    for label, val in to_send:
-                                        text_out = f"{label}: {val}".strip()
-                                        if text_out:
-                                            send_message(token, chat_id, text_out)
-                            except Exception:
-                                pass
-                    except Exception as e:
-                        # Do NOT send the error to the user. Instead, reply with xGeneral value.
-                        # Log the error locally for diagnostics.
-                        print(f"Gemini error: {e}", file=sys.stderr)
-                        try:
-                            xgeneral_value = _extract_text_for_env_xpath(html_bytes, "xGeneral") if 'html_bytes' in locals() else ""
-                        except Exception:
-                            xgeneral_value = ""
-                        # Fallback to previously extracted xpath_value if xGeneral missing/empty
-                        reply_text = xgeneral_value or (xpath_value or "")
-                        if reply_text:
-                            try:
-                                send_message(token, chat_id, reply_text)
-                            except Exception:
-                                pass
-                        # Optionally send DEFAULTS values even on error fallback
-                        if want_xpaths_report:
-                            try:
-                                defaults_vals = _build_defaults_values(html_bytes if 'html_bytes' in locals() else None)
-                                if defaults_vals:
-                                    send_message(token, chat_id, defaults_vals)
-                            except Exception:
-                                pass
-                        # Dot-trigger per-default messages even on error
-                        if dots_count > 0:
-                            try:
-                                pairs = _extract_defaults_list(html_bytes if 'html_bytes' in locals() else None)
-                                if pairs:
-                                    if dots_count <= 4:
-                                        to_send = pairs[:dots_count]
-                                    else:
-                                        to_send = pairs[:4]
-                                    for label, val in to_send:
-                                        text_out = f"{label}: {val}".strip()
-                                        if text_out:
-                                            send_message(token, chat_id, text_out)
-                            except Exception:
-                                pass
-                # Loop continues, long polling already waited
-            except KeyboardInterrupt:
-                print("Interrupted by user. Exiting...")
-                break
-            except Exception as e:
-                print(f"Error: {e}")
-                time.sleep(SLEEP_BETWEEN_ERRORS_SEC)
-    finally:
-        pass
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        rate = (100.0 * self.hits / total) if total else 0.0
+        return f"{self.hits} hits, {self.misses} misses ({rate:.1f}% hit rate), {len(self._data)} entries"
 
+    def close(self):
+        if self._db is not None:
+            self._stop.set()
+            self._thread.join()
+            self.flush()
+            with self._db_lock:
+                self._db.close()
+                self._db = None
 
-if __name__ == "__main__":
-    main()
+
+def gemini_generate(
+    api_key: str,
+    model: str,
+    user_text: str,
+    xpath_value: str,
+    prompt_template: Optional[str] = None,
+    extra_vars: Optional[dict] = None,
+    cache: Optional[ResponseCache] = None,
+    breaker: Optional[CircuitBreaker] = None,
+) -> str:
+    """Generate text using Google's official genai SDK.
+
+    This follows the template recommended by Google:
+        from google import genai
+        client = genai.Client()
+        response = client.models.generate_content(
+            model="gemini-2.5-flash", contents="..."
+        )
+        print(response.text)
+
+    We pass the API key explicitly to avoid relying on the ambient environment,
+    but the SDK also supports pulling it from GEMINI_API_KEY automatically.
+
+    If a ResponseCache is given, an identical model + prompt is answered from it.
+    A model that was not found is skipped for a while (see ModelResolver).
+    The outcome of the API call, not of a cache hit, is reported to breaker.
+    """
+    contents = _format_prompt(user_text, xpath_value, prompt_template, extra_vars)
+    cache_key = ResponseCache.key(model, contents) if cache is not None else None
+    if cache_key is not None:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached
+    try:
+        client = get_gemini_client(api_key)
+
+        # Call the model using the official method API
+        target = MODEL_RESOLVER.resolve(model)
+        try:
+            response = client.models.generate_content(model=target, contents=contents)
+        except Exception as e:
+            # Provide a graceful fallback if the configured model is invalid or unsupported;
+            # re-raise if it is already the fallback model or the error is unrelated.
+            if not _is_model_not_found(e) or target == GEMINI_FALLBACK_MODEL:
+                raise
+            MODEL_RESOLVER.mark_bad(target)
+            METRICS.inc("bot_gemini_model_fallback_total")
+            response = client.models.generate_content(model=GEMINI_FALLBACK_MODEL, contents=contents)
+    except Exception:
+        if breaker is not None:
+            breaker.failure()
+        raise
+    if breaker is not None:
+        breaker.success()
+    text = _response_text(response)
+    if cache_key is not None and text:
+        cache.put(cache_key, text)
+    return text
+
+
+# ----- Interaction log -----
+class InteractionLog:
+    """JSON-lines log of every reply, written by a background thread.
+
+    log() only puts the record on a bounded queue and never blocks: if the
+    writer falls behind (slow storage), records are dropped and counted.
+    The writer batches records, flushes every `flush_sec` seconds and
+    rotates the file when it reaches `max_bytes` or is `rotate_sec` old.
+    Rotated files are named PATH.YYYYmmdd-HHMMSS (gzip-compressed with
+    compress=True) and only the newest `keep` are kept.
+    """
+
+    _STOP = object()
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int = 10 * 1024 * 1024,
+        rotate_sec: float = 0.0,
+        compress: bool = False,
+        keep: int = 5,
+        flush_sec: float = 1.0,
+        queue_size: int = 10000,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotate_sec = rotate_sec
+        self.compress = compress
+        self.keep = keep
+        self.flush_sec = max(0.05, flush_sec)
+        self.written = 0
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        self._thread = threading.Thread(target=self._run, name="interaction-log", daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def from_env(cls) -> Optional["InteractionLog"]:
+        """InteractionLog for BOT_LOG_FILE, or None if it is not set."""
+        path = os.getenv("BOT_LOG_FILE", "")
+        if not path:
+            return None
+        return cls(
+            path,
+            max_bytes=_env_int("BOT_LOG_MAX_BYTES", 10 * 1024 * 1024),
+            rotate_sec=_env_float("BOT_LOG_ROTATE_SEC", 0.0),
+            compress=_env_flag("BOT_LOG_COMPRESS"),
+            keep=_env_int("BOT_LOG_KEEP", 5),
+            flush_sec=_env_float("BOT_LOG_FLUSH_SEC", 1.0),
+            queue_size=_env_int("BOT_LOG_QUEUE", 10000),
+        )
+
+    def log(self, record: dict):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout: float = 5.0):
+        """Write what is queued and stop the writer (waits at most `timeout`)."""
+        try:
+            self._queue.put(self._STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+
+    def _open(self):
+        return open(self.path, "a", encoding="utf-8")
+
+    def _run(self):
+        fh = None
+        opened_at = time.monotonic()
+        last_flush = time.monotonic()
+        while True:
+            try:
+                batch = [self._queue.get(timeout=self.flush_sec)]
+            except queue.Empty:
+                batch = []
+            # Take whatever else is already waiting, so one write covers many records
+            while len(batch) < 1000:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = any(r is self._STOP for r in batch)
+            try:
+                records = [r for r in batch if r is not self._STOP]
+                if records:
+                    if fh is None:
+                        fh = self._open()
+                        opened_at = time.monotonic()
+                    fh.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records))
+                    self.written += len(records)
+                now = time.monotonic()
+                if fh is not None and (stop or now - last_flush >= self.flush_sec):
+                    fh.flush()
+                    last_flush = now
+                    if fh.tell() >= self.max_bytes or (
+                        self.rotate_sec > 0 and now - opened_at >= self.rotate_sec and fh.tell() > 0
+                    ):
+                        fh.close()
+                        fh = None
+                        self._rotate()
+            except Exception as e:
+                print(f"Interaction log error ({self.path}): {e}", file=sys.stderr)
+                if fh is not None:
+                    fh.close()
+                    fh = None
+            if stop:
+                if fh is not None:
+                    fh.close()
+                return
+
+    def _rotate(self):
+        target = f"{self.path}.{time.strftime('%Y%m%d-%H%M%S')}"
+        n = 1
+        while os.path.exists(target) or os.path.exists(target + ".gz"):
+            target = f"{self.path}.{time.strftime('%Y%m%d-%H%M%S')}-{n}"
+            n += 1
+        os.replace(self.path, target)
+        if self.compress:
+            import gzip
+
+            with open(target, "rb") as src, gzip.open(target + ".gz", "wb") as dst:
+                while True:
+                    chunk = src.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+            os.remove(target)
+        # Drop the oldest rotated files beyond `keep`
+        folder = os.path.dirname(os.path.abspath(self.path))
+        prefix = os.path.basename(self.path) + "."
+        rotated = sorted(
+            (os.path.getmtime(os.path.join(folder, name)), name)
+            for name in os.listdir(folder)
+            if name.startswith(prefix)
+        )
+        for _, name in rotated[: max(0, len(rotated) - self.keep)]:
+            try:
+                os.remove(os.path.join(folder, name))
+            except OSError:
+                pass
+
+
+def _interaction_record(job: "UpdateJob", route: str, ai_text: Optional[str], total: float) -> dict:
+    """One faileor.log line: the original ts/chat_id/user_text/ai_text fields,
+    plus the chosen page, its values, the route and per-stage timings."""
+    timings = {name: round(secs * 1000, 2) for name, secs in job.timings.items()}
+    timings["total"] = round(total * 1000, 2)
+    return {
+        "ts": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "chat_id": job.chat_id,
+        "user_text": job.user_text,
+        "ai_text": ai_text,
+        "route": route,
+        "page": job.page.path,
+        "values": dict(job.page.env_values(), xpath_value=job.xpath_value),
+        "timings_ms": timings,
+    }
+
+
+# BOT_LATE_REPLY: what happens to an AI reply that arrives after the fallback was sent
+LATE_REPLY_POLICIES = ("discard", "send", "edit")
+
+
+class ReplyDeadlineExceeded(Exception):
+    """Gemini did not answer within BOT_REPLY_DEADLINE_SEC; `pending` is the
+    still-running call (a Future, or an asyncio Task in the asyncio runtime)."""
+
+    def __init__(self, pending):
+        super().__init__("reply deadline exceeded")
+        self.pending = pending
+
+
+class BotContext:
+    """Everything an update handler needs, shared by all workers."""
+
+    def __init__(
+        self,
+        token: str,
+        gemini_api_key: str,
+        gemini_model: str,
+        index: CorpusIndex,
+        html_dir: str = "",
+        limiter: Optional[RateLimiter] = None,
+        coalesce: bool = False,
+        gemini_cache: Optional[ResponseCache] = None,
+        csv_file: str = "",
+        interaction_log: Optional[InteractionLog] = None,
+    ):
+        self.token = token
+        self.gemini_api_key = gemini_api_key
+        self.gemini_model = gemini_model
+        # None while the index is still being built in the background (see set_index)
+        self.index = index
+        self._index_ready = threading.Event()
+        self._index_error: Optional[BaseException] = None
+        if index is not None:
+            self._index_ready.set()
+        self.html_dir = html_dir
+        self.csv_file = csv_file
+        self.limiter = limiter or RateLimiter()
+        self.coalesce = coalesce
+        self.sender = MessageSender(token, self.limiter, coalesce)
+        self.gemini_cache = gemini_cache
+        self.gemini_breaker = CircuitBreaker.from_env()
+        # Longest wait for Gemini per message (0: no limit) and what to do with replies that come later
+        self.reply_deadline = _env_float("BOT_REPLY_DEADLINE_SEC", 0.0)
+        self.late_reply = os.getenv("BOT_LATE_REPLY", "discard").strip().lower()
+        if self.late_reply not in LATE_REPLY_POLICIES:
+            print(f"Ignoring invalid BOT_LATE_REPLY value: {self.late_reply!r}", file=sys.stderr)
+            self.late_reply = "discard"
+        self._gemini_pool = None
+        self._gemini_pool_lock = threading.Lock()
+        METRICS.set_callback("bot_gemini_circuit_state", lambda: self.gemini_breaker.state)
+        if gemini_cache is not None:
+            METRICS.set_callback("bot_gemini_cache_hits_total", lambda: gemini_cache.hits)
+            METRICS.set_callback("bot_gemini_cache_misses_total", lambda: gemini_cache.misses)
+        self.interaction_log = interaction_log
+        if interaction_log is not None:
+            METRICS.set_callback("bot_interaction_log_written_total", lambda: interaction_log.written)
+            METRICS.set_callback("bot_interaction_log_dropped_total", lambda: interaction_log.dropped)
+        self.metrics_server = None
+        self.watcher = None  # CorpusWatcher, started once the index is built
+        self._reload_lock = threading.Lock()
+
+    def gemini_pool(self):
+        """Threads that run Gemini calls when a reply deadline is set."""
+        with self._gemini_pool_lock:
+            if self._gemini_pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+
+                self._gemini_pool = ThreadPoolExecutor(
+                    max_workers=2 * max(1, _env_int("BOT_WORKERS", 4)), thread_name_prefix="gemini"
+                )
+            return self._gemini_pool
+
+    def set_index(self, index: CorpusIndex):
+        self.index = index
+        self._index_ready.set()
+
+    def fail_index(self, error: BaseException):
+        self._index_error = error
+        self._index_ready.set()
+
+    @property
+    def index_ready(self) -> bool:
+        return self._index_ready.is_set()
+
+    def wait_index(self) -> CorpusIndex:
+        """The corpus index, waiting for the background build if it is still running."""
+        self._index_ready.wait()
+        if self.index is None:
+            raise RuntimeError(f"corpus index unavailable: {self._index_error}")
+        return self.index
+
+    @property
+    def source(self) -> str:
+        """Where pages come from: the CSV file if one is used, else the HTML directory."""
+        return self.csv_file or self.html_dir
+
+    def reload_config(self, path: Optional[str] = None):
+        """Recompile the XPath configuration (re-reading the config file at
+        path, default BOT_CONFIG_FILE) and swap it in.
+
+        If the new configuration needs the same columns, the existing index is
+        simply pointed at it; otherwise the index is rebuilt (reusing the on-disk
+        cache where possible) and replaced in one assignment. Messages being
+        served keep using the snapshot they started with.
+        """
+        with self._reload_lock:
+            self.wait_index()
+            config = reload_xpath_config(path)
+            if config.columns == self.index.config.columns:
+                self.index.config = config
+                print("XPath configuration reloaded")
+                return
+            t0 = time.monotonic()
+            if self.csv_file:
+                self.index = load_csv_index(self.csv_file, csv_column_map(), config)
+                print(f"XPath configuration reloaded; re-read {len(self.index)} rows from {self.csv_file}")
+                return
+            scanned = scan_html_files(self.html_dir)
+            if not scanned:
+                print(f"Reload skipped: no .html/.htm files under {self.html_dir}", file=sys.stderr)
+                return
+            index, reused, rebuilt = _load_index(self.html_dir, scanned, config)
+            self.index = index
+            print(
+                f"XPath configuration reloaded; re-indexed {len(index)} pages in "
+                f"{time.monotonic() - t0:.2f}s (reused {reused}, rebuilt {rebuilt})"
+            )
+
+    def close(self):
+        """Release resources and print a summary; called on shutdown."""
+        print(METRICS.summary())
+        if self.gemini_cache is not None:
+            print(f"Gemini cache: {self.gemini_cache.stats()}")
+            self.gemini_cache.close()
+        if self.watcher is not None:
+            self.watcher.stop()
+        if self._gemini_pool is not None:
+            # Late AI replies still running are not waited for
+            self._gemini_pool.shutdown(wait=False)
+        if self.interaction_log is not None:
+            self.interaction_log.close()
+            log = self.interaction_log
+            print(f"Interaction log: {log.written} records written, {log.dropped} dropped ({log.path})")
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+
+
+def _update_chat_id(upd: dict):
+    msg = upd.get("message") or upd.get("edited_message") or {}
+    return (msg.get("chat") or {}).get("id")
+
+
+class UpdateJob:
+    """A received message with its randomly chosen page and routing flags."""
+
+    __slots__ = (
+        "chat_id", "user_text", "page", "xpath_value", "extra_vars", "want_xpaths_report", "dots_count", "timings",
+        "deadline",
+    )
+
+    def __init__(self, chat_id, chat: dict, user_text: str, page: PageValues, deadline: Optional[float] = None):
+        self.timings = {}  # stage -> seconds, for the interaction log
+        # time.monotonic() by which the reply must be sent (BOT_REPLY_DEADLINE_SEC), or None
+        self.deadline = deadline
+        self.chat_id = chat_id
+        self.user_text = user_text
+        self.page = page
+        self.xpath_value = page.xpath_value
+        # Flag: when input ends with a question mark (any supported script),
+        # send ONLY the values of DEFAULT_1..4 as a follow-up message.
+        self.want_xpaths_report = _ends_with_double_q(user_text)
+        # Count trailing dots to trigger per-default separate messages
+        self.dots_count = _count_trailing_dots(user_text)
+        # Prepare extra variables for the template context
+        self.extra_vars = {
+            "chat_username": chat.get("username") or "",
+            "chat_first_name": chat.get("first_name") or "",
+            "chat_last_name": chat.get("last_name") or "",
+            "chat_title": chat.get("title") or "",
+        }
+
+    @property
+    def use_ai(self) -> bool:
+        # Route logic: only call Gemini if the input contains a danger sign; else return xGeneral/xpath.
+        return _contains_danger(self.user_text)
+
+    def fallback_text(self) -> str:
+        """xGeneral value, or the first-match XPath value if xGeneral is missing/empty."""
+        try:
+            xgeneral_value = self.page.env_value("xGeneral")
+        except Exception:
+            xgeneral_value = ""
+        return xgeneral_value or (self.xpath_value or "")
+
+    def report_text(self) -> str:
+        """The "?" follow-up (DEFAULT values), or "" if not requested."""
+        if not self.want_xpaths_report:
+            return ""
+        return self.page.defaults_values()
+
+    def dot_texts(self) -> List[str]:
+        """One "DEFAULT_n: value" message per trailing dot (at most 4)."""
+        if self.dots_count <= 0:
+            return []
+        pairs = self.page.defaults_list()
+        out = []
+        for label, val in pairs[:min(self.dots_count, 4)]:
+            text_out = f"{label}: {val}".strip()
+            if text_out:
+                out.append(text_out)
+        return out
+
+    def follow_up_texts(self) -> List[str]:
+        """Messages sent after the main reply: the "?" report, then the dot-trigger values."""
+        return [self.report_text()] + self.dot_texts()
+
+
+def prepare_update(ctx: BotContext, upd: dict) -> Optional[UpdateJob]:
+    """Pick a random page for the update, or None if it has no chat to reply to."""
+    msg = upd.get("message") or upd.get("edited_message") or {}
+    chat = msg.get("chat") or {}
+    chat_id = chat.get("id")
+    if not chat_id:
+        return None
+    # The reply deadline counts from here, including any wait for the index
+    deadline = time.monotonic() + ctx.reply_deadline if ctx.reply_deadline > 0 else None
+    # On any input, pick a random page; its XPath values were extracted at startup
+    index = ctx.wait_index()
+    t0 = time.monotonic()
+    job = UpdateJob(chat_id, chat, msg.get("text") or "", index.random_page(), deadline)
+    job.timings["lookup"] = elapsed = time.monotonic() - t0
+    METRICS.observe("bot_page_lookup_seconds", elapsed)
+    return job
+
+
+def _deliver(ctx: BotContext, job: UpdateJob, reply_text: str) -> bool:
+    """Send the main reply and its follow-ups as one batch.
+
+    Returns True if the main reply itself was delivered.
+    """
+    # Empty texts are dropped from the batch, so the main reply is message 0 only if there is one
+    main = 0 if reply_text else None
+    t0 = time.monotonic()
+    try:
+        results = ctx.sender.send_batch(job.chat_id, [reply_text] + job.follow_up_texts())
+    except Exception:
+        return False
+    finally:
+        job.timings["send"] = time.monotonic() - t0
+    return main is not None and main < len(results) and results[main]
+
+
+def _gemini_reply(ctx: BotContext, job: UpdateJob) -> str:
+    """gemini_generate for the job, bounded by job.deadline if it has one.
+
+    Raises ReplyDeadlineExceeded if the deadline passes first. A call still
+    queued on ctx.gemini_pool() is then cancelled, and one that reaches a
+    worker after the deadline is skipped; a call already running finishes,
+    and counts as a failure for ctx.gemini_breaker right away.
+    """
+    call = functools.partial(
+        gemini_generate,
+        ctx.gemini_api_key,
+        ctx.gemini_model,
+        job.user_text,
+        job.xpath_value,
+        prompt_template=None,  # can be overridden by env vars inside function
+        extra_vars=job.extra_vars,
+        cache=ctx.gemini_cache,
+        breaker=ctx.gemini_breaker,
+    )
+    if job.deadline is None:
+        return call()
+    import concurrent.futures
+
+    started = threading.Event()
+
+    def call_before_deadline():
+        if time.monotonic() >= job.deadline:
+            raise ReplyDeadlineExceeded(None)  # waited in the queue too long; spare the quota
+        started.set()
+        return call()
+
+    future = ctx.gemini_pool().submit(call_before_deadline)
+    try:
+        return future.result(timeout=max(0.0, job.deadline - time.monotonic()))
+    except concurrent.futures.TimeoutError:
+        if future.done():
+            raise  # the call itself timed out
+        future.cancel()
+        if started.is_set():
+            # Stalled at the API: count it now, not only when (if ever) it gives up
+            ctx.gemini_breaker.failure()
+        raise ReplyDeadlineExceeded(future)
+    except ReplyDeadlineExceeded:
+        # Skipped by call_before_deadline before result() timed out; report it with its future
+        raise ReplyDeadlineExceeded(future) from None
+
+
+def _late_reply(ctx: BotContext, chat_id, text: Optional[str], message_id: Optional[int]):
+    """Deliver (or drop) an AI reply that came after the fallback, per BOT_LATE_REPLY."""
+    if not text or ctx.late_reply == "discard":
+        METRICS.inc("bot_gemini_late_total", outcome="discarded" if text else "failed")
+        return
+    try:
+        if ctx.late_reply == "edit" and message_id is not None:
+            edit_message_text(ctx.token, chat_id, message_id, text)
+            outcome = "edited"
+        else:
+            send_message(ctx.token, chat_id, text)
+            outcome = "sent"
+    except Exception as e:
+        print(f"Late AI reply not delivered: {e}", file=sys.stderr)
+        outcome = "failed"
+    METRICS.inc("bot_gemini_late_total", outcome=outcome)
+
+
+def _deliver_before_ai(ctx: BotContext, job: UpdateJob, future):
+    """The deadline passed: send the fallback now and leave the AI reply to _late_reply."""
+    fallback = job.fallback_text()
+    message_id = None
+    if ctx.late_reply == "edit" and fallback:
+        # Send the main reply on its own to learn its message_id for the later edit
+        t0 = time.monotonic()
+        try:
+            message_id = send_message(ctx.token, job.chat_id, fallback)["result"]["message_id"]
+        except Exception:
+            pass
+        try:
+            ctx.sender.send_batch(job.chat_id, job.follow_up_texts())
+        except Exception:
+            pass
+        job.timings["send"] = time.monotonic() - t0
+    else:
+        _deliver(ctx, job, fallback)
+    if future is None:
+        METRICS.inc("bot_gemini_late_total", outcome="cancelled")
+        return
+
+    def done(f):
+        if f.cancelled() or isinstance(f.exception(), ReplyDeadlineExceeded):
+            METRICS.inc("bot_gemini_late_total", outcome="cancelled")
+            return
+        _late_reply(ctx, job.chat_id, None if f.exception() is not None else f.result(), message_id)
+
+    future.add_done_callback(done)
+
+
+def handle_update(ctx: BotContext, upd: dict):
+    """Reply to a single Telegram update."""
+    job = prepare_update(ctx, upd)
+    if job is None:
+        return
+    METRICS.inc("bot_updates_total")
+    t0 = time.monotonic()
+    route = "plain"
+    ai_text = None
+    try:
+        if not job.use_ai:
+            _deliver(ctx, job, job.fallback_text())
+            return
+        if not ctx.gemini_breaker.allow():
+            # Gemini keeps failing: answer like an AI error, without waiting for one
+            route = "ai_skipped"
+            _deliver(ctx, job, job.fallback_text())
+            return
+        route = "ai"
+        t_ai = time.monotonic()
+        try:
+            ai_text = _gemini_reply(ctx, job)
+        except ReplyDeadlineExceeded as late:
+            job.timings["gemini"] = time.monotonic() - t_ai
+            METRICS.observe("bot_gemini_seconds", job.timings["gemini"], outcome="timeout")
+            route = "ai_timeout"
+            _deliver_before_ai(ctx, job, late.pending)
+            return
+        except Exception as e:
+            job.timings["gemini"] = time.monotonic() - t_ai
+            METRICS.observe("bot_gemini_seconds", job.timings["gemini"], outcome="error")
+            route = "ai_error"
+            # Do NOT send the error to the user. Instead, reply with xGeneral value.
+            # Log the error locally for diagnostics.
+            print(f"Gemini error: {e}", file=sys.stderr)
+            # DEFAULTS values and dot-trigger messages are sent even on error fallback
+            _deliver(ctx, job, job.fallback_text())
+            return
+        job.timings["gemini"] = time.monotonic() - t_ai
+        METRICS.observe("bot_gemini_seconds", job.timings["gemini"], outcome="ok")
+        # Always send Gemini response as-is; newline-based actions removed per requirement.
+        # An empty response is answered with xGeneral, ahead of the follow-ups.
+        if not _deliver(ctx, job, ai_text or job.fallback_text()):
+            # The AI reply could not be delivered: fall back to xGeneral as on a Gemini error
+            route = "ai_undelivered"
+            reply_text = job.fallback_text()
+            if reply_text:
+                try:
+                    send_message(ctx.token, job.chat_id, reply_text)
+                except Exception:
+                    pass
+    finally:
+        total = time.monotonic() - t0
+        METRICS.observe("bot_update_seconds", total, route=route)
+        if ctx.interaction_log is not None:
+            ctx.interaction_log.log(_interaction_record(job, route, ai_text, total))
+
+
+# ----- Update checkpoint -----
+class UpdateCheckpoint:
+    """Durable getUpdates offset, updates in flight and recently handled update ids.
+
+    The state file is an append-only log: "bot ID" first, then "u UPDATE" (the
+    update as JSON) for each update queued for a handler, "h ID" for each
+    handled update and "o OFFSET" for the offset confirmed to Telegram. Lines
+    are collected in memory and written with one fsync every `flush_sec`
+    seconds by a background thread, so handlers never wait for the disk. The
+    log is rewritten compactly at startup and whenever it grows well past
+    `remember` entries.
+
+    Polling reads ahead of slow updates: before getUpdates confirms an offset,
+    confirm() syncs the "u" lines of everything accepted below it, so an update
+    still in flight during a crash is taken from replay() and answered after
+    the restart even though Telegram has forgotten it. A crash can lose the
+    last `flush_sec` of "h" lines; those updates are answered again. Updates
+    that come back although they were already handled (or replayed) are
+    recognised by seen() and skipped instead of being answered (and sent to
+    Gemini) again.
+    """
+
+    def __init__(self, path: str, bot_id: str = "", flush_sec: float = 1.0, remember: int = 10000):
+        self.path = path
+        self.bot_id = bot_id
+        self.flush_sec = max(0.01, flush_sec)
+        self.remember = max(1, remember)
+        self.offset: Optional[int] = None
+        self._recent = deque()
+        self._handled = set()
+        self._inflight = {}  # update_id -> the update as a JSON line
+        self._pending: List[str] = []
+        self._lines = 0
+        self._fh = None
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()  # keeps flushes (and their fsyncs) in order
+        self._stop = threading.Event()
+        self._load()
+        self._replay = [json.loads(line) for _, line in sorted(self._inflight.items())]
+        self._rewrite()
+        self._thread = threading.Thread(target=self._run, name="checkpoint", daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def from_env(cls, token: str) -> Optional["UpdateCheckpoint"]:
+        """Checkpoint in BOT_STATE_FILE, or None if it is not set."""
+        path = os.getenv("BOT_STATE_FILE", "")
+        if not path:
+            return None
+        return cls(
+            path,
+            bot_id=token.split(":", 1)[0],
+            flush_sec=_env_float("BOT_STATE_FSYNC_SEC", 1.0),
+            remember=_env_int("BOT_STATE_REMEMBER", 10000),
+        )
+
+    def _load(self):
+        try:
+            fh = open(self.path, "r", encoding="utf-8")
+        except FileNotFoundError:
+            return
+        with fh:
+            for line in fh:
+                kind, _, value = line.strip().partition(" ")
+                if kind == "bot":
+                    if value != self.bot_id:
+                        print(f"Ignoring {self.path}: it belongs to another bot", file=sys.stderr)
+                        return
+                    continue
+                try:
+                    if kind == "u":
+                        self._inflight[json.loads(value)["update_id"]] = value
+                        continue
+                    number = int(value)
+                except (ValueError, KeyError, TypeError):
+                    continue  # e.g. a line cut short by a crash
+                if kind == "o":
+                    self.offset = max(self.offset or 0, number)
+                elif kind == "h":
+                    self._remember(number)
+                    self._inflight.pop(number, None)
+
+    def _remember(self, update_id: int) -> bool:
+        if update_id in self._handled:
+            return False
+        self._handled.add(update_id)
+        self._recent.append(update_id)
+        while len(self._recent) > self.remember:
+            self._handled.discard(self._recent.popleft())
+        return True
+
+    def replay(self) -> List[dict]:
+        """Updates that were in flight when the bot last stopped, oldest first (once)."""
+        updates, self._replay = self._replay, []
+        return updates
+
+    def seen(self, update_id: int) -> bool:
+        """True if the update was already handled or is being handled now."""
+        with self._lock:
+            return update_id in self._handled or update_id in self._inflight
+
+    def accept(self, upd: dict):
+        """The update was queued for a handler; done() or abandon() must follow."""
+        line = json.dumps(upd, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            self._inflight[upd.get("update_id", 0)] = line
+            self._pending.append(f"u {line}")
+
+    def abandon(self, update_id: int):
+        """The update was not queued after all (e.g. the dispatcher was full)."""
+        with self._lock:
+            self._inflight.pop(update_id, None)
+
+    def done(self, update_id: int):
+        with self._lock:
+            self._inflight.pop(update_id, None)
+            if self._remember(update_id):
+                self._pending.append(f"h {update_id}")
+
+    def confirm(self, offset: int):
+        """Record offset and sync every accepted update, before getUpdates confirms offset to Telegram."""
+        with self._lock:
+            if self.offset is not None and offset <= self.offset:
+                return
+            self.offset = offset
+            self._pending.append(f"o {offset}")
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_sec):
+            self.flush()
+
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                lines, self._pending = self._pending, []
+            if not lines:
+                return
+            try:
+                self._fh.write("".join(line + "\n" for line in lines))
+                self._fh.flush()
+                os.fsync(self._fh.fileno())
+                self._lines += len(lines)
+                if self._lines > 4 * self.remember + 1000:
+                    self._rewrite()
+            except (OSError, ValueError) as e:
+                print(f"Update checkpoint error ({self.path}): {e}", file=sys.stderr)
+
+    def _rewrite(self):
+        """Replace the log with one holding only the current state."""
+        with self._lock:
+            offset, recent = self.offset, list(self._recent)
+            inflight = list(self._inflight.values())
+        lines = [f"bot {self.bot_id}"]
+        if offset is not None:
+            lines.append(f"o {offset}")
+        lines.extend(f"h {update_id}" for update_id in recent)
+        lines.extend(f"u {line}" for line in inflight)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fh:
+            fh.write("\n".join(lines) + "\n")
+            fh.flush()
+            os.fsync(fh.fileno())
+        if self._fh is not None:
+            self._fh.close()
+        os.replace(tmp_path, self.path)
+        self._fh = open(self.path, "a", encoding="utf-8")
+        self._lines = len(lines)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+        self._fh.close()
+
+
+def _checkpointed(handler, checkpoint: Optional[UpdateCheckpoint]):
+    """Wrap an update handler so that finishing an update is recorded in the checkpoint."""
+    if checkpoint is None:
+        return handler
+
+    def handle(upd: dict):
+        try:
+            handler(upd)
+        finally:
+            checkpoint.done(upd.get("update_id", 0))
+
+    return handle
+
+
+def _resume_message(checkpoint: Optional[UpdateCheckpoint]) -> str:
+    if checkpoint is None or checkpoint.offset is None:
+        return ""
+    return (
+        f"Resuming from update {checkpoint.offset} ({len(checkpoint._recent)} handled updates remembered, "
+        f"{len(checkpoint._replay)} in flight to answer again)"
+    )
+
+
+# ----- Concurrent update dispatch -----
+class UpdateDispatcher:
+    """Runs update handlers on a thread pool while keeping per-chat order.
+
+    Each chat has its own FIFO; at most one worker drains a given chat at a
+    time, so replies to one chat never overtake each other while different
+    chats proceed in parallel. `submit` blocks once `max_inflight` updates are
+    queued or running (backpressure), so the caller only moves the getUpdates
+    offset past work that has actually been accepted.
+    """
+
+    def __init__(self, handler, workers: int = 4, max_inflight: int = 64):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self._handler = handler
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="update")
+        self._slots = threading.BoundedSemaphore(max(1, max_inflight))
+        self._lock = threading.Lock()
+        self._queues = {}  # chat_id -> deque of pending updates
+        self._depth = 0
+
+    def depth(self) -> int:
+        """Updates queued or running."""
+        return self._depth
+
+    def submit(self, chat_id, upd: dict, block: bool = True) -> bool:
+        """Queue an update; returns False (only when block=False) if the dispatcher is full."""
+        if not self._slots.acquire(blocking=block):
+            return False
+        with self._lock:
+            self._depth += 1
+            q = self._queues.get(chat_id)
+            if q is not None:
+                # A worker is already draining this chat; it will pick this up in order
+                q.append(upd)
+                return True
+            self._queues[chat_id] = deque([upd])
+        self._pool.submit(self._drain, chat_id)
+        return True
+
+    def _drain(self, chat_id):
+        while True:
+            with self._lock:
+                q = self._queues[chat_id]
+                if not q:
+                    del self._queues[chat_id]
+                    return
+                upd = q.popleft()
+            try:
+                self._handler(upd)
+            except Exception as e:
+                print(f"Error: {e}")
+            finally:
+                with self._lock:
+                    self._depth -= 1
+                self._slots.release()
+
+    def shutdown(self, wait: bool = True):
+        self._pool.shutdown(wait=wait)
+
+
+def _load_index(html_dir: str, scanned, config: Optional[XPathConfig] = None, cache_path: Optional[str] = ""):
+    """load_corpus_index with the configured cache, falling back to no cache on SQLite errors.
+
+    cache_path defaults to index_cache_path(html_dir); None means no cache.
+    """
+    if cache_path == "":
+        cache_path = index_cache_path(html_dir)
+    if not cache_path:
+        return load_corpus_index(scanned, None, config)
+    import sqlite3
+
+    try:
+        return load_corpus_index(scanned, cache_path, config)
+    except sqlite3.Error as e:
+        print(f"Index cache unavailable ({cache_path}): {e}", file=sys.stderr)
+        return load_corpus_index(scanned, None, config)
+
+
+def _file_stamp(path: str):
+    try:
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size
+    except OSError:
+        return None
+
+
+def _watch_config_file(ctx: BotContext, path: str, interval: float, last):
+    """Poll BOT_CONFIG_FILE and reload the XPath configuration when it changes."""
+    while True:
+        time.sleep(interval)
+        current = _file_stamp(path)
+        if current != last:
+            last = current
+            try:
+                ctx.reload_config()
+            except Exception as e:
+                print(f"Config reload failed: {e}", file=sys.stderr)
+
+
+def install_config_reload(ctx: BotContext):
+    """Reload the XPath configuration on SIGHUP and on BOT_CONFIG_FILE changes.
+
+    SIGHUP always re-reads a file (config_file_path()): the process
+    environment cannot be changed from outside, so that is where new
+    values come from.
+    """
+    def reload_in_background(*_):
+        # Signal handlers run on the main thread; keep it free for serving
+        threading.Thread(
+            target=ctx.reload_config, args=(config_file_path(),), name="config-reload", daemon=True
+        ).start()
+
+    if hasattr(signal, "SIGHUP"):
+        try:
+            signal.signal(signal.SIGHUP, reload_in_background)
+        except ValueError:
+            pass  # not on the main thread
+    path = os.getenv("BOT_CONFIG_FILE", "")
+    if path:
+        interval = _env_float("BOT_CONFIG_POLL_SEC", 5.0)
+        threading.Thread(
+            target=_watch_config_file,
+            args=(ctx, path, interval, _file_stamp(path)),
+            name="config-watch",
+            daemon=True,
+        ).start()
+
+
+# ----- Corpus watcher -----
+_HTML_EXTS = (".html", ".htm")
+
+# inotify(7) event bits
+_IN_MODIFY = 0x2
+_IN_ATTRIB = 0x4
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_Q_OVERFLOW = 0x4000
+_IN_IGNORED = 0x8000
+_IN_ISDIR = 0x40000000
+_IN_WATCH_MASK = (
+    _IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+)
+
+
+class _Inotify:
+    """Recursive inotify watch on a directory tree (Linux, via ctypes).
+
+    The constructor raises OSError where inotify is unavailable or the watch
+    limit is reached, so the caller can fall back to polling.
+    """
+
+    def __init__(self, root: str):
+        import ctypes
+        import ctypes.util
+
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {}  # watch descriptor -> directory path
+        try:
+            self.add_tree(root)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def add_tree(self, top: str):
+        import ctypes
+
+        stack = [top]
+        while stack:
+            folder = stack.pop()
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(folder), _IN_WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err == errno.ENOENT:
+                    continue  # removed meanwhile
+                raise OSError(err, f"inotify_add_watch failed for {folder}: {os.strerror(err)}")
+            self.dirs[wd] = folder
+            try:
+                stack.extend(e.path for e in os.scandir(folder) if e.is_dir(follow_symlinks=False))
+            except OSError:
+                pass
+
+    def forget_tree(self, top: str):
+        """Drop the watches of a directory tree that was moved away."""
+        prefix = top + os.sep
+        for wd, folder in list(self.dirs.items()):
+            if folder == top or folder.startswith(prefix):
+                self._libc.inotify_rm_watch(self.fd, wd)
+                del self.dirs[wd]
+
+    def read(self, timeout: Optional[float]) -> List[Tuple[int, str]]:
+        """(mask, path) of the events available within `timeout` seconds."""
+        import select
+
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        pos = 0
+        while pos + 16 <= len(data):
+            wd, mask, _, size = struct.unpack_from("iIII", data, pos)
+            name = data[pos + 16:pos + 16 + size].rstrip(b"\0")
+            pos += 16 + size
+            if mask & _IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            folder = self.dirs.get(wd)
+            if mask & _IN_Q_OVERFLOW or folder is None:
+                events.append((mask, ""))
+            else:
+                events.append((mask, os.path.join(folder, os.fsdecode(name)) if name else folder))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class CorpusWatcher:
+    """Keep the corpus index in step with EST_HTML_DIR while the bot runs.
+
+    Changes are collected from inotify on Linux (or, where that is not
+    available, from a periodic stat of the whole tree), debounced, and then
+    applied to the live index: only new or changed pages are parsed, removed
+    ones are dropped, and the index cache is updated for those pages alone.
+    Each page is swapped in with one assignment, so a message being served
+    sees either the old or the new version of its page, never a mix.
+    """
+
+    def __init__(self, ctx: BotContext, mode: str = "auto", debounce: float = 1.0, poll_sec: float = 10.0):
+        self.ctx = ctx
+        self.root = ctx.html_dir
+        self.mode = mode
+        self.debounce = max(0.05, debounce)
+        self.poll_sec = max(0.1, poll_sec)
+        self._inotify: Optional[_Inotify] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_env(cls, ctx: BotContext) -> Optional["CorpusWatcher"]:
+        """Watcher configured by EST_WATCH (off, auto or poll), or None if off."""
+        mode = os.getenv("EST_WATCH", "").strip().lower()
+        if mode in ("", "0", "off", "false", "no"):
+            return None
+        if mode in ("1", "on", "true", "yes"):
+            mode = "auto"
+        if mode not in ("auto", "inotify", "poll"):
+            print(f"Ignoring invalid EST_WATCH value: {mode!r}", file=sys.stderr)
+            return None
+        return cls(
+            ctx,
+            mode,
+            debounce=_env_float("EST_WATCH_DEBOUNCE_SEC", 1.0),
+            poll_sec=_env_float("EST_WATCH_POLL_SEC", 10.0),
+        )
+
+    def start(self):
+        if self.mode != "poll":
+            try:
+                self._inotify = _Inotify(self.root)
+            except OSError as e:
+                print(f"Corpus watcher: inotify unavailable ({e}); falling back to polling", file=sys.stderr)
+        target = self._run_inotify if self._inotify is not None else self._run_poll
+        self._thread = threading.Thread(target=target, name="corpus-watch", daemon=True)
+        self._thread.start()
+        how = "inotify" if self._inotify is not None else f"polling every {self.poll_sec:g}s"
+        print(f"Watching {self.root} for page changes ({how})")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=max(self.poll_sec, self.debounce) + 1)
+        if self._inotify is not None:
+            self._inotify.close()
+
+    def _run_inotify(self):
+        # Pages written while the index was being built have no event; catch up first
+        self._apply(rescan=True)
+        dirty = set()
+        gone = []
+        rescan = False
+        first = None
+        while not self._stop.is_set():
+            timeout = 1.0 if first is None else self.debounce
+            try:
+                events = self._inotify.read(timeout)
+            except OSError as e:
+                print(f"Corpus watcher error: {e}", file=sys.stderr)
+                events, rescan = [], True
+            for mask, path in events:
+                if first is None:
+                    first = time.monotonic()
+                if not path:
+                    rescan = True  # queue overflow: events were lost
+                elif mask & _IN_ISDIR:
+                    if mask & (_IN_CREATE | _IN_MOVED_TO):
+                        try:
+                            self._inotify.add_tree(path)
+                        except OSError as e:
+                            print(f"Corpus watcher: {e}", file=sys.stderr)
+                        dirty.update(p for p, _, _ in scan_html_files(path))
+                    elif mask & (_IN_DELETE | _IN_MOVED_FROM):
+                        self._inotify.forget_tree(path)
+                        gone.append(path)
+                elif path.lower().endswith(_HTML_EXTS):
+                    dirty.add(path)
+            # Apply once the burst is over (or has gone on for 10 debounce periods)
+            if first is not None and (not events or time.monotonic() - first >= 10 * self.debounce):
+                self._apply(dirty, gone, rescan)
+                dirty, gone, rescan, first = set(), [], False, None
+
+    def _run_poll(self):
+        while not self._stop.wait(self.poll_sec):
+            self._apply(rescan=True)
+
+    def _apply(self, dirty=(), gone=(), rescan: bool = False):
+        try:
+            with self.ctx._reload_lock:
+                self._apply_locked(dirty, gone, rescan)
+        except Exception as e:
+            print(f"Corpus update failed: {e}", file=sys.stderr)
+
+    def _apply_locked(self, dirty, gone, rescan: bool):
+        t0 = time.monotonic()
+        index = self.ctx.wait_index()
+        candidates = {}  # path -> (mtime_ns, size), or None if it no longer exists
+        removed = []
+        for folder in gone:
+            removed.extend(index.paths[row] for row in index.paths.rows_under(folder))
+        if rescan:
+            seen = bytearray(len(index.paths))
+            for path, mtime_ns, size in scan_html_files(self.root):
+                row = index.paths.find(path)
+                if row is None or index.rows[row] is None or index.stamp(row) != (mtime_ns, size):
+                    candidates[path] = (mtime_ns, size)
+                if row is not None:
+                    seen[row] = 1
+            removed.extend(
+                index.paths[row] for row, values in enumerate(index.rows) if values is not None and not seen[row]
+            )
+        for path in dirty:
+            try:
+                st = os.stat(path)
+            except OSError:
+                removed.append(path)
+                continue
+            row = index.paths.find(path)
+            if row is None or index.rows[row] is None or index.stamp(row) != (st.st_mtime_ns, st.st_size):
+                candidates[path] = (st.st_mtime_ns, st.st_size)
+
+        # Parse first, then swap the rows in
+        changed = [(path, m, n, index.extract_file(path)) for path, (m, n) in candidates.items()]
+        added = sum(1 for path, _, _, _ in changed if index.page(path) is None)
+        for path, mtime_ns, size, values in changed:
+            index.add_values(path, values, (mtime_ns, size))
+        removed = [path for path in removed if path not in candidates and index.remove(path)]
+        if not changed and not removed:
+            return
+
+        if index.removed > max(64, len(index)) and len(index):
+            # Mostly-removed tables slow the random pick down; rebuild without the holes
+            self.ctx.index = index.compacted()
+        METRICS.inc("bot_index_pages_total", len(changed), source="watch")
+        METRICS.inc("bot_corpus_changes_total", added, change="added")
+        METRICS.inc("bot_corpus_changes_total", len(changed) - added, change="changed")
+        METRICS.inc("bot_corpus_changes_total", len(removed), change="removed")
+        cache_path = index_cache_path(self.root)
+        if cache_path:
+            import sqlite3
+
+            try:
+                update_index_cache(cache_path, index.columns, changed, removed)
+            except sqlite3.Error as e:
+                print(f"Index cache unavailable ({cache_path}): {e}", file=sys.stderr)
+        print(
+            f"Corpus updated in {time.monotonic() - t0:.3f}s: {added} added, "
+            f"{len(changed) - added} changed, {len(removed)} removed ({len(self.ctx.index)} pages)"
+        )
+
+
+class StartupTimer:
+    """Durations of the startup phases, for the timing report."""
+
+    def __init__(self):
+        self.phases: List[Tuple[str, float]] = []
+        self._lock = threading.Lock()
+
+    def record(self, name: str, since: float) -> float:
+        """Record a phase that started at `since` (time.monotonic()); returns now."""
+        now = time.monotonic()
+        with self._lock:
+            self.phases.append((name, now - since))
+        return now
+
+    def report(self) -> str:
+        with self._lock:
+            return ", ".join(f"{name} {secs:.3f}s" for name, secs in self.phases)
+
+
+def _startup() -> BotContext:
+    """Read configuration and build the shared context.
+
+    Only the quick checks run here, so polling can start right away: the HTML
+    corpus is scanned, but the index is built (or loaded from its cache) and
+    the Gemini client created on a background thread. Handlers wait for the
+    index if a message arrives first.
+
+    Exits the process (codes 2/3) if the HTML directory (or EST_CSV_FILE, if
+    set) is missing or empty.
+    """
+    timer = StartupTimer()
+    t = time.monotonic()
+    token = getenv_strict("TELEGRAM_BOT_TOKEN")
+    gemini_api_key = getenv_strict("GEMINI_API_KEY")
+    # Use Google's template default model unless overridden
+    gemini_model = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+    # Default directory as per issue description
+    default_dir = r"D:\SDK\estHTML"
+    html_dir = os.getenv("EST_HTML_DIR", default_dir)
+    csv_file = os.getenv("EST_CSV_FILE", "")
+    config = xpath_config()
+    t = timer.record("config", t)
+
+    index, scanned = _open_corpus(html_dir, csv_file, config)
+    t = timer.record("csv" if csv_file else "scan", t)
+
+    coalesce = _env_flag("BOT_COALESCE_REPLIES")
+    ctx = BotContext(
+        token, gemini_api_key, gemini_model, index, html_dir,
+        limiter=RateLimiter.from_env(),
+        coalesce=coalesce,
+        gemini_cache=ResponseCache.from_env(),
+        csv_file=csv_file,
+        interaction_log=InteractionLog.from_env(),
+    )
+    install_config_reload(ctx)
+    metrics_port = _env_int("METRICS_PORT", 0)
+    if metrics_port:
+        host = os.getenv("METRICS_LISTEN", "127.0.0.1")
+        try:
+            ctx.metrics_server = start_metrics_server(host, metrics_port)
+            print(f"Metrics at http://{host}:{metrics_port}/metrics")
+        except OSError as e:
+            print(f"Metrics endpoint unavailable ({host}:{metrics_port}): {e}", file=sys.stderr)
+    timer.record("context", t)
+    print(f"Startup: {timer.report()}; index and Gemini client load in the background")
+    threading.Thread(
+        target=_background_startup, args=(ctx, scanned, config, timer), name="startup", daemon=True
+    ).start()
+    return ctx
+
+
+def _open_corpus(html_dir: str, csv_file: str, config: XPathConfig):
+    """Check the data source and return (index, scanned).
+
+    With EST_CSV_FILE the table is loaded right away and scanned is None;
+    otherwise the HTML tree is scanned and index is None (built later).
+    Exits with code 2 if the source is missing, 3 if it is empty.
+    """
+    if csv_file:
+        # Serve pre-extracted values; no HTML is read at all
+        try:
+            index = load_csv_index(csv_file, csv_column_map(), config)
+        except OSError as e:
+            print(f"ERROR: Cannot read CSV file {csv_file}: {e}", file=sys.stderr)
+            sys.exit(2)
+        if not len(index):
+            print(f"ERROR: No rows found in: {csv_file}", file=sys.stderr)
+            sys.exit(3)
+        print(f"Loaded {len(index)} pages from {csv_file}")
+        return index, None
+
+    if not os.path.isdir(html_dir):
+        print(f"ERROR: HTML directory not found: {html_dir}", file=sys.stderr)
+        sys.exit(2)
+    scanned = scan_html_files(html_dir)
+    if not scanned:
+        print(f"ERROR: No .html/.htm files found under: {html_dir}", file=sys.stderr)
+        sys.exit(3)
+    return None, scanned
+
+
+def _background_startup(ctx: BotContext, scanned, config: XPathConfig, timer: StartupTimer):
+    """Slow half of startup: build the corpus index, then create the Gemini client."""
+    if scanned is not None:
+        t = time.monotonic()
+        try:
+            index, reused, rebuilt = _load_index(ctx.html_dir, scanned, config)
+        except Exception as e:
+            print(f"ERROR: Building the corpus index failed: {e}", file=sys.stderr)
+            ctx.fail_index(e)
+        else:
+            ctx.set_index(index)
+            timer.record("index", t)
+            print(
+                f"Indexed {len(index)} HTML pages in {time.monotonic() - t:.2f}s "
+                f"(reused {reused}, rebuilt {rebuilt})"
+            )
+            ctx.watcher = CorpusWatcher.from_env(ctx)
+            if ctx.watcher is not None:
+                ctx.watcher.start()
+
+    # Create the shared Gemini client now so the first AI reply does not pay for it
+    t = time.monotonic()
+    try:
+        get_gemini_client(ctx.gemini_api_key)
+    except RuntimeError as e:
+        print(f"Warning: {e}", file=sys.stderr)
+    else:
+        timer.record("gemini client", t)
+        if _env_flag("GEMINI_WARMUP"):
+            t = time.monotonic()
+            ok, detail = gemini_health_check(ctx.gemini_api_key, ctx.gemini_model)
+            timer.record("gemini warm-up", t)
+            print(f"Gemini warm-up: {'ok' if ok else 'FAILED'} ({detail})")
+    print(f"Startup complete: {timer.report()}")
+
+
+def check() -> int:
+    """Validate configuration and the corpus without going online (python bot.py --check).
+
+    No network module is imported. Returns the process exit code: 0 if all is
+    well, 1 for configuration problems, 2/3 for a missing/empty corpus.
+    """
+    timer = StartupTimer()
+    t = time.monotonic()
+    problems = []
+    for name in ("TELEGRAM_BOT_TOKEN", "GEMINI_API_KEY"):
+        if not os.getenv(name):
+            problems.append(f"{name} is not set")
+    for name, value in xpath_settings().items():
+        if value and not _parse_simple_xpath(value):
+            problems.append(f"Invalid XPath in {name}: {value}")
+    config = xpath_config()
+    html_dir = os.getenv("EST_HTML_DIR", r"D:\SDK\estHTML")
+    csv_file = os.getenv("EST_CSV_FILE", "")
+    t = timer.record("config", t)
+
+    index, scanned = _open_corpus(html_dir, csv_file, config)
+    t = timer.record("csv" if csv_file else "scan", t)
+    if index is None:
+        # Only an explicitly configured or already existing cache is used; sqlite3 is not imported otherwise
+        cache_path = index_cache_path(html_dir)
+        if cache_path and not os.getenv("EST_INDEX_CACHE") and not os.path.exists(cache_path):
+            cache_path = None
+        index, reused, rebuilt = _load_index(html_dir, scanned, config, cache_path)
+        timer.record("index", t)
+        print(f"Indexed {len(index)} HTML pages (reused {reused}, rebuilt {rebuilt})")
+
+    pages = list(index.pages())
+    print(f"Pages: {len(pages)}; XPath columns: {len(index.columns)}")
+    print(f"  first-match value empty on {sum(not p.xpath_value for p in pages)} pages")
+    for name in config.named:
+        print(f"  {name} empty on {sum(not p.env_value(name) for p in pages)} pages")
+    print(f"Startup phases: {timer.report()}")
+    for problem in problems:
+        print(f"ERROR: {problem}", file=sys.stderr)
+    if problems:
+        return 1
+    print("Configuration OK")
+    return 0
+
+
+def main():
+    ctx = _startup()
+    token = ctx.token
+    checkpoint = UpdateCheckpoint.from_env(token)
+    dispatcher = UpdateDispatcher(
+        _checkpointed(lambda upd: handle_update(ctx, upd), checkpoint),
+        workers=_env_int("BOT_WORKERS", 4),
+        max_inflight=_env_int("BOT_MAX_INFLIGHT", 64),
+    )
+    METRICS.set_callback("bot_queue_depth", dispatcher.depth)
+
+    print("Telegram bot started. Waiting for messages...")
+    print(f"Serving random pages from: {ctx.source}")
+    if _resume_message(checkpoint):
+        print(_resume_message(checkpoint))
+
+    offset = None
+    if checkpoint is not None:
+        offset = checkpoint.offset
+        # Updates still in flight when the bot last stopped; Telegram has already forgotten them
+        for upd in checkpoint.replay():
+            dispatcher.submit(_update_chat_id(upd), upd)
+    try:
+        while True:
+            try:
+                updates = get_updates(token, offset)
+                for upd in updates:
+                    update_id = upd.get("update_id", 0)
+                    offset = max(offset or 0, update_id + 1)
+                    if checkpoint is not None and checkpoint.seen(update_id):
+                        METRICS.inc("bot_updates_duplicate_total")
+                        continue
+                    chat_id = _update_chat_id(upd)
+                    if not chat_id:
+                        if checkpoint is not None:
+                            checkpoint.done(update_id)
+                        continue
+                    if checkpoint is not None:
+                        checkpoint.accept(upd)
+                    # Blocks while the dispatcher is full
+                    dispatcher.submit(chat_id, upd)
+                if checkpoint is not None and offset is not None:
+                    # The next getUpdates confirms offset, so the accepted updates must be on disk first
+                    checkpoint.confirm(offset)
+                # Loop continues, long polling already waited
+            except KeyboardInterrupt:
+                print("Interrupted by user. Exiting...")
+                break
+            except Exception as e:
+                print(f"Error: {e}")
+                time.sleep(SLEEP_BETWEEN_ERRORS_SEC)
+    finally:
+        # Let already accepted updates finish (with a checkpoint, unfinished ones are redelivered)
+        dispatcher.shutdown(wait=True)
+        if checkpoint is not None:
+            checkpoint.close()
+        ctx.close()
+
+
+# ----- Webhook mode (python bot.py --webhook) -----
+_WEBHOOK_HANDLER = None
+
+
+def _webhook_handler_class():
+    """The HTTP request handler for WebhookServer, defined on first use so that
+    http.server is only imported in webhook mode."""
+    global _WEBHOOK_HANDLER
+    if _WEBHOOK_HANDLER is not None:
+        return _WEBHOOK_HANDLER
+    import hmac
+    from http.server import BaseHTTPRequestHandler
+
+    class _WebhookHandler(BaseHTTPRequestHandler):
+        # Bounds how long a stalled client (or TLS handshake) can hold its thread
+        timeout = 30
+
+        def setup(self):
+            self.handshake_failed = False
+            if hasattr(self.request, "do_handshake"):
+                # With use_tls the handshake is deferred from accept() to this connection's thread
+                self.request.settimeout(self.timeout)
+                try:
+                    self.request.do_handshake()
+                except OSError:
+                    self.handshake_failed = True
+            super().setup()
+
+        def handle(self):
+            if not self.handshake_failed:
+                super().handle()
+
+        def _respond(self, status: int, extra_headers: Optional[dict] = None):
+            self.send_response(status)
+            for k, v in (extra_headers or {}).items():
+                self.send_header(k, v)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_POST(self):
+            srv = self.server.webhook
+            if self.path.split("?", 1)[0] != srv.path:
+                self._respond(404)
+                return
+            if srv.secret and not hmac.compare_digest(
+                self.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), srv.secret
+            ):
+                self._respond(403)
+                return
+            try:
+                length = int(self.headers.get("Content-Length") or 0)
+                upd = json.loads(self.rfile.read(length).decode("utf-8"))
+            except Exception:
+                self._respond(400)
+                return
+            # Acknowledge as soon as the update is queued; handling happens on the workers.
+            # When the dispatcher is full, ask Telegram to redeliver later instead of blocking.
+            if srv.accept(upd):
+                self._respond(200)
+            else:
+                self._respond(429, {"Retry-After": "1"})
+
+        def log_message(self, format, *args):
+            pass
+
+    _WEBHOOK_HANDLER = _WebhookHandler
+    return _WebhookHandler
+
+
+class WebhookServer:
+    """Local HTTP server that receives Telegram update POSTs.
+
+    accept(update) must return quickly: True if the update was taken, False
+    to answer 429 so Telegram retries. Requests to other paths get 404, and
+    requests without the matching secret token header get 403.
+    """
+
+    def __init__(self, address, accept, path: str = "/telegram", secret: str = ""):
+        from http.server import ThreadingHTTPServer
+
+        self.accept = accept
+        self.path = path
+        self.secret = secret
+        self.httpd = ThreadingHTTPServer(address, _webhook_handler_class())
+        self.httpd.daemon_threads = True
+        self.httpd.webhook = self
+
+    @property
+    def server_address(self):
+        return self.httpd.server_address
+
+    def use_tls(self, cert: str, key: Optional[str] = None):
+        """Serve HTTPS directly with the given certificate (and key) files.
+
+        The TLS handshake runs on each connection's own thread, so a slow or
+        silent client cannot hold up accept() for everyone else.
+        """
+        import ssl
+
+        ssl_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_ctx.load_cert_chain(cert, key)
+        self.httpd.socket = ssl_ctx.wrap_socket(self.httpd.socket, server_side=True, do_handshake_on_connect=False)
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+
+    def server_close(self):
+        self.httpd.server_close()
+
+
+def set_webhook(token: str, url: str, secret: str = ""):
+    body = {"url": url, "allowed_updates": ["message", "edited_message"]}
+    if secret:
+        body["secret_token"] = secret
+    res = http_post_json(API_HOST, f"/bot{token}/setWebhook", body)
+    if not res.get("ok"):
+        raise RuntimeError(f"setWebhook failed: {res}")
+    return res
+
+
+def main_webhook():
+    """Alternative entry point: Telegram pushes updates to a local HTTP server."""
+    ctx = _startup()
+    # Telegram retries a webhook delivery until it gets a 200; the checkpoint drops such repeats
+    checkpoint = UpdateCheckpoint.from_env(ctx.token)
+    dispatcher = UpdateDispatcher(
+        _checkpointed(lambda upd: handle_update(ctx, upd), checkpoint),
+        workers=_env_int("BOT_WORKERS", 4),
+        max_inflight=_env_int("BOT_MAX_INFLIGHT", 64),
+    )
+    METRICS.set_callback("bot_queue_depth", dispatcher.depth)
+    if checkpoint is not None:
+        for upd in checkpoint.replay():
+            dispatcher.submit(_update_chat_id(upd), upd)
+
+    def accept(upd: dict) -> bool:
+        update_id = upd.get("update_id", 0)
+        if checkpoint is not None and checkpoint.seen(update_id):
+            METRICS.inc("bot_updates_duplicate_total")
+            return True
+        chat_id = _update_chat_id(upd)
+        if not chat_id:
+            return True
+        if checkpoint is None:
+            return dispatcher.submit(chat_id, upd, block=False)
+        checkpoint.accept(upd)
+        if dispatcher.submit(chat_id, upd, block=False):
+            return True
+        checkpoint.abandon(update_id)
+        return False
+
+    host = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+    port = _env_int("WEBHOOK_PORT", 8443)
+    path = os.getenv("WEBHOOK_PATH", "/telegram")
+    secret = os.getenv("WEBHOOK_SECRET", "")
+    server = WebhookServer((host, port), accept, path=path, secret=secret)
+    cert = os.getenv("WEBHOOK_CERT", "")
+    if cert:
+        # Serve HTTPS directly; otherwise terminate TLS in a reverse proxy
+        server.use_tls(cert, os.getenv("WEBHOOK_KEY") or None)
+
+    url = os.getenv("WEBHOOK_URL", "")
+    if url:
+        set_webhook(ctx.token, url, secret)
+
+    print(f"Telegram bot started (webhook). Listening on {host}:{port}{path}")
+    print(f"Serving random pages from: {ctx.source}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Interrupted by user. Exiting...")
+    finally:
+        server.server_close()
+        dispatcher.shutdown(wait=True)
+        if checkpoint is not None:
+            checkpoint.close()
+        ctx.close()
+
+
+# ----- asyncio runtime (python bot.py --async) -----
+class AsyncHTTPSConnection:
+    """A single keep-alive HTTP/1.1 connection over asyncio streams.
+
+    Only what the Telegram Bot API needs: one request at a time, responses
+    delimited by Content-Length, chunked encoding or connection close.
+    """
+
+    def __init__(self, host: str, timeout: float, port: int = 443, use_ssl: bool = True):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.use_ssl = use_ssl
+        self._reader = None
+        self._writer = None
+        self._answered = False  # some response bytes were read in the current exchange
+
+    async def _open(self):
+        import asyncio
+
+        self._reader, self._writer = await asyncio.open_connection(
+            self.host, self.port, ssl=True if self.use_ssl else None
+        )
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def request(self, method: str, path: str, body: bytes = b"", headers: Optional[dict] = None) -> Tuple[int, bytes]:
+        return (await self.pipeline([(method, path, body, headers)]))[0]
+
+    async def pipeline(self, requests: List[tuple]) -> List[Tuple[int, bytes]]:
+        """Write all (method, path, body, headers) requests, then read the responses in order.
+
+        Resending follows HTTPSConnectionPool.pipeline: only when a reused
+        socket fails before any response bytes arrive; after that, unanswered
+        requests get status 0.
+        """
+        import asyncio
+
+        results: List[Tuple[int, bytes]] = []
+        reused = self._writer is not None and not self._writer.is_closing()
+        while len(results) < len(requests):
+            pending = requests[len(results):]
+            self._answered = False
+            try:
+                if not reused:
+                    self.close()
+                    await self._open()
+                await asyncio.wait_for(self._exchange(pending, results), self.timeout)
+            except Exception as e:
+                self.close()
+                stale = isinstance(e, _stale_conn_errors() + (asyncio.IncompleteReadError,))
+                if not (reused and stale and not self._answered):
+                    if not results:
+                        raise
+                    return results + [(0, b"")] * (len(requests) - len(results))
+                # Stale keep-alive socket: nothing was processed, send again on a fresh connection
+            except BaseException:
+                self.close()
+                raise
+            # Either a stale socket or the server closed after a response: reconnect
+            reused = self._writer is not None
+        return results
+
+    async def _exchange(self, pending: List[tuple], results: List[Tuple[int, bytes]]):
+        self._writer.write(b"".join(_encode_request(self.host, *r) for r in pending))
+        await self._writer.drain()
+        for _ in pending:
+            status, headers, data = await self._read_response()
+            results.append((status, data))
+            if headers.get("connection", "").lower() == "close":
+                self.close()
+                return
+
+    async def _read_response(self) -> Tuple[int, dict, bytes]:
+        status_line = await self._reader.readline()
+        if not status_line:
+            raise ConnectionResetError("connection closed by server")
+        self._answered = True
+        status = int(status_line.split()[1])
+        resp_headers = {}
+        while True:
+            line = await self._reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            k, _, v = line.decode("latin-1").partition(":")
+            resp_headers[k.strip().lower()] = v.strip()
+
+        if "chunked" in resp_headers.get("transfer-encoding", "").lower():
+            parts = []
+            while True:
+                size = int((await self._reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    await self._reader.readline()
+                    break
+                parts.append(await self._reader.readexactly(size))
+                await self._reader.readline()
+            data = b"".join(parts)
+        elif "content-length" in resp_headers:
+            data = await self._reader.readexactly(int(resp_headers["content-length"]))
+        else:
+            data = await self._reader.read()
+            resp_headers["connection"] = "close"
+        return status, resp_headers, data
+
+
+class AsyncTelegramClient:
+    """Non-blocking Bot API client: one connection for long polling and a
+    small pool of keep-alive connections for sends."""
+
+    def __init__(
+        self,
+        token: str,
+        host: str = API_HOST,
+        pool_size: int = 4,
+        port: int = 443,
+        use_ssl: bool = True,
+        limiter: Optional[RateLimiter] = None,
+        coalesce: bool = False,
+    ):
+        self.token = token
+        self.limiter = limiter or RateLimiter()
+        self.coalesce = coalesce
+        self._poll = AsyncHTTPSConnection(host, POLL_TIMEOUT_SEC + 10, port, use_ssl)
+        self._idle = []
+        self._make = lambda: AsyncHTTPSConnection(host, 60, port, use_ssl)
+        self._pool_size = max(1, pool_size)
+
+    async def _call(self, conn: AsyncHTTPSConnection, method: str, body_obj: Optional[dict], params: Optional[dict] = None):
+        path = f"/bot{self.token}/{method}"
+        if params:
+            path = f"{path}?{urlencode(params)}"
+        if body_obj is None:
+            status, data = await conn.request("GET", path)
+        else:
+            body = json.dumps(body_obj).encode("utf-8")
+            status, data = await conn.request(
+                "POST", path, body, {"Content-Type": "application/json; charset=utf-8"}
+            )
+        if status != 200:
+            raise RuntimeError(f"HTTP {status}: {data[:200]!r}")
+        res = json.loads(data.decode("utf-8"))
+        if not res.get("ok"):
+            raise RuntimeError(f"{method} failed: {res}")
+        return res
+
+    async def get_updates(self, offset):
+        params = {"timeout": POLL_TIMEOUT_SEC}
+        if offset is not None:
+            params["offset"] = offset
+        with METRICS.time("bot_get_updates_seconds"):
+            res = await self._call(self._poll, "getUpdates", None, params)
+        return res["result"]
+
+    async def edit_message_text(self, chat_id: int, message_id: int, text: str):
+        if len(text) > 4096:
+            text = text[:4093] + "..."
+        conn = self._idle.pop() if self._idle else self._make()
+        try:
+            with METRICS.time("bot_telegram_send_seconds", kind="edit"):
+                return await self._call(
+                    conn, "editMessageText", {"chat_id": chat_id, "message_id": message_id, "text": text}
+                )
+        finally:
+            self._release(conn)
+
+    async def send_message(self, chat_id: int, text: str):
+        # Telegram messages have a 4096 character limit for text
+        if len(text) > 4096:
+            text = text[:4093] + "..."
+        conn = self._idle.pop() if self._idle else self._make()
+        try:
+            with METRICS.time("bot_telegram_send_seconds", kind="single"):
+                res = await self._call(conn, "sendMessage", {"chat_id": chat_id, "text": text})
+        except Exception:
+            METRICS.inc("bot_telegram_messages_total", result="failed")
+            raise
+        finally:
+            self._release(conn)
+        METRICS.inc("bot_telegram_messages_total", result="ok")
+        return res
+
+    def _release(self, conn: AsyncHTTPSConnection):
+        if len(self._idle) < self._pool_size:
+            self._idle.append(conn)
+        else:
+            conn.close()
+
+    async def send_batch(self, chat_id, texts: List[str]) -> List[bool]:
+        """asyncio counterpart of MessageSender.send_batch."""
+        import asyncio
+
+        texts = _prepare_batch(texts, self.coalesce)
+        if not texts:
+            return []
+        wait = self.limiter.reserve(chat_id, len(texts))
+        if wait > 0:
+            await asyncio.sleep(wait)
+        path = f"/bot{self.token}/sendMessage"
+        headers = {"Content-Type": "application/json; charset=utf-8"}
+
+        def request(text: str) -> tuple:
+            return ("POST", path, json.dumps({"chat_id": chat_id, "text": text}).encode("utf-8"), headers)
+
+        conn = self._idle.pop() if self._idle else self._make()
+        try:
+            with METRICS.time("bot_telegram_send_seconds", kind="batch"):
+                responses = await conn.pipeline([request(t) for t in texts])
+            ok = [status == 200 for status, _ in responses]
+            retry = [i for i, (status, data) in enumerate(responses) if _retry_after(status, data) is not None]
+            if retry:
+                METRICS.inc("bot_telegram_retry_after_total", len(retry))
+                await asyncio.sleep(max(_retry_after(*responses[i]) for i in retry))
+                with METRICS.time("bot_telegram_send_seconds", kind="batch"):
+                    resent = await conn.pipeline([request(texts[i]) for i in retry])
+                for i, (status, _) in zip(retry, resent):
+                    ok[i] = status == 200
+            _count_sent(ok)
+            return ok
+        finally:
+            self._release(conn)
+
+    def close(self):
+        self._poll.close()
+        for conn in self._idle:
+            conn.close()
+        self._idle = []
+
+
+async def gemini_generate_async(
+    api_key: str,
+    model: str,
+    user_text: str,
+    xpath_value: str,
+    prompt_template: Optional[str] = None,
+    extra_vars: Optional[dict] = None,
+    cache: Optional[ResponseCache] = None,
+    breaker: Optional[CircuitBreaker] = None,
+) -> str:
+    """Same as gemini_generate, using the SDK's native async API (client.aio)."""
+    contents = _format_prompt(user_text, xpath_value, prompt_template, extra_vars)
+    cache_key = ResponseCache.key(model, contents) if cache is not None else None
+    if cache_key is not None:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached
+    try:
+        client = get_gemini_client(api_key)
+        target = MODEL_RESOLVER.resolve(model)
+        try:
+            response = await client.aio.models.generate_content(model=target, contents=contents)
+        except Exception as e:
+            if not _is_model_not_found(e) or target == GEMINI_FALLBACK_MODEL:
+                raise
+            MODEL_RESOLVER.mark_bad(target)
+            METRICS.inc("bot_gemini_model_fallback_total")
+            response = await client.aio.models.generate_content(model=GEMINI_FALLBACK_MODEL, contents=contents)
+    except Exception:
+        if breaker is not None:
+            breaker.failure()
+        raise
+    if breaker is not None:
+        breaker.success()
+    text = _response_text(response)
+    if cache_key is not None and text:
+        cache.put(cache_key, text)
+    return text
+
+
+async def _gemini_reply_async(ctx: BotContext, job: UpdateJob) -> str:
+    """asyncio counterpart of _gemini_reply; the pending call is a Task.
+
+    Nothing queues here, so a call still running at the deadline is only
+    cancelled if its reply would be discarded anyway (BOT_LATE_REPLY=discard).
+    """
+    import asyncio
+
+    call = gemini_generate_async(
+        ctx.gemini_api_key,
+        ctx.gemini_model,
+        job.user_text,
+        job.xpath_value,
+        prompt_template=None,
+        extra_vars=job.extra_vars,
+        cache=ctx.gemini_cache,
+        breaker=ctx.gemini_breaker,
+    )
+    if job.deadline is None:
+        return await call
+    task = asyncio.ensure_future(call)
+    done, _ = await asyncio.wait({task}, timeout=max(0.0, job.deadline - time.monotonic()))
+    if not done:
+        # The call is waiting on the API (nothing queues here): count it as a failure now
+        ctx.gemini_breaker.failure()
+        if ctx.late_reply == "discard":
+            task.cancel()
+        raise ReplyDeadlineExceeded(task)
+    return task.result()
+
+
+_LATE_TASKS = set()  # keeps late-reply tasks alive until they finish
+
+
+async def _late_reply_async(ctx: BotContext, client: AsyncTelegramClient, chat_id, task, message_id):
+    import asyncio
+
+    try:
+        text = await task
+    except asyncio.CancelledError:
+        if not task.cancelled():
+            raise  # this coroutine itself is being cancelled
+        METRICS.inc("bot_gemini_late_total", outcome="cancelled")
+        return
+    except Exception:
+        text = None
+    if not text or ctx.late_reply == "discard":
+        METRICS.inc("bot_gemini_late_total", outcome="discarded" if text else "failed")
+        return
+    try:
+        if ctx.late_reply == "edit" and message_id is not None:
+            await client.edit_message_text(chat_id, message_id, text)
+            outcome = "edited"
+        else:
+            await client.send_message(chat_id, text)
+            outcome = "sent"
+    except Exception as e:
+        print(f"Late AI reply not delivered: {e}", file=sys.stderr)
+        outcome = "failed"
+    METRICS.inc("bot_gemini_late_total", outcome=outcome)
+
+
+async def _deliver_before_ai_async(ctx: BotContext, client: AsyncTelegramClient, job: UpdateJob, task):
+    import asyncio
+
+    fallback = job.fallback_text()
+    message_id = None
+    if ctx.late_reply == "edit" and fallback:
+        t0 = time.monotonic()
+        try:
+            message_id = (await client.send_message(job.chat_id, fallback))["result"]["message_id"]
+        except Exception:
+            pass
+        try:
+            await client.send_batch(job.chat_id, job.follow_up_texts())
+        except Exception:
+            pass
+        job.timings["send"] = time.monotonic() - t0
+    else:
+        await _deliver_async(client, job, fallback)
+    late = asyncio.ensure_future(_late_reply_async(ctx, client, job.chat_id, task, message_id))
+    _LATE_TASKS.add(late)
+    late.add_done_callback(_LATE_TASKS.discard)
+
+
+async def _deliver_async(client: AsyncTelegramClient, job: UpdateJob, reply_text: str) -> bool:
+    # Empty texts are dropped from the batch, so the main reply is message 0 only if there is one
+    main = 0 if reply_text else None
+    t0 = time.monotonic()
+    try:
+        results = await client.send_batch(job.chat_id, [reply_text] + job.follow_up_texts())
+    except Exception:
+        return False
+    finally:
+        job.timings["send"] = time.monotonic() - t0
+    return main is not None and main < len(results) and results[main]
+
+
+async def handle_update_async(ctx: BotContext, client: AsyncTelegramClient, upd: dict):
+    """asyncio counterpart of handle_update with the same routing."""
+    if not ctx.index_ready:
+        import asyncio
+
+        # Wait for the background index build without blocking the event loop
+        await asyncio.get_event_loop().run_in_executor(None, ctx.wait_index)
+    job = prepare_update(ctx, upd)
+    if job is None:
+        return
+    METRICS.inc("bot_updates_total")
+    t0 = time.monotonic()
+    route = "plain"
+    ai_text = None
+    try:
+        if not job.use_ai:
+            await _deliver_async(client, job, job.fallback_text())
+            return
+        if not ctx.gemini_breaker.allow():
+            route = "ai_skipped"
+            await _deliver_async(client, job, job.fallback_text())
+            return
+        route = "ai"
+        t_ai = time.monotonic()
+        try:
+            ai_text = await _gemini_reply_async(ctx, job)
+        except ReplyDeadlineExceeded as late:
+            job.timings["gemini"] = time.monotonic() - t_ai
+            METRICS.observe("bot_gemini_seconds", job.timings["gemini"], outcome="timeout")
+            route = "ai_timeout"
+            await _deliver_before_ai_async(ctx, client, job, late.pending)
+            return
+        except Exception as e:
+            job.timings["gemini"] = time.monotonic() - t_ai
+            METRICS.observe("bot_gemini_seconds", job.timings["gemini"], outcome="error")
+            route = "ai_error"
+            print(f"Gemini error: {e}", file=sys.stderr)
+            await _deliver_async(client, job, job.fallback_text())
+            return
+        job.timings["gemini"] = time.monotonic() - t_ai
+        METRICS.observe("bot_gemini_seconds", job.timings["gemini"], outcome="ok")
+        if not await _deliver_async(client, job, ai_text or job.fallback_text()):
+            route = "ai_undelivered"
+            reply_text = job.fallback_text()
+            if reply_text:
+                try:
+                    await client.send_message(job.chat_id, reply_text)
+                except Exception:
+                    pass
+    finally:
+        total = time.monotonic() - t0
+        METRICS.observe("bot_update_seconds", total, route=route)
+        if ctx.interaction_log is not None:
+            ctx.interaction_log.log(_interaction_record(job, route, ai_text, total))
+
+
+class AsyncUpdateDispatcher:
+    """asyncio counterpart of UpdateDispatcher: one task per busy chat,
+    per-chat FIFO order and a cap on queued+running updates."""
+
+    def __init__(self, handler, max_inflight: int = 64):
+        import asyncio
+
+        self._handler = handler
+        self._slots = asyncio.Semaphore(max(1, max_inflight))
+        self._queues = {}
+        self._tasks = set()
+        self._loop = asyncio.get_event_loop()
+        self._depth = 0
+
+    def depth(self) -> int:
+        """Updates queued or running."""
+        return self._depth
+
+    async def submit(self, chat_id, upd: dict):
+        await self._slots.acquire()
+        self._depth += 1
+        q = self._queues.get(chat_id)
+        if q is not None:
+            q.append(upd)
+            return
+        self._queues[chat_id] = deque([upd])
+        task = self._loop.create_task(self._drain(chat_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _drain(self, chat_id):
+        q = self._queues[chat_id]
+        while q:
+            upd = q.popleft()
+            try:
+                await self._handler(upd)
+            except Exception as e:
+                print(f"Error: {e}")
+            finally:
+                self._depth -= 1
+                self._slots.release()
+        del self._queues[chat_id]
+
+    async def join(self):
+        import asyncio
+
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+
+async def main_async():
+    """Alternative entry point: polling, sends and Gemini calls all overlap on one event loop."""
+    import asyncio
+
+    ctx = _startup()
+    host, _, port = API_HOST.partition(":")
+    client = AsyncTelegramClient(
+        ctx.token,
+        host=host,
+        port=int(port) if port else (443 if API_TLS else 80),
+        use_ssl=API_TLS,
+        pool_size=_env_int("TELEGRAM_POOL_SIZE", 4),
+        limiter=ctx.limiter,
+        coalesce=ctx.coalesce,
+    )
+    checkpoint = UpdateCheckpoint.from_env(ctx.token)
+
+    async def handle(upd: dict):
+        try:
+            await handle_update_async(ctx, client, upd)
+        finally:
+            if checkpoint is not None:
+                checkpoint.done(upd.get("update_id", 0))
+
+    dispatcher = AsyncUpdateDispatcher(handle, max_inflight=_env_int("BOT_MAX_INFLIGHT", 64))
+    METRICS.set_callback("bot_queue_depth", dispatcher.depth)
+
+    print("Telegram bot started (asyncio). Waiting for messages...")
+    print(f"Serving random pages from: {ctx.source}")
+    if _resume_message(checkpoint):
+        print(_resume_message(checkpoint))
+
+    # Same offset handling as main()
+    offset = None
+    if checkpoint is not None:
+        offset = checkpoint.offset
+        for upd in checkpoint.replay():
+            await dispatcher.submit(_update_chat_id(upd), upd)
+    try:
+        while True:
+            try:
+                updates = await client.get_updates(offset)
+                for upd in updates:
+                    update_id = upd.get("update_id", 0)
+                    offset = max(offset or 0, update_id + 1)
+                    if checkpoint is not None and checkpoint.seen(update_id):
+                        METRICS.inc("bot_updates_duplicate_total")
+                        continue
+                    chat_id = _update_chat_id(upd)
+                    if not chat_id:
+                        if checkpoint is not None:
+                            checkpoint.done(update_id)
+                        continue
+                    if checkpoint is not None:
+                        checkpoint.accept(upd)
+                    await dispatcher.submit(chat_id, upd)
+                if checkpoint is not None and offset is not None:
+                    await asyncio.get_event_loop().run_in_executor(None, checkpoint.confirm, offset)
+            except Exception as e:
+                print(f"Error: {e}")
+                await asyncio.sleep(SLEEP_BETWEEN_ERRORS_SEC)
+    finally:
+        await dispatcher.join()
+        client.close()
+        if checkpoint is not None:
+            checkpoint.close()
+        ctx.close()
+
+
+if __name__ == "__main__":
+    if "--check" in sys.argv[1:]:
+        sys.exit(check())
+    elif "--webhook" in sys.argv[1:]:
+        main_webhook()
+    elif "--async" in sys.argv[1:]:
+        import asyncio
+
+        try:
+            asyncio.run(main_async())
+        except KeyboardInterrupt:
+            print("Interrupted by user. Exiting...")
+    else:
+        main()
@@ -0,0 +1,164 @@
+"""Extract XPath values from a whole HTML corpus into a CSV table.
+
+Usage:
+  python extract_corpus.py HTML_DIR OUT.csv [--workers N] [--column NAME=XPATH ...] [--full]
+
+Without --column the table has the layout of the estekhareh plugin's source.csv:
+filename,xp1m,xp2,xp3,xp4 (the DEFAULT_1..4 XPaths used by the bot).
+
+Pages are parsed in parallel on a process pool and rows are streamed to the
+output file in filename order. A small state file next to the output
+(OUT.csv.state.json) remembers each page's modification time and size, so a
+re-run only parses new or changed pages and copies the other rows over.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from bot import CSV_DEFAULT_COLUMNS, _parse_simple_xpath, extract_paths, scan_html_files
+
+PROGRESS_EVERY_SEC = 2.0
+
+_worker_specs: List[Tuple[Tuple[str, int], ...]] = []
+
+
+def _init_worker(specs):
+    global _worker_specs
+    _worker_specs = specs
+
+
+def _extract_file(path: str) -> Tuple[List[str], int]:
+    """Runs in a worker process: (values, bytes read) for one page."""
+    try:
+        with open(path, "rb") as fh:
+            data = fh.read()
+    except OSError:
+        # Same as the bot's index: unreadable pages get empty values
+        return [""] * len(_worker_specs), 0
+    return extract_paths(data, _worker_specs), len(data)
+
+
+def default_columns() -> List[Tuple[str, str]]:
+    return list(CSV_DEFAULT_COLUMNS)
+
+
+def parse_column(arg: str) -> Tuple[str, str]:
+    name, sep, xpath = arg.partition("=")
+    if not sep or not name.strip() or not _parse_simple_xpath(xpath):
+        raise argparse.ArgumentTypeError(f"expected NAME=XPATH, got {arg!r}")
+    return name.strip(), xpath.strip()
+
+
+def _relative_name(root: str, path: str) -> str:
+    return os.path.relpath(path, root).replace(os.sep, "/")
+
+
+def _load_previous(out_path: str, state_path: str, columns) -> Tuple[Dict[str, list], Dict[str, List[str]]]:
+    """Stamps and rows of the previous run, or empty dicts if it cannot be reused."""
+    try:
+        with open(state_path, "r", encoding="utf-8") as fh:
+            state = json.load(fh)
+        if state.get("columns") != [list(c) for c in columns]:
+            return {}, {}
+        with open(out_path, "r", encoding="utf-8", newline="") as fh:
+            reader = csv.reader(fh)
+            next(reader, None)  # header
+            rows = {row[0]: row[1:] for row in reader if len(row) == len(columns) + 1}
+    except (OSError, ValueError):
+        return {}, {}
+    return state.get("files") or {}, rows
+
+
+def extract_corpus(
+    html_dir: str,
+    out_path: str,
+    columns: List[Tuple[str, str]],
+    workers: Optional[int] = None,
+    full: bool = False,
+) -> dict:
+    """Write the CSV table for html_dir and return run statistics."""
+    t0 = time.monotonic()
+    specs = [tuple(_parse_simple_xpath(xp)) for _, xp in columns]
+    scanned = sorted(
+        (_relative_name(html_dir, path), path, mtime_ns, size)
+        for path, mtime_ns, size in scan_html_files(html_dir)
+    )
+    state_path = out_path + ".state.json"
+    old_stamps, old_rows = ({}, {}) if full else _load_previous(out_path, state_path, columns)
+
+    todo = []
+    for name, path, mtime_ns, size in scanned:
+        if old_stamps.get(name) != [mtime_ns, size] or name not in old_rows:
+            todo.append(path)
+
+    stats = {"pages": len(scanned), "extracted": len(todo), "reused": len(scanned) - len(todo), "bytes": 0}
+    workers = workers or os.cpu_count() or 1
+    tmp_path = out_path + ".tmp"
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(specs,)) as pool:
+        # map() yields in submission order, so rows stream out sorted by filename
+        results = pool.map(_extract_file, todo, chunksize=max(1, min(64, len(todo) // (workers * 4) or 1)))
+        done = 0
+        next_report = time.monotonic() + PROGRESS_EVERY_SEC
+        with open(tmp_path, "w", encoding="utf-8", newline="") as fh:
+            writer = csv.writer(fh)
+            writer.writerow(["filename"] + [name for name, _ in columns])
+            for name, path, mtime_ns, size in scanned:
+                if old_stamps.get(name) == [mtime_ns, size] and name in old_rows:
+                    writer.writerow([name] + old_rows[name])
+                    continue
+                values, nbytes = next(results)
+                writer.writerow([name] + values)
+                stats["bytes"] += nbytes
+                done += 1
+                if time.monotonic() >= next_report:
+                    next_report += PROGRESS_EVERY_SEC
+                    rate = done / (time.monotonic() - t0)
+                    print(f"  {done}/{len(todo)} pages parsed ({rate:.0f} pages/s)", file=sys.stderr)
+
+    os.replace(tmp_path, out_path)
+    with open(state_path, "w", encoding="utf-8") as fh:
+        json.dump(
+            {
+                "columns": [list(c) for c in columns],
+                "files": {name: [mtime_ns, size] for name, _, mtime_ns, size in scanned},
+            },
+            fh,
+        )
+    stats["seconds"] = time.monotonic() - t0
+    stats["workers"] = workers
+    return stats
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Extract XPath values from an HTML corpus into a CSV table.")
+    parser.add_argument("html_dir", help="directory scanned recursively for .html/.htm files")
+    parser.add_argument("out", help="output CSV file")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument(
+        "--column", dest="columns", action="append", type=parse_column, metavar="NAME=XPATH",
+        help="output column (repeatable); default: xp1m,xp2,xp3,xp4 = DEFAULT_1..4",
+    )
+    parser.add_argument("--full", action="store_true", help="ignore the previous run and parse every page")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.html_dir):
+        print(f"ERROR: HTML directory not found: {args.html_dir}", file=sys.stderr)
+        return 2
+    stats = extract_corpus(args.html_dir, args.out, args.columns or default_columns(), args.workers, args.full)
+    secs = max(stats["seconds"], 1e-9)
+    print(
+        f"Wrote {stats['pages']} rows to {args.out} in {secs:.2f}s "
+        f"(parsed {stats['extracted']}, reused {stats['reused']}; "
+        f"{stats['extracted'] / secs:.0f} pages/s, {stats['bytes'] / secs / 1e6:.1f} MB/s, "
+        f"{stats['workers']} workers)"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,642 @@
+"""Tests for bot.py against the local Telegram/Gemini stand-ins from bench.py.
+
+Run with:  python -m pytest -q   (or: python -m unittest test_bot)
+
+Nothing leaves the machine: bot.py is pointed at bench.FakeTelegram through
+TELEGRAM_API_URL, which bot.py reads at import, so the fake server is started
+and the environment prepared before bot is imported.
+"""
+import http.client
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import bench
+
+FAKE = bench.FakeTelegram()
+TMP = tempfile.mkdtemp(prefix="bottest-")
+CORPUS = bench.generate_corpus(os.path.join(TMP, "html"), 20)
+os.environ.update(
+    TELEGRAM_BOT_TOKEN="test",
+    GEMINI_API_KEY="test",
+    TELEGRAM_API_URL=FAKE.url,
+    EST_HTML_DIR=CORPUS,
+    EST_INDEX_CACHE="off",
+    TELEGRAM_CHAT_RATE="0",
+    TELEGRAM_GLOBAL_RATE="0",
+    xGeneral="/html/body/div[7]/p",
+)
+bench.install_fake_genai(0.0)
+
+import bot  # noqa: E402  (TELEGRAM_API_URL is read at import)
+
+
+def tearDownModule():
+    FAKE.server.shutdown()
+    shutil.rmtree(TMP, ignore_errors=True)
+
+
+def wait_for(predicate, timeout: float = 10.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return predicate()
+
+
+def message_update(update_id: int, chat_id: int, text: str) -> dict:
+    return {"update_id": update_id, "message": {"chat": {"id": chat_id, "first_name": "Test"}, "text": text}}
+
+
+class _CuttingServer:
+    """Raw HTTP server: answers the first request on a connection, then sends
+    `cut` (part of a response) for the next batch and closes."""
+
+    OK = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n{}"
+
+    def __init__(self, cut: bytes):
+        self.cut = cut
+        self.requests = 0
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(8)
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _read_requests(self, conn, count: int = 0) -> int:
+        data = b""
+        conn.settimeout(0.3)
+        try:
+            while count == 0 or data.count(b"\r\n\r\n") < count:
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        except socket.timeout:
+            pass
+        self.requests += data.count(b"\r\n\r\n")
+        return data.count(b"\r\n\r\n")
+
+    def _serve(self):
+        first = True
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with conn:
+                if first:
+                    first = False
+                    self._read_requests(conn, 1)
+                    conn.sendall(self.OK)
+                    self._read_requests(conn)
+                    conn.sendall(self.cut)
+                else:
+                    conn.sendall(self.OK * self._read_requests(conn))
+
+    def close(self):
+        self.sock.close()
+
+
+class PipelineTest(unittest.TestCase):
+    """sendMessage is not idempotent: a batch must not be sent twice after a partial answer."""
+
+    BATCH = [("POST", "/botx/sendMessage", b"", {})] * 3
+    CUT = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n{"
+
+    def run_pipeline(self, cut: bytes, use_async: bool):
+        server = self.server = _CuttingServer(cut)
+        self.addCleanup(server.close)
+        if use_async:
+            import asyncio
+
+            conn = bot.AsyncHTTPSConnection("127.0.0.1", 5, server.port, use_ssl=False)
+
+            async def run():
+                await conn.request("POST", "/botx/getMe")
+                try:
+                    return await conn.pipeline(self.BATCH)
+                finally:
+                    conn.close()
+
+            return server, asyncio.run(run())
+        pool = bot.HTTPSConnectionPool(f"127.0.0.1:{server.port}", 5, use_tls=False)
+        pool.request("POST", "/botx/getMe")
+        try:
+            return server, pool.pipeline(self.BATCH)
+        finally:
+            pool.close()
+
+    def test_unanswered_requests_are_not_resent(self):
+        for use_async in (False, True):
+            with self.subTest(use_async=use_async):
+                # One full response, then one cut off in its body
+                server, results = self.run_pipeline(_CuttingServer.OK + self.CUT, use_async)
+                self.assertEqual([status for status, _ in results], [200, 0, 0])
+                self.assertEqual(server.requests, 4, "requests were sent again")
+
+    def test_batch_with_a_cut_response_is_not_resent(self):
+        for use_async in (False, True):
+            with self.subTest(use_async=use_async):
+                with self.assertRaises(Exception):
+                    self.run_pipeline(self.CUT, use_async)
+                self.assertEqual(self.server.requests, 4, "requests were sent again")
+
+
+class ExtractPathsTest(unittest.TestCase):
+    """The streaming extract_paths must give what the reference tree
+    (_SimpleHTMLTree + _find_nth_child + _collect_text) gives."""
+
+    TAGS = ["div", "span", "p", "b", "br", "img", "html", "body", "i", "script", "DIV"]
+    TEXTS = ["txt", " a ", "&amp;", "&#1605;", "\n", "x&y", "\u0645\u0631\u062d\u0628\u0627", "  "]
+    XPATHS = [
+        "/html/body/div[1]/div[2]/span", "/html/body/div[2]/div[2]/span", "/html/body/div[4]/div[2]/span",
+        "/html/body/div[7]/p", "/html", "/html/body", "/html/body/div[2]", "/div", "/span/b", "/div[2]/span",
+        "/p", "/html/body/div[1]",
+    ]
+
+    def generate(self, rng: random.Random, depth: int = 0) -> str:
+        """Random markup with unclosed, stray and mismatched end tags."""
+        out = []
+        for _ in range(rng.randint(0, 6 if depth < 5 else 1)):
+            r = rng.random()
+            if r < 0.3:
+                out.append(rng.choice(self.TEXTS))
+            elif r < 0.35:
+                out.append("<!-- c -->")
+            elif r < 0.4:
+                out.append("</" + rng.choice(self.TAGS) + ">")
+            elif r < 0.45:
+                out.append("<br/>")
+            else:
+                tag = rng.choice(self.TAGS)
+                if tag == "script":
+                    out.append("<script>if (a<b) x='</div>';</script>")
+                    continue
+                end = f"</{tag}>" if rng.random() < 0.85 else ""
+                out.append(f"<{tag} class='c'>{self.generate(rng, depth + 1)}{end}")
+        return "".join(out)
+
+    def page(self, rng: random.Random, i: int) -> bytes:
+        html = self.generate(rng)
+        if i % 3 == 0:
+            blocks = "".join(
+                f"<div>{self.generate(rng, 3)}<div>{self.generate(rng, 4)}</div>"
+                f"<div><span>v{n}{self.generate(rng, 4)}</span></div></div>"
+                for n in range(8)
+            )
+            html = f"<html><body>{blocks}{html}</body></html>"
+        # Invalid UTF-8 at the end is dropped by both
+        return html.encode("utf-8") + (b"\xff\xfe" if i % 7 == 0 else b"")
+
+    @staticmethod
+    def reference(html: bytes, spec) -> str:
+        tree = bot._SimpleHTMLTree()
+        tree.feed(html.decode("utf-8", errors="ignore"))
+        node = tree.root
+        for tag, idx in spec:
+            node = bot._find_nth_child(node, tag, idx)
+            if node is None:
+                return ""
+        return bot._collect_text(node)
+
+    def check(self, chunk: int, pages: int):
+        rng = random.Random(chunk)
+        specs = [bot._parse_simple_xpath(xp) for xp in self.XPATHS]
+        with mock.patch.object(bot, "_EXTRACT_CHUNK", chunk):
+            for i in range(pages):
+                html = self.page(rng, i)
+                expected = [self.reference(html, spec) for spec in specs]
+                self.assertEqual(bot.extract_paths(html, specs), expected, html[:300])
+
+    def test_matches_reference_tree(self):
+        self.check(bot._EXTRACT_CHUNK, 300)
+
+    def test_matches_reference_tree_in_small_chunks(self):
+        # Chunk boundaries inside tags, character references and multi-byte characters
+        self.check(7, 150)
+        self.check(1, 60)
+
+    def test_extract_page_parses_once(self):
+        with open(os.path.join(CORPUS, "1.html"), "rb") as fh:
+            html = fh.read()
+        with mock.patch.object(bot, "extract_paths", wraps=bot.extract_paths) as parse:
+            page = bot.extract_page(html)
+        self.assertEqual(parse.call_count, 1)
+        self.assertEqual(page.xpath_value, bot.extract_span_text_for_fixed_xpath(html))
+        self.assertEqual(page.env_value("xGeneral"), bot._extract_text_for_env_xpath(html, "xGeneral"))
+        self.assertEqual(page.defaults_values(), bot._build_defaults_values(html))
+        self.assertEqual(page.defaults_list(), bot._extract_defaults_list(html))
+
+
+class HandleUpdateTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.ctx = bot._startup()
+        cls.ctx.wait_index()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.ctx.close()
+
+    def handle(self, upd: dict) -> "bot.UpdateJob":
+        jobs = []
+        prepare = bot.prepare_update
+
+        def capture(ctx, upd):
+            jobs.append(prepare(ctx, upd))
+            return jobs[-1]
+
+        with mock.patch.object(bot, "prepare_update", capture):
+            bot.handle_update(self.ctx, upd)
+        return jobs[0]
+
+    def test_empty_ai_reply_is_replaced_by_fallback_before_follow_ups(self):
+        with mock.patch.object(bot, "gemini_generate", lambda *a, **k: ""):
+            job = self.handle(message_update(10, 601, "hello!?"))
+        follow_ups = [t for t in job.follow_up_texts() if t]
+        self.assertTrue(follow_ups)
+        self.assertEqual(FAKE.texts[601], [job.fallback_text()] + follow_ups)
+
+
+@unittest.skipUnless(hasattr(signal, "SIGHUP"), "SIGHUP is not available")
+class ConfigReloadTest(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(TMP, "reload.env")
+        with open(self.path, "w", encoding="utf-8") as fh:
+            fh.write("xGeneral=/html/body/div[7]/p\n")
+
+    def tearDown(self):
+        bot.reload_xpath_config()
+
+    def reload_on_sighup(self, env: dict):
+        with mock.patch.dict(os.environ, env):
+            ctx = bot._startup()
+            try:
+                ctx.wait_index()
+                initial = tuple(bot._parse_simple_xpath("/html/body/div[7]/p"))
+                self.assertEqual(bot.xpath_config().named["xGeneral"], initial)
+                with open(self.path, "w", encoding="utf-8") as fh:
+                    fh.write("# changed\nxGeneral=/html/body/div[3]/p\n")
+                os.kill(os.getpid(), signal.SIGHUP)
+                changed = tuple(bot._parse_simple_xpath("/html/body/div[3]/p"))
+                self.assertTrue(wait_for(lambda: bot.xpath_config().named.get("xGeneral") == changed))
+                self.assertTrue(wait_for(lambda: ctx.index.config is bot.xpath_config()))
+            finally:
+                ctx.close()
+
+    def test_sighup_rereads_config_file(self):
+        self.reload_on_sighup({"BOT_CONFIG_FILE": self.path, "BOT_CONFIG_POLL_SEC": "3600"})
+
+    def test_sighup_falls_back_to_api_env(self):
+        with mock.patch.object(bot, "DEFAULT_CONFIG_FILE", self.path):
+            self.reload_on_sighup({})
+
+
+class CorpusIndexTest(unittest.TestCase):
+    def test_random_page_while_pages_are_added(self):
+        index = bot.CorpusIndex()
+        index.add_values("/0/0.html", ("0",) * len(index.columns))
+        errors = []
+        stop = threading.Event()
+
+        def reader():
+            try:
+                while not stop.is_set():
+                    page = index.random_page()
+                    assert page.path.endswith(f"/{page.values[0]}.html"), page.path
+            except Exception as e:
+                errors.append(e)
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        thread = threading.Thread(target=reader)
+        thread.start()
+        try:
+            for n in range(1, 20000):
+                index.add_values(f"/{n % 7}/{n}.html", (str(n),) * len(index.columns))
+        finally:
+            stop.set()
+            thread.join()
+            sys.setswitchinterval(interval)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(index), 20000)
+
+
+class ReplyDeadlineTest(unittest.TestCase):
+    def setUp(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        index = bot.CorpusIndex()
+        index.add_values("/page.html", ("value",) * len(index.columns))
+        self.ctx = bot.BotContext("test", "test", "model", index)
+        self.ctx.reply_deadline = 0.2
+        self.ctx._gemini_pool = ThreadPoolExecutor(max_workers=1)
+        self.calls = []
+
+        def slow_generate(*args, **kwargs):
+            self.calls.append(time.monotonic())
+            time.sleep(0.5)
+            return "AI reply"
+
+        patcher = mock.patch.object(bot, "gemini_generate", slow_generate)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.ctx._gemini_pool.shutdown(wait=True)
+
+    def job(self) -> "bot.UpdateJob":
+        return bot.prepare_update(self.ctx, message_update(20, 901, "hello!"))
+
+    def test_deadline_counts_from_job_creation(self):
+        job = self.job()
+        time.sleep(0.3)
+        t0 = time.monotonic()
+        with self.assertRaises(bot.ReplyDeadlineExceeded):
+            bot._gemini_reply(self.ctx, job)
+        self.assertLess(time.monotonic() - t0, 0.1)
+        self.ctx._gemini_pool.shutdown(wait=True)
+        self.assertEqual(self.calls, [], "Gemini was called after the deadline")
+
+    def test_queued_call_is_not_made_after_the_deadline(self):
+        jobs = [self.job(), self.job()]
+        errors = []
+
+        def reply(job):
+            try:
+                bot._gemini_reply(self.ctx, job)
+            except bot.ReplyDeadlineExceeded as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=reply, args=(job,)) for job in jobs]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(errors), 2)
+        self.ctx._gemini_pool.shutdown(wait=True)
+        # The one pool thread was busy with the first call; the second never reached Gemini
+        self.assertEqual(len(self.calls), 1)
+
+    def test_stalled_calls_open_the_circuit(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.ctx._gemini_pool = ThreadPoolExecutor(max_workers=2)
+        self.ctx.gemini_breaker = bot.CircuitBreaker(threshold=2, cooldown=60)
+        jobs = [self.job(), self.job(), self.job()]
+
+        def reply(job):
+            with self.assertRaises(bot.ReplyDeadlineExceeded):
+                bot._gemini_reply(self.ctx, job)
+
+        threads = [threading.Thread(target=reply, args=(job,)) for job in jobs]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # Two calls were running at the deadline; the third was still queued and is not counted
+        self.assertEqual(self.ctx.gemini_breaker._failures, 2)
+        self.assertFalse(self.ctx.gemini_breaker.allow())
+
+    def test_call_skipped_at_the_deadline_gets_the_fallback(self):
+        from concurrent.futures import Future
+
+        class LateExecutor:
+            # Runs the call only once the deadline has passed, so it is skipped before result() times out
+            def submit(self, fn):
+                time.sleep(0.3)
+                future = Future()
+                try:
+                    future.set_result(fn())
+                except Exception as e:
+                    future.set_exception(e)
+                return future
+
+        with mock.patch.object(self.ctx, "gemini_pool", LateExecutor):
+            bot.handle_update(self.ctx, message_update(21, 902, "hello!"))
+        self.assertEqual(FAKE.texts[902], ["value"])
+        self.assertEqual(self.calls, [])
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def test_file_is_trimmed_to_maxsize_and_ttl(self):
+        import sqlite3
+
+        path = os.path.join(TMP, "gemini_cache.sqlite3")
+        cache = bot.ResponseCache(maxsize=3, ttl=3600, path=path, flush_sec=3600)
+        cache._unwritten.append(("old", time.time() - 7200, "expired"))
+        for i in range(10):
+            cache.put(f"k{i}", f"reply {i}")
+            time.sleep(0.001)
+        self.assertEqual(sqlite3.connect(path).execute("SELECT COUNT(*) FROM responses").fetchone()[0], 0)
+        cache.close()
+        rows = sqlite3.connect(path).execute("SELECT key FROM responses ORDER BY ts").fetchall()
+        self.assertEqual([key for key, in rows], ["k7", "k8", "k9"])
+        reopened = bot.ResponseCache(maxsize=3, ttl=3600, path=path)
+        self.assertEqual(reopened.get("k9"), "reply 9")
+        self.assertIsNone(reopened.get("k6"))
+        reopened.close()
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def generate(self, breaker, cache):
+        return bot.gemini_generate("key", "model", "hi!", "value", cache=cache, breaker=breaker)
+
+    def half_open(self) -> "bot.CircuitBreaker":
+        breaker = bot.CircuitBreaker(threshold=1, cooldown=0)
+        breaker.failure()
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        return breaker
+
+    def test_cache_hit_is_not_a_probe_result(self):
+        cache = bot.ResponseCache()
+        self.generate(None, cache)
+        breaker = self.half_open()
+        self.assertTrue(self.generate(breaker, cache))
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+
+    def test_api_call_outcome_is_recorded(self):
+        breaker = self.half_open()
+        self.generate(breaker, None)
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        breaker = self.half_open()
+        with mock.patch.object(bot, "get_gemini_client", side_effect=RuntimeError("unavailable")):
+            with self.assertRaises(RuntimeError):
+                self.generate(breaker, None)
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+
+# Runs the bot in a child process, so a test can kill it like a crash would
+RUNNER = """
+import asyncio, os, sys
+sys.path.insert(0, {here!r})
+import bench
+bench.install_fake_genai(float(sys.argv[1]))
+import bot
+if "--async" in sys.argv:
+    asyncio.run(bot.main_async())
+else:
+    bot.main()
+"""
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.state = os.path.join(TMP, f"{self.id()}.state")
+        self.runner = os.path.join(TMP, "runner.py")
+        with open(self.runner, "w", encoding="utf-8") as fh:
+            fh.write(RUNNER.format(here=os.path.dirname(os.path.abspath(__file__))))
+
+    def start_bot(self, gemini_latency: float, *args) -> subprocess.Popen:
+        env = dict(os.environ, BOT_STATE_FILE=self.state, BOT_STATE_FSYNC_SEC="0.02")
+        return subprocess.Popen(
+            [sys.executable, self.runner, str(gemini_latency), *args],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+
+    def state_has(self, text: str) -> bool:
+        try:
+            with open(self.state, "r", encoding="utf-8") as fh:
+                return text in fh.read()
+        except FileNotFoundError:
+            return False
+
+    def crash_with_update_in_flight(self, *args):
+        plain, slow = (801, 802) if args else (701, 702)
+        proc = self.start_bot(60, *args)
+        try:
+            FAKE.push(plain, "hello")
+            FAKE.push(slow, "hello!")  # goes to Gemini, which takes 60s
+            self.assertTrue(wait_for(lambda: FAKE.texts.get(plain), 20))
+            # The plain update is handled and synced; the slow one is still in flight
+            self.assertTrue(wait_for(lambda: self.state_has("h "), 5))
+            self.assertNotIn(slow, FAKE.texts)
+        finally:
+            proc.kill()
+            proc.wait()
+        proc = self.start_bot(0, *args)
+        try:
+            self.assertTrue(wait_for(lambda: FAKE.texts.get(slow), 20), "the in-flight update was lost")
+        finally:
+            proc.kill()
+            proc.wait()
+        self.assertEqual(len(FAKE.texts[plain]), 1, "a handled update was answered again")
+
+    def slow_update_does_not_hold_later_ones(self, *args):
+        first = 1201 if args else 1001
+        proc = self.start_bot(30, *args)
+        try:
+            FAKE.push(first, "hello!")  # in flight for 30s
+            chats = range(first + 1, first + 151)
+            for chat in chats:
+                FAKE.push(chat, "hello")
+            # More than one getUpdates batch (100) queued behind the slow update
+            self.assertTrue(wait_for(lambda: all(FAKE.texts.get(chat) for chat in chats), 10))
+            self.assertNotIn(first, FAKE.texts)
+        finally:
+            proc.kill()
+            proc.wait()
+
+    def test_slow_update_does_not_hold_later_ones(self):
+        self.slow_update_does_not_hold_later_ones()
+
+    def test_slow_update_does_not_hold_later_ones_async(self):
+        self.slow_update_does_not_hold_later_ones("--async")
+
+    def test_update_in_flight_is_answered_after_restart(self):
+        self.crash_with_update_in_flight()
+
+    def test_update_in_flight_is_answered_after_restart_async(self):
+        self.crash_with_update_in_flight("--async")
+
+
+class WebhookTest(unittest.TestCase):
+    """Webhook mode end to end: HTTP POST -> dispatcher -> handle_update -> sendMessage."""
+
+    def setUp(self):
+        self.ctx = bot._startup()
+        self.ctx.wait_index()
+        self.dispatcher = bot.UpdateDispatcher(lambda upd: bot.handle_update(self.ctx, upd), workers=2)
+        self.accepted = []
+
+        def accept(upd: dict) -> bool:
+            self.accepted.append(upd["update_id"])
+            return self.dispatcher.submit(bot._update_chat_id(upd), upd, block=False)
+
+        self.server = bot.WebhookServer(("127.0.0.1", 0), accept, path="/hook", secret="s3cret")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.dispatcher.shutdown(wait=True)
+        self.ctx.close()
+
+    def serve(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def post(self, conn, upd: dict, secret: str = "s3cret", path: str = "/hook") -> int:
+        body = json.dumps(upd).encode("utf-8")
+        headers = {"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": secret}
+        conn.request("POST", path, body, headers)
+        res = conn.getresponse()
+        res.read()
+        return res.status
+
+    def test_secret_and_delivery(self):
+        self.serve()
+        conn = http.client.HTTPConnection("127.0.0.1", self.server.server_address[1], timeout=10)
+        self.assertEqual(self.post(conn, message_update(1, 501, "hello"), secret="wrong"), 403)
+        self.assertEqual(self.post(conn, message_update(2, 501, "hello"), path="/other"), 404)
+        self.assertEqual(self.accepted, [])
+        self.assertEqual(self.post(conn, message_update(3, 501, "hello")), 200)
+        self.assertEqual(self.accepted, [3])
+        self.assertTrue(wait_for(lambda: FAKE.texts.get(501)), "no reply reached the fake Bot API")
+        conn.close()
+
+    def test_tls_handshake_does_not_block_accept(self):
+        cert = os.path.join(TMP, "cert.pem")
+        key = os.path.join(TMP, "key.pem")
+        if not os.path.exists(cert):
+            try:
+                subprocess.run(
+                    ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                     "-subj", "/CN=127.0.0.1", "-keyout", key, "-out", cert],
+                    check=True, capture_output=True,
+                )
+            except (OSError, subprocess.CalledProcessError):
+                self.skipTest("openssl is not available")
+        self.server.use_tls(cert, key)
+        self.serve()
+        port = self.server.server_address[1]
+        # A client that connects but never starts the handshake
+        stalled = socket.create_connection(("127.0.0.1", port))
+        try:
+            ssl_ctx = ssl.create_default_context()
+            ssl_ctx.check_hostname = False
+            ssl_ctx.verify_mode = ssl.CERT_NONE
+            conn = http.client.HTTPSConnection("127.0.0.1", port, timeout=5, context=ssl_ctx)
+            self.assertEqual(self.post(conn, message_update(4, 502, "hello")), 200)
+            conn.close()
+        finally:
+            stalled.close()
+        self.assertTrue(wait_for(lambda: FAKE.texts.get(502)))
+
+
+if __name__ == "__main__":
+    unittest.main()